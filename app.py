@@ -1,16 +1,50 @@
 import os
 import logging
-from flask import Flask, render_template, request, redirect, url_for, session, flash
-from werkzeug.utils import secure_filename
+from flask import (
+    Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, send_file, abort,
+    stream_with_context, g
+)
 import base64
-import requests
+import importlib.util
 import json
-from PIL import Image
-import io
-import google.generativeai as genai
+import threading
+import uuid
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from verdict_cache import VerdictCache, file_digest, make_cache_key
+from gemini_client import ModelRegistry, load_backend, load_sdk
+from model_router import ModelRouter, parse_routes
+from imaging import (
+    MAX_INPUT_PIXELS, ImageNormalizationError, NormalizedImage, normalize_image, normalize_upload,
+    load_normalized_image, save_display_image, get_thumbnail
+)
+from payload_policy import PayloadPolicy
+from storage import ImageStore, Janitor
+from jobs import JobQueue, QueueFullError
+from rate_limit import OverloadedError, RateLimiter
+from upload_validation import UploadRejected, UploadRequest
+import result_store
+import references
+import metrics
+import log_config
+try:
+    import prescreen
+    import similarity_index
+except ImportError:  # NumPy is not installed
+    prescreen = similarity_index = None
+from verdict_parser import STRUCTURED_PROMPT, parse_verdict, structured_generation_config
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging: JSON lines written by a background thread, per-module levels
+# (e.g. LOG_LEVELS="werkzeug=WARNING,imaging=DEBUG"), sampled DEBUG records and a
+# per-request cap on records below WARNING
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()
+LOG_DEBUG_SAMPLE = int(os.environ.get("LOG_DEBUG_SAMPLE", "10"))
+LOG_REQUEST_BUDGET = int(os.environ.get("LOG_REQUEST_BUDGET", "50"))
+log_config.configure(level=LOG_LEVEL, levels=LOG_LEVELS, fmt=LOG_FORMAT,
+                     debug_sample=LOG_DEBUG_SAMPLE, request_budget=LOG_REQUEST_BUDGET)
 logger = logging.getLogger(__name__)
 
 # Initialize the Flask application
@@ -18,16 +52,78 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "deepfake-detection-secret-key")
 
 # Configure upload settings
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER") or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB limit
 
-# Create upload folder if it doesn't exist
+# Normalized uploads are stored by content digest in sharded subdirectories
+STORE_FOLDER = os.path.join(UPLOAD_FOLDER, 'store')
+
+# Registered reference images are kept (with their features) until deleted, outside the janitor's reach
+REFERENCE_FOLDER = os.path.join(UPLOAD_FOLDER, 'references')
+
+# Display thumbnails are stored by content digest and cached by browsers for a year
+THUMBNAIL_FOLDER = os.path.join(UPLOAD_FOLDER, 'thumbnails')
+THUMBNAIL_MAX_AGE = 365 * 24 * 3600
+
+# Retention for stored uploads and thumbnails, enforced by a background janitor
+UPLOAD_RETENTION = int(os.environ.get("UPLOAD_RETENTION", str(7 * 24 * 3600)))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", str(1024 * 1024 * 1024)))
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "600"))
+
+# Create upload folders if they don't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
+
+# Analysis results are stored server-side (SQLite by default, or DATABASE_URL)
+os.makedirs(app.instance_path, exist_ok=True)
+app.config['SQLALCHEMY_DATABASE_URI'] = (
+    os.environ.get("DATABASE_URL") or "sqlite:///" + os.path.join(app.instance_path, 'results.db'))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {"pool_pre_ping": True}
+result_store.init_app(app)
 app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
 
+# Uploaded files are checked by signature and header while the body is being received,
+# so disguised files and oversized images are rejected before the rest is read
+UPLOAD_MAX_PIXELS = int(os.environ.get("UPLOAD_MAX_PIXELS", str(MAX_INPUT_PIXELS)))
+UploadRequest.upload_max_pixels = UPLOAD_MAX_PIXELS
+app.request_class = UploadRequest
+
+# Request metrics, served at /metrics. Each worker writes periodic snapshots to METRICS_DIR
+# so that a scrape of any worker reports totals for the whole server.
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(app.instance_path, 'metrics'))
+metrics.configure(snapshot_dir=METRICS_DIR or None)
+
+metrics.describe("http_requests_total", "counter", "HTTP requests by endpoint, method and status")
+metrics.describe("http_request_duration_seconds", "histogram", "Time to produce each HTTP response (excluding streamed bodies)")
+metrics.describe("http_request_bytes_total", "counter", "Request body bytes received")
+metrics.describe("http_response_bytes_total", "counter", "Response body bytes sent (responses of known length)")
+metrics.describe("verdict_cache_lookups_total", "counter", "Verdict cache lookups by result")
+metrics.describe("prescreen_total", "counter", "Local pre-screen outcomes")
+metrics.describe("known_fake_lookups_total", "counter", "Known-fake index lookups by result")
+metrics.describe("model_calls_total", "counter", "Gemini calls by model")
+metrics.describe("model_call_seconds", "histogram", "Duration of each Gemini call by model, including failed calls")
+metrics.describe("model_errors_total", "counter", "Failed Gemini calls by model and exception type")
+metrics.describe("model_request_bytes_total", "counter", "Prompt and image bytes sent to Gemini")
+metrics.describe("model_response_bytes_total", "counter", "Reply text bytes received from Gemini")
+metrics.describe("face_crops_total", "counter", "Model calls sent as face crops or, without a face in both images, as full images")
+metrics.describe("model_payload_bytes_total", "counter", "Image bytes sent to Gemini by payload (compact, full or face crops)")
+metrics.describe("model_payload_saved_bytes_total", "counter", "Image bytes the compact payload saved over sending the full normalized images")
+metrics.describe("model_payload_escalations_total", "counter", "Analyses asked again with the full images after a low-confidence compact verdict")
+metrics.describe("upload_rejections_total", "counter", "Uploads rejected by signature or header validation")
+metrics.describe("log_records_total", "counter", "Log records written during requests")
+metrics.describe("log_records_dropped_total", "counter", "Log records dropped by the per-request budget")
+metrics.describe("request_log_seconds", "histogram", "Time each request spent in logging calls")
+metrics.describe("log_queue_depth", "gauge", "Log records waiting for the writer thread in this worker")
+metrics.describe("log_queue_dropped", "gauge", "Log records dropped because the queue was full, since this worker started")
+metrics.describe("log_sampled_out", "gauge", "DEBUG records dropped by sampling, since this worker started")
+metrics.registry.gauge("log_queue_depth", lambda: log_config.stats()["queue_depth"])
+metrics.registry.gauge("log_queue_dropped", lambda: log_config.stats()["queue_dropped"])
+metrics.registry.gauge("log_sampled_out", lambda: log_config.stats()["sampled_out"])
+
 # Configure Gemini API
 # Check for both potential API key environment variables
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY", "")
@@ -42,57 +138,12 @@ if not api_key:
 else:
     logger.info("API key found. Configuring Gemini API.")
 
-# Configure the API with whatever key we found
-genai.configure(api_key=api_key)
-
-def allowed_file(filename):
-    """Check if file has an allowed extension"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
-
-def encode_image(image_path):
-    """Encode image to base64 string"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# Model used for analysis. Bump PROMPT_VERSION (or STRUCTURED_PROMPT_VERSION) whenever a prompt changes
+# so cached verdicts produced by the old prompt are no longer served.
+MODEL_NAME = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash")
+PROMPT_VERSION = 1
 
-def resize_image_if_needed(file_path, max_size=(1024, 1024)):
-    """Resize image if it's too large for the API"""
-    try:
-        # Normalize the path to handle OS-specific path separators
-        file_path = os.path.normpath(file_path)
-        
-        logger.info(f"Checking if image needs resizing: {file_path}")
-        
-        img = Image.open(file_path)
-        if img.width > max_size[0] or img.height > max_size[1]:
-            img.thumbnail(max_size, Image.LANCZOS)
-            img.save(file_path)
-            logger.info(f"Image resized to {img.size}")
-        else:
-            logger.info(f"No resize needed, image is {img.size}")
-    except Exception as e:
-        logger.error(f"Error resizing image: {e}")
-
-def analyze_images_with_gemini(original_path, suspected_path):
-    """
-    Use Google's Gemini API to analyze if the second image is a deepfake
-    compared to the first (original) image
-    """
-    try:
-        # Normalize paths to prevent OS-specific path separator issues
-        original_path = os.path.normpath(original_path)
-        suspected_path = os.path.normpath(suspected_path)
-        
-        logger.info(f"Analyzing images from: {original_path} and {suspected_path}")
-        
-        # Configure the model
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        
-        # Load images
-        original_img = Image.open(original_path)
-        suspected_img = Image.open(suspected_path)
-        
-        # Prepare prompt for Gemini
-        prompt = """
+ANALYSIS_PROMPT = """
         Analyze these two images carefully:
         Image 1 is provided as the reference/original image.
         Image 2 is a suspected deepfake or manipulated version.
@@ -117,57 +168,484 @@ def analyze_images_with_gemini(original_path, suspected_path):
         
         Format your response with clear headings and be as specific as possible.
         """
+
+# Analysis mode: "detailed" asks for free-form prose and infers the verdict from
+# keywords; "structured" uses the terse prompt with a JSON response schema and
+# falls back to the keyword heuristic if the reply does not validate.
+ANALYSIS_MODE = os.environ.get("ANALYSIS_MODE", "detailed").lower()
+STRUCTURED_MODE = ANALYSIS_MODE == "structured"
+STRUCTURED_PROMPT_VERSION = 1
+
+if STRUCTURED_MODE:
+    ACTIVE_PROMPT, ACTIVE_PROMPT_VERSION = STRUCTURED_PROMPT, f"structured-{STRUCTURED_PROMPT_VERSION}"
+else:
+    ACTIVE_PROMPT, ACTIVE_PROMPT_VERSION = ANALYSIS_PROMPT, PROMPT_VERSION
+
+# Face-crop mode: when both images contain a face, send aligned face crops (and optionally
+# low-resolution thumbnails of the full images) instead of the full images
+FACE_CROP_ENABLED = os.environ.get("FACE_CROP_ENABLED", "false").lower() in ("1", "true", "yes")
+FACE_CROP_CONTEXT = os.environ.get("FACE_CROP_CONTEXT", "false").lower() in ("1", "true", "yes")
+
+# OpenCV is slow to import, so the faces module is only loaded when face cropping is enabled
+faces = None
+if FACE_CROP_ENABLED:
+    try:
+        import faces
+    except ImportError:
+        logger.warning("OpenCV is not installed; face cropping is disabled.")
+        FACE_CROP_ENABLED = False
+
+FACE_CROP_NOTE = """
+        Note: Image 1 and Image 2 are aligned close-up crops of the main face in the
+        reference and the suspected image."""
+FACE_CONTEXT_NOTE = """
+        Image 3 and Image 4 are low-resolution views of the complete reference and
+        suspected images, provided only for context."""
+
+if FACE_CROP_ENABLED:
+    # Crops change what the model sees, so they get their own cache namespace
+    ACTIVE_PROMPT_VERSION = f"{ACTIVE_PROMPT_VERSION}+faces{'-context' if FACE_CROP_CONTEXT else ''}"
+
+# Payload policy: full images are first sent to the model resized to PAYLOAD_MAX_SIZE and
+# re-encoded (lossless WebP for graphics, PAYLOAD_FORMAT for photos) within PAYLOAD_BYTE_BUDGET
+# bytes each; with PAYLOAD_ESCALATE, inconclusive or low-confidence verdicts are asked again
+# with the full normalized images
+PAYLOAD_POLICY_ENABLED = os.environ.get("PAYLOAD_POLICY_ENABLED", "true").lower() in ("1", "true", "yes")
+PAYLOAD_MAX_SIZE = int(os.environ.get("PAYLOAD_MAX_SIZE", "768"))
+PAYLOAD_BYTE_BUDGET = int(os.environ.get("PAYLOAD_BYTE_BUDGET", str(256 * 1024)))
+PAYLOAD_FORMAT = os.environ.get("PAYLOAD_FORMAT", "jpeg").lower()
+PAYLOAD_QUALITY = int(os.environ.get("PAYLOAD_QUALITY", "85"))
+PAYLOAD_ESCALATE = os.environ.get("PAYLOAD_ESCALATE", "true").lower() in ("1", "true", "yes")
+
+payload_policy = None
+if PAYLOAD_POLICY_ENABLED:
+    payload_policy = PayloadPolicy(max_size=(PAYLOAD_MAX_SIZE, PAYLOAD_MAX_SIZE), byte_budget=PAYLOAD_BYTE_BUDGET,
+                                   photo_format=PAYLOAD_FORMAT, quality=PAYLOAD_QUALITY, escalate=PAYLOAD_ESCALATE)
+    # The model sees different bytes, so compact payloads get their own cache namespace
+    ACTIVE_PROMPT_VERSION = f"{ACTIVE_PROMPT_VERSION}+payload-{payload_policy.key}{'-escalate' if PAYLOAD_ESCALATE else ''}"
+
+# Local pre-screen thresholds; pairs that pass them are answered without calling Gemini
+PRESCREEN_ENABLED = os.environ.get("PRESCREEN_ENABLED", "true").lower() in ("1", "true", "yes")
+PRESCREEN_MAX_HASH_DISTANCE = int(os.environ.get("PRESCREEN_MAX_HASH_DISTANCE", "2"))
+PRESCREEN_MIN_SSIM = float(os.environ.get("PRESCREEN_MIN_SSIM", "0.99"))
+PRESCREEN_MAX_ELA_DELTA = float(os.environ.get("PRESCREEN_MAX_ELA_DELTA", "0.01"))
+PRESCREEN_MIN_BLOCK_SSIM = float(os.environ.get("PRESCREEN_MIN_BLOCK_SSIM", "0.95"))
+PRESCREEN_MAX_BLOCK_DIFF = float(os.environ.get("PRESCREEN_MAX_BLOCK_DIFF", "0.02"))
+
+if PRESCREEN_ENABLED and prescreen is None:
+    logger.warning("NumPy is not installed; local pre-screening is disabled.")
+
+# Known-fake index: every suspected image with a model verdict is recorded by perceptual hash
+# together with its reference, and near-duplicates (re-crops, re-compressions) of images already
+# flagged as deepfakes against the same reference get the prior verdict, with its provenance,
+# without a model call
+KNOWN_FAKES_ENABLED = os.environ.get("KNOWN_FAKES_ENABLED", "true").lower() in ("1", "true", "yes")
+KNOWN_FAKES_MAX_DISTANCE = int(os.environ.get("KNOWN_FAKES_MAX_DISTANCE", "6"))
+KNOWN_FAKES_FOLDER = os.environ.get("KNOWN_FAKES_FOLDER") or os.path.join(app.instance_path, 'similarity_index')
+
+known_fakes = None
+if KNOWN_FAKES_ENABLED and similarity_index is not None:
+    known_fakes = similarity_index.SimilarityIndex(KNOWN_FAKES_FOLDER, max_distance=KNOWN_FAKES_MAX_DISTANCE)
+    metrics.describe("known_fakes_indexed", "gauge", "Known deepfakes searchable by this worker")
+    metrics.registry.gauge("known_fakes_indexed", lambda: len(known_fakes))
+elif KNOWN_FAKES_ENABLED:
+    logger.warning("NumPy is not installed; the known-fake index is disabled.")
+
+# Configure the shared Gemini client with whatever key we found. Models are
+# created once per process and reused across requests.
+GEMINI_TIMEOUT = float(os.environ.get("GEMINI_TIMEOUT", "60"))
+GEMINI_RETRY_TIMEOUT = float(os.environ.get("GEMINI_RETRY_TIMEOUT", "30"))
+GEMINI_TRANSPORT = os.environ.get("GEMINI_TRANSPORT") or None
+
+# Client-side limits on Gemini calls. The token bucket and in-flight cap are shared by
+# every worker on the machine through GEMINI_LIMITER_PATH; calls that cannot get a slot
+# within GEMINI_QUEUE_TIMEOUT seconds fail fast and the client is told to retry later.
+GEMINI_RATE_LIMIT = float(os.environ.get("GEMINI_RATE_LIMIT", "0"))
+GEMINI_BURST = float(os.environ.get("GEMINI_BURST") or 0)
+GEMINI_MAX_IN_FLIGHT = int(os.environ.get("GEMINI_MAX_IN_FLIGHT", "8"))
+GEMINI_MAX_WAITING = int(os.environ.get("GEMINI_MAX_WAITING", "32"))
+GEMINI_QUEUE_TIMEOUT = float(os.environ.get("GEMINI_QUEUE_TIMEOUT", "30"))
+GEMINI_LIMITER_PATH = os.environ.get("GEMINI_LIMITER_PATH", os.path.join(app.instance_path, 'gemini_limiter.db'))
+
+gemini_limiter = None
+if GEMINI_RATE_LIMIT > 0 or GEMINI_MAX_IN_FLIGHT > 0:
+    gemini_limiter = RateLimiter(
+        rate=GEMINI_RATE_LIMIT,
+        burst=GEMINI_BURST or None,
+        max_in_flight=GEMINI_MAX_IN_FLIGHT,
+        max_waiting=GEMINI_MAX_WAITING,
+        db_path=GEMINI_LIMITER_PATH or None,
+        lease_ttl=max(2 * GEMINI_TIMEOUT, 60),
+    )
+
+model_registry = ModelRegistry(
+    api_key=api_key,
+    transport=GEMINI_TRANSPORT,
+    timeout=GEMINI_TIMEOUT,
+    retry_timeout=GEMINI_RETRY_TIMEOUT,
+    limiter=gemini_limiter,
+    queue_timeout=GEMINI_QUEUE_TIMEOUT,
+)
+
+# Model routing. GEMINI_MODELS lists the models to use, in order, each with optional per-model
+# settings ("gemini-1.5-flash:timeout=20:cost=1,gemini-1.5-pro:timeout=60:cost=4"); it defaults
+# to GEMINI_MODEL alone. GEMINI_ROUTING picks the strategy: fallback, hedge or ensemble.
+GEMINI_MODELS = os.environ.get("GEMINI_MODELS", "")
+GEMINI_ROUTING = os.environ.get("GEMINI_ROUTING", "fallback").lower()
+GEMINI_ENSEMBLE_SIZE = int(os.environ.get("GEMINI_ENSEMBLE_SIZE", "2"))
+GEMINI_MAX_COST = float(os.environ.get("GEMINI_MAX_COST", "0"))
+GEMINI_MAX_ERROR_RATE = float(os.environ.get("GEMINI_MAX_ERROR_RATE", "0.5"))
+
+def record_model_call(model, elapsed, text, error):
+    """Router observer: per-model call, latency, error and response byte metrics"""
+    metrics.inc("model_calls_total", model=model)
+    metrics.observe("model_call_seconds", elapsed, model=model)
+    if error is not None:
+        metrics.inc("model_errors_total", model=model, type=type(error).__name__)
+    else:
+        metrics.inc("model_response_bytes_total", len(text.encode("utf-8")))
+
+model_router = ModelRouter(
+    model_registry,
+    parse_routes(GEMINI_MODELS or MODEL_NAME, default_timeout=GEMINI_TIMEOUT),
+    strategy=GEMINI_ROUTING,
+    ensemble_size=GEMINI_ENSEMBLE_SIZE,
+    max_cost=GEMINI_MAX_COST,
+    max_error_rate=GEMINI_MAX_ERROR_RATE,
+    observer=record_model_call,
+)
+# Results are recorded under the first model; the model that actually answered is stored on completion
+MODEL_NAME = model_router.primary
+
+# Model backend: empty for the real Gemini API, "fake" for the local FakeModel used by
+# benchmarks (FAKE_MODEL_LATENCY, FAKE_MODEL_TEXT), or "package.module:factory"
+GEMINI_BACKEND = os.environ.get("GEMINI_BACKEND", "")
+if GEMINI_BACKEND:
+    model_registry.set_factory(load_backend(GEMINI_BACKEND))
+    logger.warning("Using model backend %r instead of the Gemini API", GEMINI_BACKEND)
+
+# Model warm-up when a worker starts: "client" imports the SDK and creates the routed models
+# in a background thread, "connect" also opens their connections, "off" leaves it all to the
+# first request that needs a model
+MODEL_WARMUP = os.environ.get("MODEL_WARMUP", "client").lower()
+
+# Configure verdict cache (set VERDICT_CACHE_PATH to share verdicts between workers)
+VERDICT_CACHE_SIZE = int(os.environ.get("VERDICT_CACHE_SIZE", "1024"))
+VERDICT_CACHE_TTL = int(os.environ.get("VERDICT_CACHE_TTL", str(7 * 24 * 3600)))
+VERDICT_CACHE_PATH = os.environ.get("VERDICT_CACHE_PATH", "")
+
+verdict_cache = VerdictCache(
+    max_entries=VERDICT_CACHE_SIZE,
+    ttl=VERDICT_CACHE_TTL,
+    db_path=VERDICT_CACHE_PATH or None,
+)
+
+# Configure upload storage and start the retention janitor
+image_store = ImageStore(STORE_FOLDER)
+reference_store = ImageStore(REFERENCE_FOLDER)
+storage_janitor = Janitor(
+    [STORE_FOLDER, THUMBNAIL_FOLDER],
+    max_age=UPLOAD_RETENTION,
+    max_bytes=UPLOAD_MAX_BYTES,
+    interval=JANITOR_INTERVAL,
+)
+storage_janitor.start()
+
+# Configure background analysis jobs used by JSON clients of /upload
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "64"))
+JOB_RETRY_AFTER = 5  # seconds suggested to clients when the queue is full
+
+job_queue = JobQueue(max_workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE)
+
+metrics.describe("jobs_pending", "gauge", "Queued or running analysis jobs in this worker")
+metrics.registry.gauge("jobs_pending", job_queue.pending)
+if gemini_limiter is not None:
+    metrics.describe("model_calls_in_flight", "gauge", "Gemini calls holding a limiter slot on this machine")
+    metrics.registry.gauge("model_calls_in_flight", lambda: gemini_limiter.stats()["in_flight"])
+
+# Streaming mode: jobs call the model with streaming enabled and the results page
+# shows the analysis text as it arrives over server-sent events (/stream/<id>).
+# Each event stream holds a worker, so run gunicorn with threaded workers when enabling it.
+STREAMING_ENABLED = os.environ.get("STREAM_RESULTS", "false").lower() in ("1", "true", "yes")
+STREAM_POLL_INTERVAL = float(os.environ.get("STREAM_POLL_INTERVAL", "0.25"))
+STREAM_MAX_DURATION = float(os.environ.get("STREAM_MAX_DURATION", "30"))
+STREAM_FLUSH_INTERVAL = 0.25  # seconds between writes of partial text to the result store
+STREAM_KEEPALIVE = 15  # seconds of silence before a keep-alive comment is sent
+STREAM_RETRY_MS = 1000  # reconnection delay suggested to EventSource clients
+
+# Configure the batch API (one reference compared against many suspected images)
+BATCH_PARALLELISM = int(os.environ.get("BATCH_PARALLELISM", "4"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "50"))
+
+def readiness_checks(include_load=True):
+    """
+    Check the dependencies a worker needs to serve analyses.
+    
+    Returns a dict mapping each check name to a problem description, or None
+    when the check passed. include_load adds the job queue capacity check,
+    which only makes sense for a running worker.
+    """
+    checks = {
+        "model": None if (api_key or GEMINI_BACKEND) else "No Gemini API key configured (GEMINI_API_KEY or GOOGLE_API_KEY)",
+        "storage": None,
+        "database": None,
+    }
+    
+    for folder in (STORE_FOLDER, THUMBNAIL_FOLDER, REFERENCE_FOLDER):
+        os.makedirs(folder, exist_ok=True)
+        if not os.access(folder, os.W_OK):
+            checks["storage"] = f"Upload folder {folder} is not writable"
+    
+    try:
+        with app.app_context():
+            result_store.ping()
+    except Exception as e:
+        checks["database"] = f"Database unavailable: {e}"
+    
+    if include_load:
+        checks["jobs"] = "Job queue is full" if job_queue.pending() >= JOB_QUEUE_SIZE else None
+    return checks
+
+def startup_check():
+    """
+    Run the readiness checks once before serving (gunicorn on_starting, or
+    `python main.py --check`). Returns the list of problems found.
+    """
+    problems = [f"{name}: {problem}" for name, problem in readiness_checks(include_load=False).items() if problem]
+    for problem in problems:
+        logger.error("Startup check failed: %s", problem)
+    if not problems:
+        logger.info("Startup check passed")
+    return problems
+
+def init_worker():
+    """
+    Reset per-process state inherited from a preloading parent process.
+    
+    Called by gunicorn's post_fork hook: pooled database connections, SQLite
+    handles and the Gemini transport must not be shared across a fork, and
+    the log writer thread does not survive it.
+    """
+    log_config.reinit()
+    with app.app_context():
+        result_store.dispose_connections()
+    verdict_cache.reopen()
+    if known_fakes is not None:
+        known_fakes.reopen()
+    if gemini_limiter is not None:
+        gemini_limiter.reopen()
+    model_registry.reset()
+
+def preload():
+    """
+    Import the Gemini SDK in a preloading parent process (gunicorn on_starting).
+    
+    Forked workers then share the imported modules instead of each importing
+    them. Nothing is configured and no connection is opened before the fork.
+    """
+    if MODEL_WARMUP != "off" and not GEMINI_BACKEND:
+        started = time.perf_counter()
+        load_sdk()
+        logger.info("Preloaded the Gemini SDK in %.2fs", time.perf_counter() - started)
+
+def warm_up(background=True):
+    """
+    Create the routed models (and with MODEL_WARMUP=connect, open their
+    connections) before the first request needs them.
+    
+    Runs in a daemon thread unless background is False; returns the thread.
+    Failures are logged and left to the first request to retry.
+    """
+    if MODEL_WARMUP == "off":
+        return None
+    
+    def run():
+        started = time.perf_counter()
+        try:
+            model_registry.warm_up([route.name for route in model_router.routes], connect=MODEL_WARMUP == "connect")
+        except Exception as e:
+            logger.warning("Model warm-up failed: %s", e)
+            return
+        logger.info("Model warm-up finished in %.2fs", time.perf_counter() - started)
+    
+    if not background:
+        run()
+        return None
+    thread = threading.Thread(target=run, name="model-warmup", daemon=True)
+    thread.start()
+    return thread
+
+# Video mode (/api/video): keyframes of a clip are scored against a reference image.
+# Sampling and parallelism bound how many model calls one clip can cost.
+VIDEO_EXTENSIONS = {'mp4', 'mov', 'webm', 'mkv', 'avi'}
+VIDEO_MAX_BYTES = int(os.environ.get("VIDEO_MAX_BYTES", str(100 * 1024 * 1024)))
+VIDEO_SAMPLE_EVERY = int(os.environ.get("VIDEO_SAMPLE_EVERY", "5"))
+VIDEO_SCENE_THRESHOLD = float(os.environ.get("VIDEO_SCENE_THRESHOLD", "0.35"))
+VIDEO_FACE_THRESHOLD = float(os.environ.get("VIDEO_FACE_THRESHOLD", "0.12"))
+VIDEO_MIN_GAP = float(os.environ.get("VIDEO_MIN_GAP", "1.0"))
+VIDEO_MAX_FRAMES = int(os.environ.get("VIDEO_MAX_FRAMES", "16"))
+VIDEO_MAX_DURATION = float(os.environ.get("VIDEO_MAX_DURATION", "120"))
+VIDEO_PARALLELISM = int(os.environ.get("VIDEO_PARALLELISM", "4"))
+VIDEO_DEEPFAKE_RATIO = float(os.environ.get("VIDEO_DEEPFAKE_RATIO", "0.3"))
+
+# Clips are received straight into a temporary file, with their own size limit
+UploadRequest.upload_spool_endpoints = {'analyze_video': VIDEO_MAX_BYTES}
+UploadRequest.upload_spool_extensions = frozenset(VIDEO_EXTENSIONS)
+
+if importlib.util.find_spec("cv2") is None:
+    logger.warning("OpenCV is not installed; video analysis is disabled.")
+
+def load_video_support():
+    """Import the video module on first use (OpenCV is slow to import); None without OpenCV"""
+    try:
+        import video
+    except ImportError:
+        return None
+    return video
+
+def allowed_file(filename):
+    """Check if file has an allowed extension"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def allowed_video(filename):
+    """Check if file has an allowed video extension"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in VIDEO_EXTENSIONS
+
+def encode_image(image_path):
+    """Encode image to base64 string"""
+    with open(image_path, "rb") as image_file:
+        return base64.b64encode(image_file.read()).decode('utf-8')
+
+def resize_image_if_needed(file_path, max_size=(1024, 1024)):
+    """
+    Resize an image file in place if it's too large for the API.
+    
+    Raises ImageNormalizationError if the file is not a valid image, so
+    corrupt or disguised files never reach the model.
+    """
+    try:
+        # Normalize the path to handle OS-specific path separators
+        file_path = os.path.normpath(file_path)
         
-        # Generate content with Gemini
-        response = model.generate_content([prompt, original_img, suspected_img])
+        logger.debug("Checking if image needs resizing: %s", file_path)
         
-        # Process response
-        analysis = response.text
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        normalized = normalize_image(data, max_size=max_size, display_size=None)
+        if normalized.data is not data:
+            normalized.save(file_path)
+    except ImageNormalizationError as e:
+        logger.warning("Rejecting image %s: %s", file_path, e)
+        raise
+    except Exception as e:
+        logger.error("Error resizing image: %s", e)
+
+def as_normalized_image(image):
+    """Accept a NormalizedImage or a path to an already-normalized image file"""
+    if isinstance(image, NormalizedImage):
+        return image
+    return load_normalized_image(os.path.normpath(image))
+
+def analyze_images_with_gemini(original, suspected, on_partial=None):
+    """
+    Use Google's Gemini API to analyze if the second image is a deepfake
+    compared to the first (original) image.
+    
+    Each image may be a file path or a NormalizedImage that is already in
+    memory, in which case nothing is read back from disk.
+    
+    When on_partial is given (and the detailed prompt is in use) the model is
+    called with streaming enabled and on_partial(text) is called with the
+    text received so far after every chunk. on_partial("") means the reply
+    starts over, e.g. because another model took over.
+    
+    Raises OverloadedError when the model cannot take the call right now;
+    any other failure is reported as an error result.
+    """
+    try:
+        original_img = as_normalized_image(original)
+        suspected_img = as_normalized_image(suspected)
         
-        # Extract determination
-        is_deepfake = False
-        confidence = "Medium"  # Default to Medium instead of Unknown
+        logger.debug("Analyzing images %s and %s", original_img.digest[:12], suspected_img.digest[:12])
         
-        # Check for keywords that indicate different people or deepfake
-        text_lower = analysis.lower()
+        # Answer trivial pairs (identical or near-duplicate images) locally
+        if prescreen is not None and PRESCREEN_ENABLED:
+            with metrics.span("prescreen"):
+                local_result = prescreen.prescreen(
+                    original_img, suspected_img,
+                    max_hash_distance=PRESCREEN_MAX_HASH_DISTANCE,
+                    min_ssim=PRESCREEN_MIN_SSIM,
+                    max_ela_delta=PRESCREEN_MAX_ELA_DELTA,
+                    min_block_ssim=PRESCREEN_MIN_BLOCK_SSIM,
+                    max_block_diff=PRESCREEN_MAX_BLOCK_DIFF,
+                )
+            metrics.inc("prescreen_total", outcome="escalated" if local_result is None else "local")
+            if local_result is not None:
+                return local_result
         
-        # Strong indicators of different people/deepfake
-        if any(phrase in text_lower for phrase in [
-            "different people", 
-            "not the same person",
-            "completely different",
-            "two different individuals",
-            "different individuals"
-        ]):
-            is_deepfake = True
-            confidence = "High"
-        # Indicators of same person (non-deepfake)
-        elif "same person" in text_lower and "not a deepfake" in text_lower:
-            is_deepfake = False
-            confidence = "High" if "high confidence" in text_lower else "Medium"
-        else:
-            # Fall back to yes/no determination
-            if "yes" in text_lower and ("deepfake" in text_lower or "manipulated" in text_lower):
-                is_deepfake = True
-            elif "no" in text_lower and "not a deepfake" in text_lower:
-                is_deepfake = False
-            
-            # Extract confidence
-            if "high confidence" in text_lower:
-                confidence = "High"
-            elif "medium confidence" in text_lower:
-                confidence = "Medium"
-            elif "low confidence" in text_lower:
-                confidence = "Low"
+        # Serve repeat submissions of the same pair from the verdict cache
+        cache_key = make_cache_key(original_img.digest, suspected_img.digest, model_router.key, ACTIVE_PROMPT_VERSION)
+        with metrics.span("cache"):
+            cached_result = verdict_cache.get(cache_key)
+        metrics.inc("verdict_cache_lookups_total", result="miss" if cached_result is None else "hit")
+        if cached_result is not None:
+            logger.debug("Verdict cache hit for %s", cache_key[:12])
+            return cached_result
         
-        return {
-            "is_deepfake": is_deepfake,
-            "confidence": confidence,
-            "analysis": analysis
-        }
+        # Answer near-duplicates of images already flagged as deepfakes from the known-fake index
+        if known_fakes is not None:
+            with metrics.span("known_fakes"):
+                suspected_print = prescreen.fingerprint(suspected_img)
+                match = known_fakes.lookup(original_img.digest, suspected_print.phash, suspected_print.dhash)
+            metrics.inc("known_fake_lookups_total", result="miss" if match is None else "hit")
+            if match is not None:
+                return known_fake_result(match)
+        
+        # Generate content with the routed Gemini model(s)
+        prompt, images, crops = ACTIVE_PROMPT, [original_img, suspected_img], None
+        if FACE_CROP_ENABLED:
+            with metrics.span("faces"):
+                crops = faces.face_payload(original_img, suspected_img, context=FACE_CROP_CONTEXT)
+            metrics.inc("face_crops_total", outcome="full" if crops is None else "cropped")
+            if crops is not None:
+                prompt = ACTIVE_PROMPT + FACE_CROP_NOTE + (FACE_CONTEXT_NOTE if FACE_CROP_CONTEXT else "")
+                images = crops
+
+        # Face crops are already small, so the payload policy only applies to full images
+        payload = images
+        if payload_policy is not None and crops is None:
+            with metrics.span("payload"):
+                payload = [payload_policy.encode(image) for image in images]
+            if all(compact is image for compact, image in zip(payload, images)):
+                payload = images  # nothing was re-encoded, so escalating would send the same bytes again
+
+        sent = len(payload)
+        tier = "compact" if payload is not images else "crops" if crops is not None else "full"
+        result = call_model(prompt, payload, on_partial, tier=tier)
+        payload_bytes = sum(len(image.data) for image in payload)
+        if payload is not images:
+            metrics.inc("model_payload_saved_bytes_total", sum(len(image.data) for image in images) - payload_bytes)
+            if payload_policy.should_escalate(result):
+                logger.debug("Low-confidence compact verdict, asking again with the full images")
+                metrics.inc("model_payload_escalations_total")
+                if on_partial is not None and not STRUCTURED_MODE:
+                    on_partial("")  # the streamed text starts over
+                result = call_model(prompt, images, on_partial, tier="full")
+                payload_bytes += sum(len(image.data) for image in images)
+                sent += len(images)
+        result["payload"] = {"images": sent, "bytes": payload_bytes, "escalated": sent > len(payload)}
+
+        # Only successful analyses are cached; errors are retried next time
+        verdict_cache.set(cache_key, result)
+        
+        return result
     
+    except OverloadedError:
+        # Not a verdict: let the caller tell the client to retry later
+        raise
     except Exception as e:
-        logger.error(f"Error analyzing images: {e}")
+        logger.error("Error analyzing images: %s", e)
         return {
             "error": str(e),
             "is_deepfake": None,
@@ -175,6 +653,229 @@ def analyze_images_with_gemini(original_path, suspected_path):
             "analysis": f"Error during analysis: {str(e)}"
         }
 
+def call_model(prompt, images, on_partial=None, tier="full"):
+    """Ask the routed model(s) for a verdict on images and return the parsed result"""
+    contents = [prompt] + [image.blob for image in images]
+    options = {"generation_config": structured_generation_config()} if STRUCTURED_MODE else {}
+
+    image_bytes = sum(len(image.data) for image in images)
+    metrics.inc("model_request_bytes_total", len(prompt.encode("utf-8")) + image_bytes)
+    metrics.inc("model_payload_bytes_total", image_bytes, tier=tier)
+    with metrics.span("model"):
+        # Partial JSON is not worth showing, so structured replies are never streamed
+        return model_router.generate(
+            contents,
+            parse=lambda text: parse_verdict(text, structured=STRUCTURED_MODE),
+            on_partial=on_partial if not STRUCTURED_MODE else None,
+            **options,
+        )
+
+def known_fake_result(match):
+    """Verdict for a near-duplicate of a known fake, citing the analysis that flagged it"""
+    with app.app_context():
+        prior = result_store.get_result(match.result_id)
+        prior_analysis = prior.analysis if prior is not None else None
+        prior_model = prior.model_name if prior is not None else None
+    flagged_at = datetime.fromtimestamp(match.created, timezone.utc)
+    analysis = (
+        "Known deepfake (no AI model call was needed).\n\n"
+        f"The suspected image is a near-duplicate of an image flagged as a deepfake against the same "
+        f"reference image in analysis "
+        f"{match.result_id} on {flagged_at:%Y-%m-%d %H:%M} UTC "
+        f"(perceptual hashes differ by {match.distance} of 64 bits)."
+    )
+    if prior_analysis:
+        analysis += f"\n\nOriginal analysis:\n{prior_analysis}"
+    return {
+        "is_deepfake": True,
+        "confidence": match.confidence,
+        "analysis": analysis,
+        "known_fake": {
+            "result_id": match.result_id,
+            "distance": match.distance,
+            "flagged_at": flagged_at.isoformat(),
+            "model": prior_model,
+        },
+    }
+
+def index_verdict(result_id, original, suspected, results):
+    """Record a model verdict on the pair in the known-fake index, replacing an earlier one"""
+    if (known_fakes is None or results.get("is_deepfake") is None or results.get("error")
+            or "prescreen" in results or "known_fake" in results):
+        return
+    try:
+        reference = as_normalized_image(original)
+        image = as_normalized_image(suspected)
+        suspected_print = prescreen.fingerprint(image)
+        known_fakes.add(result_id, reference.digest, image.digest, suspected_print.phash, suspected_print.dhash,
+                        results["is_deepfake"], results.get("confidence"))
+    except Exception as e:
+        logger.error("Could not index verdict %s: %s", result_id, e)
+
+def run_analysis(result_id, original, suspected, stream=False):
+    """
+    Analyze a normalized image pair and record the verdict in the result store.
+    
+    With stream=True the partial analysis text is written to the result store
+    (at most every STREAM_FLUSH_INTERVAL seconds) while the model is replying,
+    so /stream/<id> can relay it from any worker.
+    """
+    with app.app_context():
+        result_store.mark_running(result_id)
+    
+    last_flush = [0.0]
+    
+    def publish_partial(text):
+        if not text:
+            # Another model starts the reply over: always recorded, so readers drop the old text
+            last_flush[0] = 0.0
+            with app.app_context():
+                result_store.reset_partial(result_id)
+            return
+        now = time.monotonic()
+        if now - last_flush[0] >= STREAM_FLUSH_INTERVAL:
+            last_flush[0] = now
+            with app.app_context():
+                result_store.update_partial(result_id, text)
+    
+    on_partial = publish_partial if stream else None
+    
+    try:
+        # Analyze images using Gemini API
+        results = analyze_images_with_gemini(original, suspected, on_partial=on_partial)
+    except Exception as e:
+        with app.app_context():
+            result_store.fail_result(result_id, str(e))
+        raise
+    
+    with app.app_context():
+        result_store.complete_result(result_id, results)
+    index_verdict(result_id, original, suspected, results)
+    return results
+
+def load_reference_image(reference_id):
+    """
+    The NormalizedImage of a registered reference, or None if the id is unknown.
+    
+    Its display rendition is restored to the thumbnail folder if the janitor
+    has removed it, so results pages keep showing the reference.
+    """
+    reference = references.load_reference(reference_id, reference_store)
+    if reference is not None:
+        save_display_image(reference, app.config['THUMBNAIL_FOLDER'])
+    return reference
+
+def wants_json():
+    """True when the client asked for a JSON response (job mode)"""
+    accept = request.accept_mimetypes
+    return accept['application/json'] > accept['text/html']
+
+def upload_error(message, status=400):
+    """Report an upload problem as JSON for job-mode clients, or as a flash message"""
+    if wants_json():
+        return jsonify({"error": message}), status
+    flash(message, 'danger')
+    return redirect(request.url)
+
+def busy_response(message, retry_after):
+    """Tell the client the server is overloaded and when to come back"""
+    if wants_json():
+        response = jsonify({"error": message})
+        response.headers['Retry-After'] = str(retry_after)
+        return response, 503
+    flash(message, 'warning')
+    response = redirect(url_for('index'))
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+def render_results(record, stream_url=None):
+    """
+    Render the results page for a stored analysis result.
+    
+    With a stream_url the page is rendered in its pending state and follows
+    the analysis over server-sent events.
+    """
+    # Images are referenced by content digest and served (and cached) by serve_image
+    original_digest = record.original_digest
+    suspected_digest = record.suspected_digest
+    
+    with metrics.span("render"):
+        return render_template('results.html', 
+                               results=record.analysis_results(),
+                               original_image_url=url_for('serve_image', digest=original_digest) if original_digest else None,
+                               suspected_image_url=url_for('serve_image', digest=suspected_digest) if suspected_digest else None,
+                               stream_url=stream_url)
+
+def parse_stream_position(event_id):
+    """(generation, offset) from a stream event id; (0, 0) when missing or malformed"""
+    generation, _, offset = event_id.rpartition(':')
+    try:
+        return int(generation or 0), int(offset or 0)
+    except ValueError:
+        return 0, 0
+
+def sse_event(event, data, event_id=None):
+    """Format one server-sent event with a JSON payload"""
+    message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    if event_id is not None:
+        message = f"id: {event_id}\n" + message
+    return message
+
+@app.before_request
+def start_request_timing():
+    """Start collecting Server-Timing spans for this request"""
+    g.request_started = time.perf_counter()
+    g.request_timings = metrics.start_request()
+    log_config.start_request()
+    if request.content_length:
+        metrics.inc("http_request_bytes_total", request.content_length)
+
+@app.after_request
+def record_request_timing(response):
+    """Record request metrics and report the stage timings in a Server-Timing header"""
+    started = g.get('request_started')
+    if started is None:
+        return response
+    
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or "unknown"
+    metrics.observe("http_request_duration_seconds", elapsed, endpoint=endpoint, method=request.method)
+    metrics.inc("http_requests_total", endpoint=endpoint, method=request.method, status=response.status_code)
+    if response.content_length:
+        metrics.inc("http_response_bytes_total", response.content_length)
+    
+    budget = log_config.end_request()
+    if budget is not None:
+        metrics.observe("request_log_seconds", budget.seconds)
+        metrics.inc("log_records_total", budget.records)
+        if budget.dropped:
+            metrics.inc("log_records_dropped_total", budget.dropped)
+    
+    response.headers['Server-Timing'] = metrics.server_timing(g.request_timings, total=elapsed)
+    metrics.flush()
+    return response
+
+@app.route('/healthz')
+def liveness():
+    """Liveness probe: the worker is up and answering requests"""
+    return jsonify({"status": "ok"})
+
+@app.route('/readyz')
+def readiness():
+    """Readiness probe: 503 while the database, storage or model backend is unavailable, or the job queue is full"""
+    checks = readiness_checks()
+    ready = not any(checks.values())
+    payload = {
+        "status": "ok" if ready else "unavailable",
+        "checks": {name: problem or "ok" for name, problem in checks.items()},
+    }
+    return jsonify(payload), 200 if ready else 503
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose request metrics in the Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     """Render the main page with upload form"""
@@ -182,213 +883,525 @@ def index():
 
 @app.route('/upload', methods=['POST'])
 def upload_files():
-    """Handle file uploads and process images"""
+    """
+    Handle file uploads and process images.
+    
+    Clients that ask for JSON get a job id back immediately (HTTP 202) and
+    poll /jobs/<id> (or, in streaming mode, follow /stream/<id>); plain form
+    posts are analyzed before redirecting.
+    """
+    # Parsing the multipart body reads the whole upload
+    with metrics.span("receive"):
+        files = request.files
+    
+    # A registered reference (reference_id) can stand in for the original image
+    reference_id = request.form.get('reference_id')
+    
     # Check if both files were submitted
-    if 'original_image' not in request.files or 'suspected_image' not in request.files:
-        flash('Both images are required', 'danger')
-        return redirect(request.url)
+    if (not reference_id and 'original_image' not in files) or 'suspected_image' not in files:
+        return upload_error('Both images are required')
     
-    original_file = request.files['original_image']
-    suspected_file = request.files['suspected_image']
+    original_file = files.get('original_image') if not reference_id else None
+    suspected_file = files['suspected_image']
     
     # Check if filenames are empty
-    if original_file.filename == '' or suspected_file.filename == '':
-        flash('No selected files', 'danger')
-        return redirect(request.url)
+    if (original_file is not None and original_file.filename == '') or suspected_file.filename == '':
+        return upload_error('No selected files')
     
     # Check if files are valid
-    if not (original_file and allowed_file(original_file.filename) and
-            suspected_file and allowed_file(suspected_file.filename)):
-        flash('Invalid file types. Please use jpg, jpeg, png, or gif.', 'danger')
-        return redirect(request.url)
+    if not (suspected_file and allowed_file(suspected_file.filename) and
+            (original_file is None or allowed_file(original_file.filename))):
+        return upload_error('Invalid file types. Please use jpg, jpeg, png, or gif.')
     
     try:
-        # Save files with secure filenames
-        original_filename = secure_filename(original_file.filename)
-        suspected_filename = secure_filename(suspected_file.filename)
-        
-        # Check if we're running on Windows or Linux/Mac
-        is_windows = os.name == 'nt'
-        path_separator = '\\' if is_windows else '/'
-        
-        # Create folder path with correct separators
-        upload_folder = app.config['UPLOAD_FOLDER']
-        
-        # Print debug info about the paths
-        logger.info(f"Current platform: {os.name}, using separator: {path_separator}")
-        logger.info(f"Upload folder: {upload_folder}")
+        # Decode and normalize each upload once, in memory, along with a
+        # display rendition for the results page
+        try:
+            with metrics.span("normalize"):
+                original = normalize_upload(original_file, max_pixels=UPLOAD_MAX_PIXELS) if original_file is not None else None
+                suspected = normalize_upload(suspected_file, max_pixels=UPLOAD_MAX_PIXELS)
+        except ImageNormalizationError as e:
+            logger.warning("Rejecting upload: %s", e)
+            return upload_error('Invalid image file. Please upload a valid jpg, jpeg, png, or gif.')
         
-        # Ensure the upload directory exists (using raw strings to avoid escape issues)
-        os.makedirs(upload_folder, exist_ok=True)
+        if original is None:
+            with metrics.span("reference"):
+                original = load_reference_image(reference_id)
+            if original is None:
+                return upload_error('Unknown reference image', 404)
         
-        # Create file paths with explicit separators
-        original_path = os.path.join(upload_folder, f"original_{original_filename}")
-        suspected_path = os.path.join(upload_folder, f"suspected_{suspected_filename}")
+        # Store the normalized images under their content digest, so concurrent
+        # uploads with the same filename never collide and duplicates are kept once.
+        # Registered references are already stored.
+        with metrics.span("store"):
+            if original_file is not None:
+                original_path = image_store.put(original)
+                save_display_image(original, app.config['THUMBNAIL_FOLDER'])
+                logger.debug("Stored original %s at: %s", original_file.filename, original_path)
+            suspected_path = image_store.put(suspected)
+            save_display_image(suspected, app.config['THUMBNAIL_FOLDER'])
         
-        # Final normalization to ensure consistency
-        original_path = os.path.normpath(original_path)
-        suspected_path = os.path.normpath(suspected_path)
+        logger.debug("Stored suspected %s at: %s", suspected_file.filename, suspected_path)
         
-        logger.info(f"Saving original file to: {original_path}")
-        logger.info(f"Saving suspected file to: {suspected_path}")
+        # Record the analysis in the result store; the session only keeps its id
+        result_id = result_store.new_result_id()
+        with metrics.span("record"):
+            result_store.create_result(result_id, original.digest, suspected.digest, MODEL_NAME)
         
-        # Save files
-        original_file.save(original_path)
-        suspected_file.save(suspected_path)
-        
-        # Resize images if needed
-        resize_image_if_needed(original_path)
-        resize_image_if_needed(suspected_path)
-        
-        # Analyze images using Gemini API
-        results = analyze_images_with_gemini(original_path, suspected_path)
-        
-        # Get base filenames for more reliable storage in session
-        original_basename = os.path.basename(original_path)
-        suspected_basename = os.path.basename(suspected_path)
-        
-        # Save results to session
-        session['analysis_results'] = results
+        # Job mode: hand the analysis to the worker pool and return at once
+        if wants_json():
+            try:
+                job_queue.submit(run_analysis, result_id, original, suspected,
+                                 stream=STREAMING_ENABLED, job_id=result_id)
+            except QueueFullError as e:
+                logger.warning("Rejecting upload: %s", e)
+                result_store.fail_result(result_id, str(e))
+                return busy_response("Server is busy, please retry shortly", JOB_RETRY_AFTER)
+            
+            payload = {
+                "job_id": result_id,
+                "status": result_store.STATUS_QUEUED,
+                "status_url": url_for('job_status', job_id=result_id),
+                "results_url": url_for('job_results', job_id=result_id),
+            }
+            if STREAMING_ENABLED:
+                payload["stream_url"] = url_for('stream_results', job_id=result_id)
+            return jsonify(payload), 202
         
-        # Store both full path and basename to provide fallback options
-        session['original_path'] = original_path
-        session['suspected_path'] = suspected_path
-        session['original_basename'] = original_basename
-        session['suspected_basename'] = suspected_basename
+        try:
+            run_analysis(result_id, original, suspected)
+        except OverloadedError as e:
+            logger.warning("Rejecting upload: %s", e)
+            return busy_response("Server is busy, please retry shortly", e.retry_after)
+        session['result_id'] = result_id
         
-        logger.info(f"Stored in session - original: {original_path}, basename: {original_basename}")
-        logger.info(f"Stored in session - suspected: {suspected_path}, basename: {suspected_basename}")
+        logger.debug("Stored result %s in session", result_id)
         
         return redirect(url_for('results'))
     
     except Exception as e:
-        logger.error(f"Error processing upload: {e}")
+        logger.error("Error processing upload: %s", e)
+        if wants_json():
+            return jsonify({"error": f"Error processing upload: {str(e)}"}), 500
         flash(f'Error processing upload: {str(e)}', 'danger')
         return redirect(url_for('index'))
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Report the state of an analysis job as JSON"""
+    record = result_store.get_result(job_id)
+    if record is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    
+    payload = record.to_dict()
+    payload['job_id'] = job_id
+    if record.status == result_store.STATUS_DONE:
+        payload['results_url'] = url_for('job_results', job_id=job_id)
+    elif record.status == result_store.STATUS_FAILED:
+        payload['error'] = record.error
+    return jsonify(payload)
+
 @app.route('/results')
 def results():
     """Display analysis results"""
-    if 'analysis_results' not in session:
+    record = result_store.get_result(session.get('result_id'))
+    if record is None or record.status != result_store.STATUS_DONE:
         flash('No analysis results available', 'warning')
         return redirect(url_for('index'))
     
-    # Get results from session
-    results = session['analysis_results']
-    original_path = session.get('original_path', '')
-    suspected_path = session.get('suspected_path', '')
+    return render_results(record)
+
+@app.route('/results/<job_id>')
+def job_results(job_id):
+    """Display the results of an analysis job"""
+    record = result_store.get_result(job_id)
+    if record is None:
+        flash('No analysis results available', 'warning')
+        return redirect(url_for('index'))
     
-    # Get basenames for fallback
-    original_basename = session.get('original_basename', '')
-    suspected_basename = session.get('suspected_basename', '')
+    if record.status == result_store.STATUS_FAILED:
+        flash(f"Error processing upload: {record.error}", 'danger')
+        return redirect(url_for('index'))
     
-    logger.info(f"Retrieved from session - original path: {original_path}")
-    logger.info(f"Retrieved from session - suspected path: {suspected_path}")
-    logger.info(f"Retrieved from session - original basename: {original_basename}")
-    logger.info(f"Retrieved from session - suspected basename: {suspected_basename}")
+    # Still queued or running: show the pending page, which follows the job over SSE
+    if record.status != result_store.STATUS_DONE:
+        return render_results(record, stream_url=url_for('stream_results', job_id=job_id))
     
-    # Read image files for display
-    original_image = None
-    suspected_image = None
+    return render_results(record)
+
+@app.route('/stream/<job_id>')
+def stream_results(job_id):
+    """
+    Follow an analysis job as server-sent events.
     
-    try:
-        # Check platform and normalize paths
-        is_windows = os.name == 'nt'
-        logger.info(f"Reading images on platform: {os.name}")
-        
-        # Normalize paths again to ensure consistency
-        original_path = os.path.normpath(original_path)
-        suspected_path = os.path.normpath(suspected_path)
-        
-        logger.info(f"Attempting to read original image from: {original_path}")
-        logger.info(f"Attempting to read suspected image from: {suspected_path}")
-        
-        # Check if the paths exist
-        # Try multiple approaches to find the original image
-        image_found = False
-        
-        # Try 1: Direct path from session
-        if os.path.exists(original_path):
-            logger.info(f"Original image found at {original_path}")
-            with open(original_path, 'rb') as f:
-                original_image = base64.b64encode(f.read()).decode('utf-8')
-            image_found = True
-        
-        # Try 2: Using basename in uploads folder
-        if not image_found:
-            fallback_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(original_path))
-            logger.info(f"Trying fallback path: {fallback_path}")
-            if os.path.exists(fallback_path):
-                with open(fallback_path, 'rb') as f:
-                    original_image = base64.b64encode(f.read()).decode('utf-8')
-                logger.info("Found original image using path basename fallback")
-                image_found = True
-        
-        # Try 3: Using stored basename
-        if not image_found and original_basename:
-            fallback_path = os.path.join(app.config['UPLOAD_FOLDER'], original_basename)
-            logger.info(f"Trying stored basename fallback: {fallback_path}")
-            if os.path.exists(fallback_path):
-                with open(fallback_path, 'rb') as f:
-                    original_image = base64.b64encode(f.read()).decode('utf-8')
-                logger.info("Found original image using stored basename fallback")
-                image_found = True
-        
-        if not image_found:
-            logger.error("Could not find original image using any available method")
-        
-        # Same approach for the suspected image
-        image_found = False
-        
-        # Try 1: Direct path from session
-        if os.path.exists(suspected_path):
-            logger.info(f"Suspected image found at {suspected_path}")
-            with open(suspected_path, 'rb') as f:
-                suspected_image = base64.b64encode(f.read()).decode('utf-8')
-            image_found = True
+    `chunk` events carry new analysis text as the model produces it; their id
+    is "<generation>:<length of the text sent so far>", so a reconnecting
+    EventSource resumes where it left off. When the reply starts over (another
+    model took over) a `reset` event tells the client to clear the text it has
+    shown before the new text is sent. A terminal `verdict` event carries the final
+    status and results. Progress is read from the result store, so any worker
+    can serve the stream. Each response ends after STREAM_MAX_DURATION seconds
+    and the browser reconnects, which bounds how long one client holds a worker.
+    """
+    if result_store.get_result(job_id) is None:
+        return jsonify({"error": "Unknown or expired job"}), 404
+    
+    generation, offset = parse_stream_position(request.headers.get('Last-Event-ID', ''))
+    
+    def generate():
+        shown_generation, sent = generation, offset
+        started = last_write = time.monotonic()
+        yield f"retry: {STREAM_RETRY_MS}\n\n"
         
-        # Try 2: Using basename in uploads folder
-        if not image_found:
-            fallback_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(suspected_path))
-            logger.info(f"Trying fallback path: {fallback_path}")
-            if os.path.exists(fallback_path):
-                with open(fallback_path, 'rb') as f:
-                    suspected_image = base64.b64encode(f.read()).decode('utf-8')
-                logger.info("Found suspected image using path basename fallback")
-                image_found = True
+        while True:
+            record = result_store.refresh_result(job_id)
+            if record is None or record.status in (result_store.STATUS_DONE, result_store.STATUS_FAILED):
+                yield sse_event('verdict', {
+                    "job_id": job_id,
+                    "status": record.status if record is not None else result_store.STATUS_FAILED,
+                    "results": record.analysis_results() if record is not None else None,
+                    "error": record.error if record is not None else "Unknown or expired job",
+                    "results_url": url_for('job_results', job_id=job_id),
+                })
+                return
+            
+            now = time.monotonic()
+            text = record.analysis or ""
+            if record.stream_generation != shown_generation:
+                shown_generation, sent = record.stream_generation, 0
+                yield sse_event('reset', {}, event_id=f"{shown_generation}:0")
+                last_write = now
+            if len(text) > sent:
+                yield sse_event('chunk', {"text": text[sent:]}, event_id=f"{shown_generation}:{len(text)}")
+                sent, last_write = len(text), now
+            elif now - last_write >= STREAM_KEEPALIVE:
+                yield ": keep-alive\n\n"
+                last_write = now
+            
+            if now - started >= STREAM_MAX_DURATION:
+                return
+            time.sleep(STREAM_POLL_INTERVAL)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # don't let a reverse proxy buffer the stream
+    return response
+
+@app.route('/api/references', methods=['POST'])
+def create_reference():
+    """
+    Register a known-authentic reference image.
+    
+    Expects a multipart field `image` and an optional `label`. The image is
+    normalized, stored and its comparison features precomputed once; the
+    returned `id` can then be passed as `reference_id` to /upload, /api/batch
+    and /api/video instead of uploading the original again. Registering an
+    image that is already known returns the existing reference (HTTP 200).
+    """
+    image_file = request.files.get('image')
+    if not image_file or image_file.filename == '':
+        return jsonify({"error": "An image is required"}), 400
+    if not allowed_file(image_file.filename):
+        return jsonify({"error": "Invalid file types. Please use jpg, jpeg, png, or gif."}), 400
+    
+    try:
+        with metrics.span("normalize"):
+            image = normalize_upload(image_file, max_pixels=UPLOAD_MAX_PIXELS)
+    except ImageNormalizationError as e:
+        return jsonify({"error": f"Invalid image: {e}"}), 400
+    
+    with metrics.span("features"):
+        record, created = references.register(image, reference_store, label=request.form.get('label') or None)
+    save_display_image(image, app.config['THUMBNAIL_FOLDER'])
+    
+    payload = record.to_dict()
+    payload['image_url'] = url_for('serve_image', digest=record.digest)
+    return jsonify(payload), 201 if created else 200
+
+@app.route('/api/references')
+def list_reference_images():
+    """List registered references, most recently used first (`limit` max 200, `offset`)"""
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    records = references.list_references(limit=limit, offset=offset)
+    return jsonify({"references": [record.to_dict() for record in records], "limit": limit, "offset": offset})
+
+@app.route('/api/references/<reference_id>', methods=['GET', 'DELETE'])
+def reference_image(reference_id):
+    """Show or delete one registered reference"""
+    if request.method == 'DELETE':
+        if not references.delete_reference(reference_id, reference_store):
+            return jsonify({"error": "Unknown reference image"}), 404
+        return '', 204
+    
+    record = references.get_reference(reference_id)
+    if record is None:
+        return jsonify({"error": "Unknown reference image"}), 404
+    return jsonify(record.to_dict())
+
+@app.route('/api/models')
+def model_stats():
+    """Routing strategy and recent latency and error statistics of each configured model"""
+    return jsonify({
+        "strategy": model_router.strategy,
+        "models": [
+            {"name": route.name, "timeout": route.timeout, "cost": route.cost,
+             "hedge_after": model_router.hedge_delay(route), **model_router.stats[route.name].snapshot()}
+            for route in model_router.routes
+        ],
+    })
+
+@app.route('/api/results')
+def list_results():
+    """
+    Query stored analyses, newest first.
+    
+    Optional parameters: `limit` (max 200), `offset`, `deepfake` (true/false)
+    and `digest` (matches either image).
+    """
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    deepfake = request.args.get('deepfake')
+    is_deepfake = None if deepfake is None else deepfake.lower() in ('1', 'true', 'yes')
+    
+    records = result_store.recent_results(limit=limit, offset=offset, is_deepfake=is_deepfake,
+                                          digest=request.args.get('digest'))
+    return jsonify({"results": [record.to_dict() for record in records], "limit": limit, "offset": offset})
+
+def analyze_batch_item(data, reference):
+    """Normalize one suspected image, compare it against the pre-loaded reference and store the result"""
+    suspected = normalize_image(data, max_pixels=UPLOAD_MAX_PIXELS)
+    image_store.put(suspected)
+    save_display_image(suspected, app.config['THUMBNAIL_FOLDER'])
+    
+    result_id = result_store.new_result_id()
+    with app.app_context():
+        result_store.create_result(result_id, reference.digest, suspected.digest, MODEL_NAME, source="batch")
+    return {"result_id": result_id, **run_analysis(result_id, reference, suspected)}
+
+@app.route('/api/batch', methods=['POST'])
+def batch_analyze():
+    """
+    Compare one original image against many suspected images.
+    
+    Expects multipart fields `original_image` (or the `reference_id` of a
+    registered reference) and one or more `suspected_images`. The reference is
+    decoded and normalized once; comparisons run concurrently (at most
+    BATCH_PARALLELISM at a time) and each result is streamed back as a line of
+    NDJSON as soon as it finishes.
+    """
+    reference_id = request.form.get('reference_id')
+    original_file = request.files.get('original_image')
+    suspected_files = [f for f in request.files.getlist('suspected_images') if f and f.filename]
+    
+    if not reference_id and (not original_file or original_file.filename == ''):
+        return jsonify({"error": "An original image or reference_id is required"}), 400
+    if not suspected_files:
+        return jsonify({"error": "At least one suspected image is required"}), 400
+    if len(suspected_files) > BATCH_MAX_ITEMS:
+        return jsonify({"error": f"At most {BATCH_MAX_ITEMS} suspected images are allowed per batch"}), 400
+    if not all(allowed_file(f.filename) for f in ([] if reference_id else [original_file]) + suspected_files):
+        return jsonify({"error": "Invalid file types. Please use jpg, jpeg, png, or gif."}), 400
+    
+    try:
+        batch_id = uuid.uuid4().hex[:12]
         
-        # Try 3: Using stored basename
-        if not image_found and suspected_basename:
-            fallback_path = os.path.join(app.config['UPLOAD_FOLDER'], suspected_basename)
-            logger.info(f"Trying stored basename fallback: {fallback_path}")
-            if os.path.exists(fallback_path):
-                with open(fallback_path, 'rb') as f:
-                    suspected_image = base64.b64encode(f.read()).decode('utf-8')
-                logger.info("Found suspected image using stored basename fallback")
-                image_found = True
+        if reference_id:
+            reference = load_reference_image(reference_id)
+            if reference is None:
+                return jsonify({"error": "Unknown reference image"}), 404
+            original_path = f"reference {reference_id}"
+        else:
+            # Save and normalize the reference once for the whole batch
+            reference = normalize_upload(original_file, max_pixels=UPLOAD_MAX_PIXELS)
+            original_path = image_store.put(reference)
+            save_display_image(reference, app.config['THUMBNAIL_FOLDER'])
         
-        if not image_found:
-            logger.error("Could not find suspected image using any available method")
+        # Read every suspected upload before streaming starts; decoding happens in the pool
+        items = [
+            (index, suspected_file.filename, suspected_file.stream.read())
+            for index, suspected_file in enumerate(suspected_files)
+        ]
+    except ImageNormalizationError as e:
+        return jsonify({"error": f"Invalid original image: {e}"}), 400
     except Exception as e:
-        logger.error(f"Error reading image files: {e}")
+        logger.error("Error preparing batch: %s", e)
+        return jsonify({"error": f"Error processing upload: {str(e)}"}), 500
+    
+    logger.info("Batch %s: comparing %s images against %s", batch_id, len(items), original_path)
+    
+    def generate():
+        pool = ThreadPoolExecutor(max_workers=min(BATCH_PARALLELISM, len(items)))
+        try:
+            futures = {
+                pool.submit(analyze_batch_item, data, reference): (index, filename)
+                for index, filename, data in items
+            }
+            for future in as_completed(futures):
+                index, filename = futures[future]
+                try:
+                    item = future.result()
+                except Exception as e:
+                    logger.error("Batch %s item %s failed: %s", batch_id, index, e)
+                    item = {
+                        "error": str(e),
+                        "is_deepfake": None,
+                        "confidence": "Medium",
+                        "analysis": f"Error during analysis: {str(e)}"
+                    }
+                    if isinstance(e, OverloadedError):
+                        item["retry_after"] = e.retry_after
+                yield json.dumps({"batch_id": batch_id, "index": index, "filename": filename, **item}) + "\n"
+        finally:
+            # Stop queued comparisons if the client goes away mid-stream
+            pool.shutdown(wait=False, cancel_futures=True)
+    
+    return Response(generate(), mimetype='application/x-ndjson')
+
+def score_keyframe(keyframe, reference):
+    """Normalize one keyframe through the upload path and compare it against the reference"""
+    frame = normalize_image(keyframe.data, display_size=None)
+    result = analyze_images_with_gemini(reference, frame)
+    return {"timestamp": keyframe.timestamp, "frame": keyframe.index, "reason": keyframe.reason, **result}
+
+@app.route('/api/video', methods=['POST'])
+def analyze_video():
+    """
+    Compare the keyframes of a video clip against a reference image.
+    
+    Expects multipart fields `original_image` (or the `reference_id` of a
+    registered reference) and `suspected_video`. The clip
+    is decoded frame by frame; keyframes are picked by scene change and
+    face-region difference (at most `max_frames`, capped by VIDEO_MAX_FRAMES)
+    and scored concurrently, at most VIDEO_PARALLELISM at a time, while
+    decoding continues. Returns the clip verdict with a per-timestamp breakdown.
+    """
+    video = load_video_support()
+    if video is None:
+        return jsonify({"error": "Video analysis is not available (OpenCV is not installed)"}), 501
+    
+    reference_id = request.form.get('reference_id')
+    original_file = request.files.get('original_image')
+    video_file = request.files.get('suspected_video')
+    if not reference_id and (not original_file or original_file.filename == ''):
+        return jsonify({"error": "An original image or reference_id is required"}), 400
+    if not video_file or video_file.filename == '':
+        return jsonify({"error": "A suspected video is required"}), 400
+    if not reference_id and not allowed_file(original_file.filename):
+        return jsonify({"error": "Invalid file types. Please use jpg, jpeg, png, or gif."}), 400
+    if not allowed_video(video_file.filename) or video.sniff_video_format(video_file.stream.read(12)) is None:
+        return jsonify({"error": f"Invalid video file. Please use {', '.join(sorted(VIDEO_EXTENSIONS))}."}), 400
     
-    return render_template('results.html', 
-                           results=results,
-                           original_image=original_image,
-                           suspected_image=suspected_image)
+    max_frames = min(request.form.get('max_frames', VIDEO_MAX_FRAMES, type=int), VIDEO_MAX_FRAMES)
+    
+    if reference_id:
+        reference = load_reference_image(reference_id)
+        if reference is None:
+            return jsonify({"error": "Unknown reference image"}), 404
+    else:
+        try:
+            reference = normalize_upload(original_file, max_pixels=UPLOAD_MAX_PIXELS)
+            image_store.put(reference)
+            save_display_image(reference, app.config['THUMBNAIL_FOLDER'])
+        except ImageNormalizationError as e:
+            return jsonify({"error": f"Invalid original image: {e}"}), 400
+    
+    video_file.stream.flush()
+    video_digest = file_digest(video_file.stream.name)
+    
+    frames = []
+    pool = ThreadPoolExecutor(max_workers=max(1, VIDEO_PARALLELISM))
+    try:
+        futures = {}
+        with metrics.span("video_decode"):
+            keyframes = video.iter_keyframes(
+                video_file.stream.name,
+                sample_every=max(1, VIDEO_SAMPLE_EVERY),
+                scene_threshold=VIDEO_SCENE_THRESHOLD,
+                face_threshold=VIDEO_FACE_THRESHOLD,
+                min_gap=VIDEO_MIN_GAP,
+                max_frames=max(1, max_frames),
+                max_duration=VIDEO_MAX_DURATION,
+            )
+            for keyframe in keyframes:
+                futures[pool.submit(score_keyframe, keyframe, reference)] = keyframe
+        
+        for future in as_completed(futures):
+            keyframe = futures[future]
+            try:
+                frames.append(future.result())
+            except Exception as e:
+                logger.error("Scoring frame %s failed: %s", keyframe.index, e)
+                item = {"timestamp": keyframe.timestamp, "frame": keyframe.index, "reason": keyframe.reason,
+                        "error": str(e), "is_deepfake": None, "confidence": "Medium"}
+                if isinstance(e, OverloadedError):
+                    item["retry_after"] = e.retry_after
+                frames.append(item)
+    except video.VideoDecodeError as e:
+        return jsonify({"error": f"Invalid video file: {e}"}), 400
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    
+    frames.sort(key=lambda frame: frame["timestamp"])
+    verdict = video.aggregate_verdicts(frames, deepfake_ratio=VIDEO_DEEPFAKE_RATIO)
+    
+    result_id = result_store.new_result_id()
+    result_store.create_result(result_id, reference.digest, video_digest, MODEL_NAME, source="video")
+    result_store.complete_result(result_id, verdict)
+    logger.info("Video %s: %s keyframes scored, deepfake=%s", video_digest[:12], len(frames), verdict['is_deepfake'])
+    
+    return jsonify({"result_id": result_id, **verdict, "frames_scored": len(frames), "frames": frames})
+
+@app.route('/images/<digest>')
+def serve_image(digest):
+    """
+    Serve a display thumbnail by content digest.
+    
+    `size` selects the variant (sm or md). WebP is returned to clients that
+    accept it. Content is immutable per URL, so responses carry a strong ETag,
+    a long-lived Cache-Control header and answer conditional GETs with 304.
+    """
+    size = request.args.get('size', 'md')
+    fmt = 'webp' if any(value == 'image/webp' for value, _ in request.accept_mimetypes) else 'jpeg'
+    
+    try:
+        path = get_thumbnail(app.config['THUMBNAIL_FOLDER'], digest, size, fmt)
+    except FileNotFoundError:
+        abort(404)
+    
+    response = send_file(path, mimetype=f'image/{fmt}', etag=f"{digest}-{size}-{fmt}",
+                         conditional=True, max_age=THUMBNAIL_MAX_AGE)
+    response.headers['Cache-Control'] = f'public, max-age={THUMBNAIL_MAX_AGE}, immutable'
+    response.vary.add('Accept')
+    return response
+
+@app.errorhandler(UploadRejected)
+def upload_rejected(error):
+    """Handle an upload that failed validation while the request body was being received"""
+    metrics.inc("upload_rejections_total")
+    logger.warning("Rejecting upload %r: %s", error.filename, error)
+    message = f"Invalid image file {error.filename}: {error}" if error.filename else f"Invalid image file: {error}"
+    if request.path.startswith('/api/'):
+        return jsonify({"error": message}), 400
+    return upload_error(message)
 
 @app.errorhandler(413)
 def request_entity_too_large(error):
-    """Handle file size too large error"""
-    flash('File too large. Maximum size is 10MB.', 'danger')
+    """Handle file size too large error, citing the limit of the endpoint that was called"""
+    limit = request.max_content_length or MAX_CONTENT_LENGTH  # VIDEO_MAX_BYTES for /api/video
+    message = f"File too large. Maximum size is {limit / (1024 * 1024):g}MB."
+    if wants_json():
+        return jsonify({"error": message}), 413
+    flash(message, 'danger')
     return redirect(url_for('index')), 413
 
 @app.errorhandler(500)
 def server_error(error):
     """Handle server errors"""
-    logger.error(f"Server error: {error}")
+    logger.error("Server error: %s", error)
     flash('Server error occurred. Please try again later.', 'danger')
     return redirect(url_for('index')), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server only; use `gunicorn -c gunicorn.conf.py main:app` in production
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get("FLASK_DEBUG", "").lower() in ("1", "true", "yes"))
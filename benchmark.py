@@ -0,0 +1,668 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark and load-test suite.
+
+Nothing here calls the Gemini API: the app runs with GEMINI_BACKEND=fake, a
+local model that answers after a configurable delay with configurable text.
+All state (uploads, result store, caches, metrics) goes to a temporary
+directory.
+
+Suites:
+    normalize  image normalization on a corpus of sizes and formats
+    app        /upload + /results round trips through the Flask test client
+    gunicorn   the same round trips over HTTP against a real gunicorn server
+    logging    time a request spends logging, synchronous vs the queued JSON setup
+    startup    `import app` time (-X importtime) and gunicorn time to first request
+    similarity known-fake index lookups at --entries entries (requires NumPy)
+    payload    compact model payload vs full images: bytes, encoding time, fidelity
+               (with --live, verdicts from the real model on --corpus pairs)
+
+Every scenario reports p50/p95/p99 latency and requests per second, and is
+compared with the stored baseline (benchmark_baseline.json by default).
+
+Examples:
+    python benchmark.py normalize
+    python benchmark.py app --concurrency 1,4,16 --requests 48 --latency 0.5
+    python benchmark.py gunicorn --workers 2 --threads 8
+    python benchmark.py logging
+    python benchmark.py startup --runs 5
+    python benchmark.py similarity --entries 1000000
+    python benchmark.py payload --corpus pairs/ --live
+    python benchmark.py all --save-baseline
+    python benchmark.py all --check        # exit status 1 on a regression
+
+Baselines are only comparable on the machine that recorded them.
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(ROOT, 'benchmark_baseline.json')
+
+CORPUS_SIZES = [(640, 480), (1920, 1080), (4032, 3024)]
+CORPUS_FORMATS = ['JPEG', 'PNG', 'WEBP', 'GIF']
+UPLOAD_SIZE = (1280, 960)
+
+LOG_RECORDS_PER_REQUEST = 20
+SIMILARITY_REFERENCES = 1000
+
+FAKE_TEXT = "The images show the same person. This is not a deepfake. High confidence."
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(latencies, elapsed):
+    """p50/p95/p99 in milliseconds and requests per second"""
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "rps": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+    }
+
+
+def make_image(size, fmt, seed):
+    """Encode a photo-like test image (gradient plus noise) that is unique for each seed"""
+    rng = random.Random(seed)
+    noise = [Image.effect_noise(size, rng.uniform(20, 60)) for _ in range(3)]
+    gradient = Image.linear_gradient('L').resize(size)
+    image = Image.merge('RGB', [Image.blend(channel, gradient, 0.5) for channel in noise])
+    buffer = io.BytesIO()
+    if fmt == 'GIF':
+        image = image.convert('P', palette=Image.ADAPTIVE)
+    image.save(buffer, format=fmt, **({'quality': 90} if fmt in ('JPEG', 'WEBP') else {}))
+    return buffer.getvalue()
+
+
+def prepare_environment(workdir, latency, text):
+    """Point the app at the fake backend and a scratch directory (must run before importing app)"""
+    os.environ.update({
+        "GEMINI_API_KEY": os.environ.get("GEMINI_API_KEY", "benchmark"),
+        "GEMINI_BACKEND": "fake",
+        "FAKE_MODEL_LATENCY": str(latency),
+        "FAKE_MODEL_TEXT": text,
+        "UPLOAD_FOLDER": os.path.join(workdir, 'uploads'),
+        "DATABASE_URL": "sqlite:///" + os.path.join(workdir, 'results.db'),
+        "METRICS_DIR": os.path.join(workdir, 'metrics'),
+        "GEMINI_LIMITER_PATH": os.path.join(workdir, 'limiter.db'),
+        "JANITOR_INTERVAL": "0",
+    })
+
+
+def bench_normalize(args):
+    """Time normalize_image on every size/format combination of the corpus"""
+    from imaging import normalize_image
+
+    results = {}
+    for size in CORPUS_SIZES:
+        for fmt in CORPUS_FORMATS:
+            data = make_image(size, fmt, seed=f"{fmt}-{size[0]}x{size[1]}")
+            latencies = []
+            started = time.perf_counter()
+            for _ in range(args.iterations):
+                call_started = time.perf_counter()
+                normalize_image(data, allowed_formats=CORPUS_FORMATS)
+                latencies.append(time.perf_counter() - call_started)
+            name = f"normalize/{fmt.lower()}/{size[0]}x{size[1]}"
+            results[name] = summarize(latencies, time.perf_counter() - started)
+            report(name, results[name], args.baseline_data)
+    return results
+
+
+def bench_logging(args):
+    """
+    Time the logging a request does in the request thread.
+
+    Each simulated request emits LOG_RECORDS_PER_REQUEST INFO records and as
+    many DEBUG records, as the app did before its logging overhaul, then
+    idles for a millisecond (its other work). Records go to a pipe drained by
+    a child process, like stderr under a process manager. The `sync`
+    scenario formats and writes every record in the calling thread
+    (logging.basicConfig at DEBUG); `async` uses log_config as the app
+    configures it, writing JSON from the listener thread.
+    """
+    import log_config
+
+    logger = logging.getLogger("benchmark.request")
+    reader = subprocess.Popen([sys.executable, '-c', 'import sys\nfor line in sys.stdin: pass'],
+                              stdin=subprocess.PIPE, text=True)
+    results = {}
+    try:
+        for scenario in ('sync', 'async'):
+            if scenario == 'sync':
+                log_config.shutdown()
+                logging.basicConfig(level=logging.DEBUG, stream=reader.stdin, force=True)
+            else:
+                log_config.configure(level="INFO", levels="benchmark=DEBUG", debug_sample=10,
+                                     request_budget=50, stream=reader.stdin)
+
+            latencies = []
+            started = time.perf_counter()
+            for index in range(args.requests * args.iterations):
+                call_started = time.perf_counter()
+                log_config.start_request()
+                for step in range(LOG_RECORDS_PER_REQUEST):
+                    logger.info("Stored original %s at: %s", f"{index:032x}", f"/uploads/store/{step:02x}/{index}.jpg")
+                    logger.debug("Checking %s: %s", step, {"size": (1024, 768), "digest": f"{index:064x}"})
+                log_config.end_request()
+                latencies.append(time.perf_counter() - call_started)
+                time.sleep(0.001)
+            name = f"logging/{scenario}"
+            results[name] = summarize(latencies, time.perf_counter() - started)
+            report(name, results[name], args.baseline_data)
+        log_config.shutdown()
+    finally:
+        reader.stdin.close()
+        reader.wait()
+    log_config.configure(level="WARNING")
+    return results
+
+
+def bench_similarity(args):
+    """
+    Time known-fake index lookups with --entries random entries (half of them fakes, spread over
+    SIMILARITY_REFERENCES references), after compaction into a memory-mapped base and with the
+    same entries still in memory. Queries are fakes with a few bits flipped against their own
+    reference (hits) and fresh random hashes (misses).
+    """
+    from similarity_index import SimilarityIndex
+
+    rng = random.Random(0)
+    hashes = [(rng.getrandbits(64), rng.getrandbits(64)) for _ in range(args.entries)]
+    directory = os.path.join(args.workdir, 'similarity_index')
+    index = SimilarityIndex(directory, max_distance=6, compact_after=args.entries + 1)
+    started = time.perf_counter()
+    def reference(row):
+        return f"{row % SIMILARITY_REFERENCES:064x}"
+
+    index.add_many((f"{row:032x}", reference(row), f"{row:064x}", phash, dhash, row % 2 == 0, "High")
+                   for row, (phash, dhash) in enumerate(hashes))
+    index.refresh(force=True)
+    print(f"  indexed {args.entries} entries in {time.perf_counter() - started:.1f}s")
+
+    def flip(value, bits):
+        for bit in rng.sample(range(64), bits):
+            value ^= 1 << bit
+        return value
+
+    queries = {
+        "hit": [(reference(row), flip(hashes[row][0], 4), flip(hashes[row][1], 2))
+                for row in rng.sample(range(0, args.entries, 2), min(args.requests * 20, args.entries // 2))],
+        "miss": [(reference(rng.randrange(args.entries)), rng.getrandbits(64), rng.getrandbits(64))
+                 for _ in range(args.requests * 20)],
+    }
+
+    results = {}
+    for layout in ('memory', 'mmap'):
+        if layout == 'mmap':
+            started = time.perf_counter()
+            index.compact()
+            print(f"  compacted in {time.perf_counter() - started:.1f}s")
+        for kind, pairs in queries.items():
+            latencies, found = [], 0
+            started = time.perf_counter()
+            for digest, phash, dhash in pairs:
+                call_started = time.perf_counter()
+                found += index.lookup(digest, phash, dhash) is not None
+                latencies.append(time.perf_counter() - call_started)
+            name = f"similarity/{layout}/{kind}"
+            results[name] = summarize(latencies, time.perf_counter() - started)
+            results[name]["found"] = found
+            report(name, results[name], args.baseline_data)
+    return results
+
+
+def make_screenshot(size, seed):
+    """Encode a graphic-like test image (flat panels and text on white) as PNG"""
+    from PIL import ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    colors = [(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(6)]
+    for _ in range(12):
+        x, y = rng.randrange(size[0] - 40), rng.randrange(size[1] - 20)
+        draw.rectangle([x, y, x + rng.randrange(40, size[0] // 2), y + rng.randrange(20, size[1] // 4)],
+                       fill=rng.choice(colors))
+    for line in range(0, size[1], 24):
+        draw.text((16, line), f"Line {line // 24}: " + "lorem ipsum " * (size[0] // 80), fill=(20, 20, 20))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def payload_corpus(args):
+    """(name, encoded image) pairs: the images under --corpus, or synthetic photos and screenshots"""
+    if args.corpus:
+        for directory, _, filenames in sorted(os.walk(args.corpus)):
+            for filename in sorted(filenames):
+                path = os.path.join(directory, filename)
+                with open(path, 'rb') as f:
+                    yield os.path.relpath(path, args.corpus), f.read()
+        return
+    for size in CORPUS_SIZES:
+        for fmt in ('JPEG', 'PNG'):
+            yield f"photo/{fmt.lower()}/{size[0]}x{size[1]}", make_image(size, fmt, seed=f"payload-{fmt}-{size}")
+        yield f"screenshot/png/{size[0]}x{size[1]}", make_screenshot(size, seed=f"payload-{size}")
+
+
+def bench_payload(args):
+    """
+    Compare the compact model payload with the full normalized images: bytes, encoding time
+    and, with NumPy, pHash distance and SSIM between the two. With --live (and a real API key)
+    every original_/suspected_ pair under --corpus is also sent to Gemini both ways, and pairs
+    whose verdict changes are reported as regressions.
+    """
+    import app as deepfake_app
+    from imaging import ImageNormalizationError, normalize_image
+    from payload_policy import PayloadPolicy
+
+    policy = deepfake_app.payload_policy or PayloadPolicy()
+    print(f"  policy {policy.key}")
+
+    results = {}
+    for name, data in payload_corpus(args):
+        try:
+            full = normalize_image(data, allowed_formats=CORPUS_FORMATS)
+        except ImageNormalizationError as e:
+            print(f"  skipped {name}: {e}")
+            continue
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            call_started = time.perf_counter()
+            compact = policy.reencode(full)
+            latencies.append(time.perf_counter() - call_started)
+        name = f"payload/{name}"
+        results[name] = summarize(latencies, time.perf_counter() - started)
+        results[name].update(full_bytes=len(full.data), compact_bytes=len(compact.data))
+        report(name, results[name], args.baseline_data)
+
+        line = (f"  {len(full.data):>9} -> {len(compact.data):>8} bytes "
+                f"({len(compact.data) / len(full.data):.0%}), {compact.mime_type} {compact.size[0]}x{compact.size[1]}")
+        if deepfake_app.prescreen is not None:
+            similarity = deepfake_app.prescreen.compare(full, compact)
+            line += f", pHash distance {similarity['phash_distance']}, SSIM {similarity['ssim']:.3f}"
+        print(line)
+
+    full_total = sum(stats["full_bytes"] for stats in results.values())
+    compact_total = sum(stats["compact_bytes"] for stats in results.values())
+    if full_total:
+        print(f"  total {full_total} -> {compact_total} bytes ({compact_total / full_total:.0%})")
+
+    if args.live:
+        compare_live_verdicts(args, deepfake_app, policy)
+    return results
+
+
+def compare_live_verdicts(args, deepfake_app, policy):
+    """Send each --corpus pair to Gemini as full and as compact payload and count verdict changes"""
+    import bulk_scan
+    from imaging import normalize_image
+
+    pairs, _ = bulk_scan.pairs_from_directory(args.corpus)
+    if not pairs:
+        print("  --live needs original_<name>/suspected_<name> pairs under --corpus")
+        return
+    agree = escalated = 0
+    for pair in pairs:
+        images = []
+        for path in (pair.original, pair.suspected):
+            with open(path, 'rb') as f:
+                images.append(normalize_image(f.read()))
+        full = deepfake_app.call_model(deepfake_app.ACTIVE_PROMPT, images)
+        verdict = deepfake_app.call_model(deepfake_app.ACTIVE_PROMPT, [policy.encode(image) for image in images],
+                                          tier="compact")
+        if policy.should_escalate(verdict):
+            escalated += 1
+            verdict = full
+        if verdict.get("is_deepfake") == full.get("is_deepfake"):
+            agree += 1
+        else:
+            args.failures.append(f"payload/verdict {pair.pair_id}: {full.get('is_deepfake')} with the full "
+                                 f"images, {verdict.get('is_deepfake')} with the compact payload")
+    print(f"  verdicts: {agree} of {len(pairs)} pairs unchanged ({escalated} escalated to the full images)")
+
+
+def run_load(client_factory, round_trip, concurrency, total, seed_base):
+    """Run total round trips with concurrency clients; return per-step latencies and wall time"""
+    lock = threading.Lock()
+    latencies = {"upload": [], "results": [], "round_trip": []}
+    errors = []
+    local = threading.local()
+
+    def one(index):
+        if not hasattr(local, 'client'):
+            local.client = client_factory()
+        original = make_image(UPLOAD_SIZE, 'JPEG', seed=seed_base + 2 * index)
+        suspected = make_image(UPLOAD_SIZE, 'JPEG', seed=seed_base + 2 * index + 1)
+        try:
+            steps = round_trip(local.client, original, suspected)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            return
+        with lock:
+            for step, elapsed in steps.items():
+                latencies[step].append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total)))
+    return latencies, time.perf_counter() - started, errors
+
+
+def timed_round_trip(post_upload, get_results):
+    """Upload a pair (sync form post), then fetch the results page, timing both"""
+    def round_trip(client, original, suspected):
+        started = time.perf_counter()
+        status = post_upload(client, original, suspected)
+        uploaded = time.perf_counter()
+        if status != 302:
+            raise RuntimeError(f"/upload returned {status}")
+        status = get_results(client)
+        finished = time.perf_counter()
+        if status != 200:
+            raise RuntimeError(f"/results returned {status}")
+        return {
+            "upload": uploaded - started,
+            "results": finished - uploaded,
+            "round_trip": finished - started,
+        }
+    return round_trip
+
+
+def record_load(prefix, concurrency, latencies, elapsed, errors, results, baseline):
+    for step, values in latencies.items():
+        name = f"{prefix}/{step}/c{concurrency}"
+        results[name] = summarize(values, elapsed)
+        results[name]["errors"] = len(errors)
+        report(name, results[name], baseline)
+    if errors:
+        print(f"  {len(errors)} errors, first: {errors[0]}")
+
+
+def bench_app(args):
+    """Drive /upload and /results through the Flask test client"""
+    import app as deepfake_app
+    
+    # Per-request INFO logging to the console would dominate the measurements
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def post_upload(client, original, suspected):
+        response = client.post('/upload', data={
+            'original_image': (io.BytesIO(original), 'original.jpg'),
+            'suspected_image': (io.BytesIO(suspected), 'suspected.jpg'),
+        }, headers={'Accept': 'text/html'})
+        return response.status_code
+
+    def get_results(client):
+        return client.get('/results').status_code
+
+    results = {}
+    round_trip = timed_round_trip(post_upload, get_results)
+    for concurrency in args.concurrency:
+        latencies, elapsed, errors = run_load(deepfake_app.app.test_client, round_trip, concurrency,
+                                              args.requests, seed_base=concurrency * 100000)
+        record_load("app", concurrency, latencies, elapsed, errors, results, args.baseline_data)
+    return results
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_gunicorn(args):
+    """Drive /upload and /results over HTTP against a gunicorn server running the fake backend"""
+    import requests
+
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    command = [
+        sys.executable, '-m', 'gunicorn', '--bind', f"127.0.0.1:{port}",
+        '--workers', str(args.workers), '--worker-class', 'gthread', '--threads', str(args.threads),
+        '--timeout', '120', '--log-level', 'warning', 'main:app',
+    ]
+    log_path = os.path.join(args.workdir, 'gunicorn.log')
+    log_file = open(log_path, 'wb')
+    server = subprocess.Popen(command, cwd=ROOT, env=os.environ.copy(), stdout=log_file, stderr=subprocess.STDOUT)
+    try:
+        wait_for_server(base_url, server, log_path)
+
+        def post_upload(session, original, suspected):
+            response = session.post(base_url + '/upload', files={
+                'original_image': ('original.jpg', original, 'image/jpeg'),
+                'suspected_image': ('suspected.jpg', suspected, 'image/jpeg'),
+            }, headers={'Accept': 'text/html'}, allow_redirects=False, timeout=120)
+            return response.status_code
+
+        def get_results(session):
+            return session.get(base_url + '/results', timeout=120).status_code
+
+        results = {}
+        round_trip = timed_round_trip(post_upload, get_results)
+        for concurrency in args.concurrency:
+            latencies, elapsed, errors = run_load(requests.Session, round_trip, concurrency,
+                                                  args.requests, seed_base=concurrency * 200000)
+            record_load("gunicorn", concurrency, latencies, elapsed, errors, results, args.baseline_data)
+        return results
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        log_file.close()
+
+
+def import_profile():
+    """Import app in a fresh interpreter with -X importtime; returns {module: cumulative seconds} for top-level imports"""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=ROOT, env=os.environ.copy(),
+                            capture_output=True, text=True, check=True).stderr
+    modules = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name.startswith('  '):  # nested imports are indented below the top-level module
+            modules[name.strip()] = int(cumulative) / 1e6
+    return modules
+
+
+def bench_startup(args):
+    """
+    Time `import app` in a fresh interpreter, and how long a single-worker gunicorn
+    (with gunicorn.conf.py) takes from launch to answering /healthz and its first analysis.
+    """
+    import requests
+
+    results = {}
+    imports, profile = [], {}
+    started = time.perf_counter()
+    for _ in range(args.runs):
+        profile = import_profile()
+        imports.append(profile['app'])
+    results["startup/import_app"] = summarize(imports, time.perf_counter() - started)
+    report("startup/import_app", results["startup/import_app"], args.baseline_data)
+    heaviest = sorted(((seconds, name) for name, seconds in profile.items() if name != 'app'), reverse=True)[:8]
+    print("  heaviest imports: " + ", ".join(f"{name} {seconds * 1000:.0f} ms" for seconds, name in heaviest))
+
+    first_response, first_analysis = [], []
+    original = make_image(UPLOAD_SIZE, 'JPEG', seed='startup-original')
+    suspected = make_image(UPLOAD_SIZE, 'JPEG', seed='startup-suspected')
+    started = time.perf_counter()
+    for run in range(args.runs):
+        port = free_port()
+        base_url = f"http://127.0.0.1:{port}"
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f"127.0.0.1:{port}",
+                   '--workers', '1', '--log-level', 'warning', 'main:app']
+        log_path = os.path.join(args.workdir, f'gunicorn-startup-{run}.log')
+        with open(log_path, 'wb') as log_file:
+            launched = time.perf_counter()
+            server = subprocess.Popen(command, cwd=ROOT, env=os.environ.copy(), stdout=log_file,
+                                      stderr=subprocess.STDOUT)
+            try:
+                wait_for_server(base_url, server, log_path, path='/healthz', interval=0.01)
+                first_response.append(time.perf_counter() - launched)
+                response = requests.post(base_url + '/upload', files={
+                    'original_image': ('original.jpg', original, 'image/jpeg'),
+                    'suspected_image': ('suspected.jpg', suspected, 'image/jpeg'),
+                }, headers={'Accept': 'text/html'}, allow_redirects=False, timeout=120)
+                if response.status_code != 302:
+                    raise RuntimeError(f"/upload returned {response.status_code}, see {log_path}")
+                first_analysis.append(time.perf_counter() - launched)
+            finally:
+                server.terminate()
+                try:
+                    server.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    server.kill()
+    elapsed = time.perf_counter() - started
+    for name, values in (("startup/first_response", first_response), ("startup/first_analysis", first_analysis)):
+        results[name] = summarize(values, elapsed)
+        report(name, results[name], args.baseline_data)
+    return results
+
+
+def wait_for_server(base_url, server, log_path, timeout=60, path='/', interval=0.2):
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited with status {server.returncode}, see {log_path}")
+        try:
+            if requests.get(base_url + path, timeout=5).status_code == 200:
+                return
+        except requests.RequestException:
+            pass  # not listening yet, or workers are still importing the app
+        time.sleep(interval)
+    raise RuntimeError(f"gunicorn did not start in time, see {log_path}")
+
+
+def report(name, stats, baseline):
+    """Print one scenario, with the change against the baseline when there is one"""
+    line = (f"{name:<36} p50 {stats['p50_ms']:>9.2f} ms  p95 {stats['p95_ms']:>9.2f} ms  "
+            f"p99 {stats['p99_ms']:>9.2f} ms  {stats['rps']:>8.2f} req/s")
+    previous = baseline.get(name)
+    if previous:
+        line += f"  (p95 {change(stats['p95_ms'], previous['p95_ms'])}, req/s {change(stats['rps'], previous['rps'])})"
+    print(line, flush=True)
+
+
+def change(current, previous):
+    if not previous:
+        return "n/a"
+    return f"{(current - previous) / previous * 100:+.1f}%"
+
+
+def regressions(results, baseline, tolerance):
+    """Scenarios whose p95 grew, or whose throughput fell, by more than tolerance"""
+    found = []
+    for name, stats in results.items():
+        previous = baseline.get(name)
+        if not previous:
+            continue
+        if previous['p95_ms'] and stats['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            found.append(f"{name}: p95 {previous['p95_ms']} -> {stats['p95_ms']} ms")
+        if previous['rps'] and stats['rps'] < previous['rps'] * (1 - tolerance):
+            found.append(f"{name}: {previous['rps']} -> {stats['rps']} req/s")
+    return found
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks with a fake Gemini backend")
+    parser.add_argument('suite', choices=['normalize', 'app', 'gunicorn', 'logging', 'startup', 'similarity', 'payload', 'all'])
+    parser.add_argument('--concurrency', default='1,4,16',
+                        type=lambda value: [int(part) for part in value.split(',')],
+                        help="comma-separated concurrency levels (default: 1,4,16)")
+    parser.add_argument('--requests', type=int, default=48, help="round trips per concurrency level")
+    parser.add_argument('--iterations', type=int, default=20, help="normalizations per corpus image (x --requests simulated requests for logging)")
+    parser.add_argument('--latency', type=float, default=0.5, help="fake model latency in seconds")
+    parser.add_argument('--text', default=FAKE_TEXT, help="fake model reply text")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn worker processes")
+    parser.add_argument('--threads', type=int, default=8, help="threads per gunicorn worker")
+    parser.add_argument('--entries', type=int, default=1000000, help="entries in the similarity suite's index")
+    parser.add_argument('--runs', type=int, default=3, help="fresh interpreters / servers started by the startup suite")
+    parser.add_argument('--corpus', help="directory of images for the payload suite (default: synthetic)")
+    parser.add_argument('--live', action='store_true',
+                        help="payload suite: compare verdicts from the real Gemini API on --corpus pairs")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="baseline JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--check', action='store_true', help="exit with status 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative change (default: 0.2)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    args.baseline_data = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        args.baseline_data = baseline.get("results", {})
+        if baseline.get("latency") != args.latency:
+            print(f"Note: the baseline was recorded with a fake latency of {baseline.get('latency')}s")
+
+    args.workdir = tempfile.mkdtemp(prefix='deepfake-bench-')
+    prepare_environment(args.workdir, args.latency, args.text)
+    if args.live:
+        if args.suite != 'payload' or not args.corpus or os.environ["GEMINI_API_KEY"] == "benchmark":
+            print("--live needs the payload suite, --corpus and GEMINI_API_KEY")
+            return 2
+        os.environ["GEMINI_BACKEND"] = ""
+    args.failures = []
+    print(f"Fake model latency {args.latency}s, scratch directory {args.workdir}")
+
+    results = {}
+    suites = ['normalize', 'app', 'gunicorn', 'logging', 'startup', 'similarity', 'payload'] if args.suite == 'all' else [args.suite]
+    for suite in suites:
+        print(f"\n== {suite}")
+        results.update({'normalize': bench_normalize, 'app': bench_app, 'gunicorn': bench_gunicorn,
+                        'logging': bench_logging, 'startup': bench_startup,
+                        'similarity': bench_similarity, 'payload': bench_payload}[suite](args))
+
+    if args.save_baseline:
+        merged = dict(args.baseline_data)
+        merged.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump({"recorded": time.strftime('%Y-%m-%dT%H:%M:%S'), "latency": args.latency,
+                       "results": merged}, f, indent=2, sort_keys=True)
+        print(f"\nBaseline saved to {args.baseline}")
+
+    found = regressions(results, args.baseline_data, args.tolerance) + args.failures
+    if found:
+        print("\nRegressions against the baseline:")
+        for line in found:
+            print(f"  {line}")
+        if args.check:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Offline scan of many image pairs, e.g. an archive of past uploads.
+
+Pairs come from a directory or a CSV manifest:
+
+- In a directory, `original_<name>.<ext>` is paired with
+  `suspected_<name>.<ext>` (any allowed image extension on either side),
+  searched recursively. Files without a partner are listed and skipped.
+- A manifest has `original` and `suspected` columns (paths relative to the
+  manifest) and an optional `id` column.
+
+Images are copied to a scratch directory and normalized there with
+`resize_image_if_needed` in a process pool, so the archive itself is never
+modified. Normalized pairs are analyzed with `analyze_images_with_gemini` in
+a bounded thread pool, which goes through the same pre-screen, verdict
+cache, rate limiter and model routing as the web app.
+
+Every result is written as soon as it is known. The output doubles as the
+checkpoint: pairs already in it are skipped, so an interrupted run resumes
+where it stopped when started again with the same output.
+
+    python bulk_scan.py uploads/ --output scan.jsonl
+    python bulk_scan.py pairs.csv --output scan/ --format parquet --concurrency 8
+
+Pairs whose earlier result was an error (e.g. the model was unavailable) are
+scanned again with --retry-errors; readers should keep the last row per
+pair_id. Parquet output (a directory of part files) requires pyarrow.
+"""
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is optional
+    pa = pq = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Scanning an archive must not delete anything or write to the upload store
+os.environ.setdefault("JANITOR_INTERVAL", "0")
+
+dotenv_path = os.path.join(ROOT, '.env')
+if os.path.exists(dotenv_path):
+    load_dotenv(dotenv_path)
+
+import app as deepfake_app  # noqa: E402  (configured from the environment loaded above)
+from imaging import ImageNormalizationError  # noqa: E402
+from rate_limit import OverloadedError  # noqa: E402
+
+FIELDS = ("pair_id", "original", "suspected", "is_deepfake", "confidence", "model", "analysis", "error",
+          "seconds", "scanned_at")
+
+
+class Pair:
+    """One original/suspected pair to scan"""
+
+    __slots__ = ('pair_id', 'original', 'suspected')
+
+    def __init__(self, pair_id, original, suspected):
+        self.pair_id = pair_id
+        self.original = original
+        self.suspected = suspected
+
+
+def pairs_from_directory(directory):
+    """Pair original_<name> with suspected_<name> files; returns (pairs, unmatched paths)"""
+    found = {"original": {}, "suspected": {}}
+    for path in sorted(glob.glob(os.path.join(directory, '**', '*_*'), recursive=True)):
+        filename = os.path.basename(path)
+        role, _, rest = filename.partition('_')
+        if role not in found or not os.path.isfile(path) or not deepfake_app.allowed_file(filename):
+            continue
+        relative_dir = os.path.relpath(os.path.dirname(path), directory)
+        key = os.path.normpath(os.path.join(relative_dir, os.path.splitext(rest)[0]))
+        found[role][key] = path
+
+    originals, suspects = found["original"], found["suspected"]
+    pairs = [Pair(key, originals[key], suspects[key]) for key in sorted(originals.keys() & suspects.keys())]
+    unmatched = sorted(path for role in found.values() for key, path in role.items()
+                       if key not in originals or key not in suspects)
+    return pairs, unmatched
+
+
+def pairs_from_manifest(manifest):
+    """Read pairs from a CSV with original, suspected and optional id columns"""
+    base = os.path.dirname(os.path.abspath(manifest))
+    pairs = []
+    with open(manifest, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = {"original", "suspected"} - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"Manifest is missing the column(s): {', '.join(sorted(missing))}")
+        for line, row in enumerate(reader, start=2):
+            original = os.path.join(base, row["original"])
+            suspected = os.path.join(base, row["suspected"])
+            pairs.append(Pair(row.get("id") or f"line-{line}", original, suspected))
+    return pairs
+
+
+class JsonlWriter:
+    """Appends one JSON object per result and flushes it at once"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def completed(self, retry_errors=False):
+        """
+        pair_ids already written (only those without an error, with retry_errors).
+
+        A last line cut off by an interrupted run is removed.
+        """
+        done = set()
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, 'rb+') as f:
+            good = 0
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    row = json.loads(line)
+                    if not (retry_errors and row.get("error")):
+                        done.add(row["pair_id"])
+                except (ValueError, KeyError):
+                    break
+                good += len(line)
+            f.truncate(good)
+        return done
+
+    def write(self, row):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(row) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+
+class ParquetWriter:
+    """
+    Writes results to a directory of Parquet part files.
+
+    Rows are buffered and written as a new part every rows_per_part results
+    (and at the end). Each part is written to a temporary name and renamed,
+    so every visible part is complete; buffered rows lost to an interruption
+    are simply scanned again.
+    """
+
+    def __init__(self, directory, rows_per_part=500):
+        if pa is None:
+            raise RuntimeError("Parquet output requires pyarrow (pip install pyarrow)")
+        self.directory = directory
+        self.rows_per_part = rows_per_part
+        types = {"is_deepfake": pa.bool_(), "seconds": pa.float64()}
+        self.schema = pa.schema([(name, types.get(name, pa.string())) for name in FIELDS])
+        self._rows = []
+        os.makedirs(directory, exist_ok=True)
+        self._next_part = len(self._parts())
+
+    def _parts(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'part-*.parquet')))
+
+    def completed(self, retry_errors=False):
+        done = set()
+        for part in self._parts():
+            table = pq.read_table(part, columns=["pair_id", "error"]).to_pydict()
+            done.update(pair_id for pair_id, error in zip(table["pair_id"], table["error"])
+                        if not (retry_errors and error))
+        return done
+
+    def write(self, row):
+        self._rows.append(row)
+        if len(self._rows) >= self.rows_per_part:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        table = pa.Table.from_pylist(self._rows, schema=self.schema)
+        path = os.path.join(self.directory, f'part-{self._next_part:05d}.parquet')
+        pq.write_table(table, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        self._next_part += 1
+        self._rows = []
+
+    def close(self):
+        self.flush()
+
+
+def process_context():
+    """
+    Start method for the normalization workers.
+
+    Forked workers inherit the imported app, and init_worker resets what must
+    not be shared across a fork. Where fork is unavailable (Windows), workers
+    are spawned and import the app themselves; init_worker is then a no-op
+    reset of fresh state.
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context('spawn')
+
+
+def normalize_pair(pair, scratch):
+    """
+    Copy a pair into the scratch directory and normalize the copies (runs in a worker process).
+
+    Returns (original path, suspected path); raises ImageNormalizationError
+    for files that are not valid images.
+    """
+    directory = tempfile.mkdtemp(dir=scratch)
+    paths = []
+    for role, source in (("original", pair.original), ("suspected", pair.suspected)):
+        path = os.path.join(directory, role + os.path.splitext(source)[1].lower())
+        shutil.copyfile(source, path)
+        deepfake_app.resize_image_if_needed(path)
+        paths.append(path)
+    return tuple(paths)
+
+
+def analyze_pair(original, suspected):
+    """Analyze a normalized pair, waiting and retrying while the model is overloaded"""
+    while True:
+        try:
+            return deepfake_app.analyze_images_with_gemini(original, suspected)
+        except OverloadedError as e:
+            time.sleep(e.retry_after)
+
+
+def make_row(pair, result, started):
+    return {
+        "pair_id": pair.pair_id,
+        "original": pair.original,
+        "suspected": pair.suspected,
+        "is_deepfake": result.get("is_deepfake"),
+        "confidence": result.get("confidence"),
+        "model": result.get("model"),
+        "analysis": result.get("analysis"),
+        "error": result.get("error"),
+        "seconds": round(time.monotonic() - started, 3),
+        "scanned_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }
+
+
+class Progress:
+    """Prints pairs done, throughput and ETA at most every interval seconds"""
+
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.errors = 0
+        self.deepfakes = 0
+        self.started = time.monotonic()
+        self._last = 0.0
+
+    def add(self, row):
+        self.done += 1
+        self.errors += row["error"] is not None
+        self.deepfakes += row["is_deepfake"] is True
+        now = time.monotonic()
+        if now - self._last >= self.interval or self.done == self.total:
+            self._last = now
+            print(self.line(), flush=True)
+
+    def line(self):
+        elapsed = time.monotonic() - self.started
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        remaining = (self.total - self.done) / rate if rate > 0 else float('inf')
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining)) if remaining != float('inf') else "--:--:--"
+        return (f"{self.done}/{self.total} pairs, {rate:.2f} pairs/s, ETA {eta}, "
+                f"{self.deepfakes} flagged, {self.errors} errors")
+
+
+def scan(pairs, writer, processes, concurrency, progress_interval=5.0):
+    """Normalize and analyze pairs, writing a row for each; returns the Progress"""
+    progress = Progress(len(pairs), progress_interval)
+    scratch = tempfile.mkdtemp(prefix='deepfake-scan-')
+    process_pool = ProcessPoolExecutor(max_workers=processes, mp_context=process_context(),
+                                       initializer=deepfake_app.init_worker)
+    thread_pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="bulk-scan")
+    # Bound the pairs held in memory or on scratch disk at any time
+    max_in_flight = processes * 2 + concurrency * 2
+
+    pending = iter(pairs)
+    normalizing, analyzing = {}, {}
+    try:
+        while True:
+            while len(normalizing) + len(analyzing) < max_in_flight:
+                pair = next(pending, None)
+                if pair is None:
+                    break
+                normalizing[process_pool.submit(normalize_pair, pair, scratch)] = (pair, time.monotonic())
+            if not normalizing and not analyzing:
+                break
+
+            done, _ = wait(list(normalizing) + list(analyzing), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in normalizing:
+                    pair, started = normalizing.pop(future)
+                    try:
+                        paths = future.result()
+                    except (ImageNormalizationError, OSError) as e:
+                        row = make_row(pair, {"error": f"Could not read image: {e}"}, started)
+                        writer.write(row)
+                        progress.add(row)
+                        continue
+                    analyzing[thread_pool.submit(analyze_pair, *paths)] = (pair, started, paths)
+                else:
+                    pair, started, paths = analyzing.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"error": str(e)}
+                    shutil.rmtree(os.path.dirname(paths[0]), ignore_errors=True)
+                    row = make_row(pair, result, started)
+                    writer.write(row)
+                    progress.add(row)
+    finally:
+        process_pool.shutdown(wait=True, cancel_futures=True)
+        thread_pool.shutdown(wait=True, cancel_futures=True)
+        writer.close()
+        shutil.rmtree(scratch, ignore_errors=True)
+    return progress
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Scan a directory or CSV manifest of image pairs for deepfakes")
+    parser.add_argument('source', help="directory of original_*/suspected_* files, or a CSV manifest")
+    parser.add_argument('--output', required=True, help="JSONL file, or directory for --format parquet")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 2,
+                        help="normalization worker processes (default: CPU count)")
+    parser.add_argument('--concurrency', type=int, default=4, help="concurrent model calls (default: 4)")
+    parser.add_argument('--rows-per-part', type=int, default=500, help="rows per Parquet part file")
+    parser.add_argument('--progress-interval', type=float, default=5.0, help="seconds between progress lines")
+    parser.add_argument('--retry-errors', action='store_true',
+                        help="scan pairs whose earlier result was an error again (the new row is added after the old one)")
+    parser.add_argument('--limit', type=int, default=0, help="scan at most this many pairs (0 for all)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if os.path.isdir(args.source):
+        pairs, unmatched = pairs_from_directory(args.source)
+        for path in unmatched:
+            print(f"No partner for {path}, skipped")
+    else:
+        pairs = pairs_from_manifest(args.source)
+
+    if args.format == 'parquet':
+        writer = ParquetWriter(args.output, rows_per_part=args.rows_per_part)
+    else:
+        writer = JsonlWriter(args.output)
+
+    completed = writer.completed(retry_errors=args.retry_errors)
+    remaining = [pair for pair in pairs if pair.pair_id not in completed]
+    print(f"{len(pairs)} pairs, {len(pairs) - len(remaining)} already scanned, {len(remaining)} to scan")
+    if args.limit:
+        remaining = remaining[:args.limit]
+    if not remaining:
+        writer.close()
+        return 0
+
+    try:
+        progress = scan(remaining, writer, max(1, args.processes), max(1, args.concurrency), args.progress_interval)
+    except KeyboardInterrupt:
+        print("Interrupted; run the same command again to resume")
+        return 130
+    print(f"Done: {progress.line()}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
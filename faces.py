@@ -0,0 +1,177 @@
+"""
+CPU-only face detection and cropping for model payloads.
+
+Whole images are up to 1024x1024 even when the face fills a small part of
+the frame. When both images of a pair contain a face we send Gemini an
+aligned crop of the largest face from each (rotated so the eyes are level),
+optionally followed by a low-resolution thumbnail of each full image for
+context. Crops are a fraction of the size of the full images, so calls are
+cheaper and faster.
+
+Detection uses OpenCV's bundled Haar cascades on a downscaled grayscale copy.
+Detections are cached per image digest, so a reference compared many times is
+only scanned once.
+
+Requires OpenCV (opencv-python-headless) and NumPy.
+"""
+
+import io
+import logging
+import math
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from imaging import NormalizedImage
+
+logger = logging.getLogger(__name__)
+
+DETECT_MAX_SIZE = 640
+CROP_SIZE = (512, 512)
+CROP_MARGIN = 0.35
+CROP_QUALITY = 90
+CONTEXT_SIZE = (256, 256)
+CONTEXT_QUALITY = 75
+
+DETECTION_CACHE_SIZE = 512
+
+_detections = OrderedDict()
+_detections_lock = threading.Lock()
+
+# Cascade classifiers are not safe to share between threads, so each thread loads its own
+_local = threading.local()
+
+
+class FaceRegion:
+    """A detected face: its box in image pixels and the rotation (degrees) that levels the eyes"""
+
+    __slots__ = ('box', 'angle')
+
+    def __init__(self, box, angle=0.0):
+        self.box = box
+        self.angle = angle
+
+
+def _cascade(name):
+    cascades = getattr(_local, 'cascades', None)
+    if cascades is None:
+        cascades = _local.cascades = {}
+    if name not in cascades:
+        cascades[name] = cv2.CascadeClassifier(cv2.data.haarcascades + name)
+    return cascades[name]
+
+
+def find_faces(gray, min_size=(24, 24)):
+    """Face boxes (x, y, w, h) in a grayscale array, largest first"""
+    faces = _cascade('haarcascade_frontalface_default.xml').detectMultiScale(
+        gray, scaleFactor=1.2, minNeighbors=5, minSize=min_size)
+    return sorted((tuple(int(v) for v in face) for face in faces), key=lambda face: face[2] * face[3], reverse=True)
+
+
+def _eye_angle(face_gray):
+    """Angle (degrees) of the line through the two largest eyes in the upper half of a face, or 0"""
+    upper = face_gray[:face_gray.shape[0] // 2]
+    eyes = _cascade('haarcascade_eye.xml').detectMultiScale(upper, scaleFactor=1.1, minNeighbors=5)
+    if len(eyes) < 2:
+        return 0.0
+    eyes = sorted(eyes, key=lambda eye: eye[2] * eye[3], reverse=True)[:2]
+    (x1, y1), (x2, y2) = sorted((x + w / 2, y + h / 2) for x, y, w, h in eyes)
+    angle = math.degrees(math.atan2(y2 - y1, x2 - x1))
+    return angle if abs(angle) <= 30 else 0.0  # larger angles are more likely false detections
+
+
+def detect_faces(image):
+    """Detect faces in a NormalizedImage (cached by digest); returns FaceRegions, largest first"""
+    with _detections_lock:
+        cached = _detections.get(image.digest)
+        if cached is not None:
+            _detections.move_to_end(image.digest)
+            return cached
+
+    with Image.open(io.BytesIO(image.data)) as img:
+        gray = img.convert('L')
+    scale = min(1.0, DETECT_MAX_SIZE / max(gray.size))
+    if scale < 1.0:
+        gray = gray.resize((round(gray.width * scale), round(gray.height * scale)), Image.BILINEAR)
+    pixels = np.asarray(gray)
+
+    regions = []
+    for x, y, w, h in find_faces(pixels):
+        angle = _eye_angle(pixels[y:y + h, x:x + w])
+        regions.append(FaceRegion(tuple(round(v / scale) for v in (x, y, w, h)), angle))
+
+    remember(image.digest, regions)
+    return regions
+
+
+def remember(digest, regions):
+    """Put detections computed elsewhere (e.g. loaded from the reference registry) into the cache"""
+    with _detections_lock:
+        _detections[digest] = regions
+        _detections.move_to_end(digest)
+        while len(_detections) > DETECTION_CACHE_SIZE:
+            _detections.popitem(last=False)
+
+
+def regions_to_list(regions):
+    """JSON-compatible form of FaceRegions: [x, y, w, h, angle] each"""
+    return [[*region.box, region.angle] for region in regions]
+
+
+def regions_from_list(data):
+    return [FaceRegion(tuple(int(v) for v in entry[:4]), float(entry[4])) for entry in data]
+
+
+def _encode_jpeg(img, quality):
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return NormalizedImage(buffer.getvalue(), 'image/jpeg', img.size)
+
+
+def crop_face(image, region, margin=CROP_MARGIN, size=CROP_SIZE):
+    """Square, eye-aligned crop of one face region as a JPEG NormalizedImage"""
+    x, y, w, h = region.box
+    center_x, center_y = x + w / 2, y + h / 2
+    half = max(w, h) * (1 + margin) / 2
+
+    with Image.open(io.BytesIO(image.data)) as img:
+        # Crop generously first so rotating does not pull in empty corners, then trim to the square
+        outer = half * math.sqrt(2)
+        crop = img.convert('RGB').crop((round(center_x - outer), round(center_y - outer),
+                                        round(center_x + outer), round(center_y + outer)))
+    if region.angle:
+        crop = crop.rotate(region.angle, resample=Image.BICUBIC)
+    offset = outer - half
+    crop = crop.crop((round(offset), round(offset), round(offset + 2 * half), round(offset + 2 * half)))
+    crop.thumbnail(size, Image.LANCZOS)
+    return _encode_jpeg(crop, CROP_QUALITY)
+
+
+def context_thumbnail(image, size=CONTEXT_SIZE):
+    """Low-resolution JPEG of the whole image"""
+    with Image.open(io.BytesIO(image.data)) as img:
+        img.thumbnail(size, Image.LANCZOS)
+        return _encode_jpeg(img, CONTEXT_QUALITY)
+
+
+def face_payload(original, suspected, context=False):
+    """
+    Images to send instead of the full pair, or None when either image has no detectable face.
+
+    Returns [original face, suspected face] followed, with context=True, by
+    thumbnails of the full original and suspected images.
+    """
+    original_faces = detect_faces(original)
+    suspected_faces = detect_faces(suspected)
+    if not original_faces or not suspected_faces:
+        return None
+
+    images = [crop_face(original, original_faces[0]), crop_face(suspected, suspected_faces[0])]
+    if context:
+        images += [context_thumbnail(original), context_thumbnail(suspected)]
+    return images
@@ -0,0 +1,253 @@
+"""
+Shared Gemini model registry.
+
+Creating a GenerativeModel and configuring the SDK on every request adds
+setup cost and churns connections. The registry configures the SDK once per
+process, keeps one model object per model name (the SDK reuses its default
+transport, so the gRPC channel stays open between requests) and applies the
+configured timeout and retry policy to every call.
+
+Calls can be throttled by a rate_limit.RateLimiter. Retryable errors are
+retried with jittered exponential backoff, taking a fresh limiter slot for
+every attempt; a quota or overload error that outlasts the retry budget is
+raised as OverloadedError so callers can answer 503 with Retry-After.
+
+Tests and benchmarks can swap in a local fake with `set_factory`, or select
+one by name with `load_backend` (see GEMINI_BACKEND in app.py).
+
+The SDK and its gRPC/protobuf stack take a large share of the application's
+import time, so they are imported on first use (`load_sdk`): a process that
+runs the fake backend never loads them, and workers load them off the
+request path in `warm_up`.
+"""
+
+import importlib
+import logging
+import os
+import random
+import threading
+import time
+
+from rate_limit import OverloadedError
+
+logger = logging.getLogger(__name__)
+
+# Set by load_sdk; None until the SDK is first needed
+genai = None
+api_exceptions = None
+api_retry = None
+
+_sdk_lock = threading.Lock()
+
+# Backoff between attempts: a random delay up to initial * multiplier ** attempt, capped at maximum
+RETRY_INITIAL = 1.0
+RETRY_MAXIMUM = 10.0
+RETRY_MULTIPLIER = 2.0
+
+
+def load_sdk():
+    """Import the Gemini SDK (once per process) and return the google.generativeai module"""
+    global genai, api_exceptions, api_retry
+    if genai is None:
+        with _sdk_lock:
+            if genai is None:
+                from google.api_core import exceptions, retry
+                import google.generativeai as sdk
+                api_exceptions, api_retry = exceptions, retry
+                genai = sdk
+    return genai
+
+
+def is_transient_error(error):
+    """Whether an SDK error is worth retrying; errors raised before the SDK was loaded never are"""
+    return api_retry is not None and api_retry.if_transient_error(error)
+
+
+def is_overload_error(error):
+    """Whether an SDK error means quota exhaustion or an overloaded service"""
+    return api_exceptions is not None and isinstance(
+        error, (api_exceptions.TooManyRequests, api_exceptions.ServiceUnavailable))
+
+
+def backoff_delay(attempt, initial=RETRY_INITIAL, maximum=RETRY_MAXIMUM, multiplier=RETRY_MULTIPLIER):
+    """Full-jitter exponential backoff, so retrying workers spread out instead of retrying in step"""
+    return random.uniform(0, min(maximum, initial * multiplier ** attempt))
+
+
+class ModelRegistry:
+    """Process-wide cache of Gemini models sharing one configured transport"""
+
+    def __init__(self, api_key="", transport=None, timeout=60.0, retry_timeout=30.0, factory=None,
+                 limiter=None, queue_timeout=30.0):
+        self.api_key = api_key
+        self.transport = transport
+        self.timeout = timeout
+        self.retry_timeout = retry_timeout
+        self.limiter = limiter
+        self.queue_timeout = queue_timeout
+
+        self._factory = factory
+        self._models = {}
+        self._configured = False
+        self._lock = threading.Lock()
+
+    def set_factory(self, factory):
+        """
+        Replace the model factory, e.g. with FakeModel for tests.
+
+        The factory is called as factory(model_name) and must return an object
+        with a generate_content(contents, **kwargs) method.
+        """
+        with self._lock:
+            self._factory = factory
+            self._models.clear()
+
+    def reset(self):
+        """
+        Forget every cached model and the SDK configuration so the next call
+        creates fresh ones (and a new transport, e.g. after a fork)
+        """
+        with self._lock:
+            self._models.clear()
+            self._configured = False
+
+    def get(self, model_name):
+        """Return the shared model for model_name, creating it on first use"""
+        model = self._models.get(model_name)
+        if model is not None:
+            return model
+
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is None:
+                model = self._create(model_name)
+                self._models[model_name] = model
+            return model
+
+    def generate(self, model_name, contents, **kwargs):
+        """
+        Call generate_content on the shared model with the configured timeout,
+        rate limit and retries.
+
+        With stream=True the limiter slot is held until the returned stream
+        has been consumed.
+        """
+        model = self.get(model_name)
+        kwargs.setdefault("request_options", self.request_options())
+        deadline = time.monotonic() + max(self.retry_timeout or 0, 0)
+        attempt = 0
+
+        while True:
+            lease = self.limiter.acquire(self.queue_timeout) if self.limiter is not None else None
+            try:
+                response = model.generate_content(contents, **kwargs)
+            except Exception as e:
+                self._release(lease)
+                delay = backoff_delay(attempt)
+                if not is_transient_error(e) or time.monotonic() + delay > deadline:
+                    if is_overload_error(e):
+                        raise OverloadedError(f"Model is overloaded: {e}", retry_after=RETRY_MAXIMUM) from e
+                    raise
+                attempt += 1
+                logger.warning("Retrying %s call in %.1fs (attempt %s): %s", model_name, delay, attempt, e)
+                time.sleep(delay)
+                continue
+
+            if kwargs.get("stream"):
+                return self._release_after(response, lease)
+            self._release(lease)
+            return response
+
+    def warm_up(self, model_names, connect=False):
+        """
+        Create the shared models before the first request needs them.
+
+        This imports and configures the SDK. With connect=True each model
+        also makes a count_tokens call, which opens the connection without
+        generating anything (and is not counted by the rate limiter).
+        """
+        for model_name in model_names:
+            model = self.get(model_name)
+            if connect and self._factory is None:
+                model.count_tokens("ping", request_options=self.request_options())
+
+    def request_options(self):
+        """Per-call timeout passed to the SDK; retries are handled by generate"""
+        return {"timeout": self.timeout, "retry": None}
+
+    def _release(self, lease):
+        if lease is not None:
+            self.limiter.release(lease)
+
+    def _release_after(self, stream, lease):
+        """Yield from a streamed response and free the limiter slot once it ends"""
+        try:
+            yield from stream
+        finally:
+            self._release(lease)
+
+    def _create(self, model_name):
+        if self._factory is not None:
+            return self._factory(model_name)
+
+        genai = load_sdk()
+        if not self._configured:
+            genai.configure(api_key=self.api_key, transport=self.transport)
+            self._configured = True
+
+        logger.info("Creating shared Gemini model: %s", model_name)
+        return genai.GenerativeModel(model_name)
+
+
+class FakeResponse:
+    """Minimal stand-in for a Gemini response"""
+
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModel:
+    """Local fake model returning canned text after an optional delay (streamed in chunks with stream=True)"""
+
+    def __init__(self, model_name="fake", text="The images show the same person. This is not a deepfake. High confidence.",
+                 latency=0.0):
+        self.model_name = model_name
+        self.text = text
+        self.latency = latency
+        self.calls = 0
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        self.calls += 1
+        if stream:
+            return self._stream()
+        if self.latency:
+            time.sleep(self.latency)
+        return FakeResponse(self.text)
+
+    def _stream(self, words_per_chunk=8):
+        """Yield the text a few words at a time, spreading the latency across chunks"""
+        words = self.text.split(" ")
+        starts = range(0, len(words), words_per_chunk)
+        for start in starts:
+            if self.latency:
+                time.sleep(self.latency / len(starts))
+            end = start + words_per_chunk
+            yield FakeResponse(" ".join(words[start:end]) + (" " if end < len(words) else ""))
+
+
+def fake_factory(model_name):
+    """FakeModel configured from FAKE_MODEL_LATENCY (seconds) and FAKE_MODEL_TEXT"""
+    kwargs = {"latency": float(os.environ.get("FAKE_MODEL_LATENCY", "0"))}
+    if os.environ.get("FAKE_MODEL_TEXT"):
+        kwargs["text"] = os.environ["FAKE_MODEL_TEXT"]
+    return FakeModel(model_name, **kwargs)
+
+
+def load_backend(spec):
+    """Resolve a model factory: "fake" or "package.module:callable" """
+    if spec == "fake":
+        return fake_factory
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"Model backend must be 'fake' or 'module:factory', got {spec!r}")
+    return getattr(importlib.import_module(module_name), attribute)
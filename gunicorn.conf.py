@@ -0,0 +1,123 @@
+"""
+Production gunicorn configuration.
+
+    gunicorn -c gunicorn.conf.py main:app
+
+The application is imported once in the master (preload_app) and forked into
+workers, so workers start quickly and share the imported code. Analyses spend
+almost all their time waiting for Gemini, so the default worker class is
+gthread: each worker serves GUNICORN_THREADS requests concurrently, and
+open event streams (STREAM_RESULTS) do not tie up a whole process.
+
+Timeouts are derived from the Gemini settings, so a synchronous form post that
+waits for a limiter slot, the model call and its retries is never killed
+mid-analysis, and a graceful restart lets in-flight analyses finish. Workers
+are recycled after GUNICORN_MAX_REQUESTS requests (with jitter, so they do not
+all restart together) to bound memory growth.
+
+The Gemini SDK is imported lazily by the application; with preloading it is
+imported once in the master, and each worker creates its model client in a
+background thread as soon as it has booted (MODEL_WARMUP).
+
+Every setting can be overridden with the environment variables below or on
+the gunicorn command line.
+"""
+
+import multiprocessing
+import os
+import sys
+
+
+def _env_int(name, default):
+    return int(os.environ.get(name) or default)
+
+
+def _env_float(name, default):
+    return float(os.environ.get(name) or default)
+
+
+# Longest a request can legitimately take: waiting for a limiter slot, the call itself and its retries
+ANALYSIS_BUDGET = (_env_float("GEMINI_QUEUE_TIMEOUT", 30) + _env_float("GEMINI_TIMEOUT", 60)
+                   + _env_float("GEMINI_RETRY_TIMEOUT", 30))
+
+bind = os.environ.get("GUNICORN_BIND") or f"0.0.0.0:{os.environ.get('PORT') or 5000}"
+
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS") or "gthread"
+workers = _env_int("WEB_CONCURRENCY", min(multiprocessing.cpu_count() + 1, 8))
+threads = _env_int("GUNICORN_THREADS", 8)
+worker_connections = _env_int("GUNICORN_WORKER_CONNECTIONS", 256)  # gevent only
+
+# gevent patches the standard library when a worker starts, which is too late for an
+# application imported in the master, so preloading is off by default for gevent workers
+preload_app = os.environ.get("GUNICORN_PRELOAD", "false" if worker_class == "gevent" else "true").lower() in ("1", "true", "yes")
+
+timeout = _env_int("GUNICORN_TIMEOUT", ANALYSIS_BUDGET + 30)
+graceful_timeout = _env_int("GUNICORN_GRACEFUL_TIMEOUT", ANALYSIS_BUDGET + 30)
+keepalive = _env_int("GUNICORN_KEEPALIVE", 5)
+
+max_requests = _env_int("GUNICORN_MAX_REQUESTS", 1000)
+max_requests_jitter = _env_int("GUNICORN_MAX_REQUESTS_JITTER", max_requests // 10)
+
+# Uploads are up to 10MB; let the kernel queue bursts of connections while workers are busy
+backlog = _env_int("GUNICORN_BACKLOG", 2048)
+
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-") or None
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+# Trust X-Forwarded-* headers from these proxy addresses
+forwarded_allow_ips = os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1")
+
+
+def _application():
+    """The preloaded app module, or None when the application is loaded in each worker"""
+    return sys.modules.get("app")
+
+
+def on_starting(server):
+    """Refuse to start when the configuration is unusable (see `python main.py --check`)"""
+    app_module = _application()
+    if app_module is None:
+        return  # not preloaded: the check would import the whole application into the master
+    problems = app_module.startup_check()
+    if problems and os.environ.get("STARTUP_CHECK_STRICT", "true").lower() in ("1", "true", "yes"):
+        raise RuntimeError("Startup check failed: " + "; ".join(problems))
+    app_module.preload()
+
+
+def post_fork(server, worker):
+    """Give each worker its own database connections and Gemini transport"""
+    app_module = _application()
+    if app_module is not None:
+        app_module.init_worker()
+    if server.cfg.worker_class_str == "gevent":
+        try:
+            from grpc.experimental import gevent as grpc_gevent
+        except ImportError:
+            pass
+        else:
+            grpc_gevent.init_gevent()
+
+
+def post_worker_init(worker):
+    """Create the model client in the background, so the first request does not pay for it"""
+    app_module = _application()
+    if app_module is not None:
+        app_module.warm_up()
+
+
+def worker_exit(server, worker):
+    """Let queued background analyses finish before a worker exits (bounded by graceful_timeout)"""
+    app_module = _application()
+    if app_module is not None:
+        app_module.job_queue.shutdown(wait=True)
+        app_module.metrics.flush(force=True)
+
+
+def child_exit(server, worker):
+    """Fold the exited worker's metrics snapshot into the server-wide totals (runs in the master)"""
+    app_module = _application()
+    snapshot_dir = app_module.METRICS_DIR if app_module is not None else os.environ.get("METRICS_DIR")
+    if snapshot_dir:
+        import metrics
+        metrics.mark_process_dead(worker.pid, snapshot_dir)
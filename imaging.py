@@ -0,0 +1,258 @@
+"""
+Single-pass image normalization.
+
+An upload is decoded exactly once: JPEGs are draft-decoded at a reduced
+scale, EXIF orientation is applied and the image is thumbnailed to the model
+size limit. From that one decoded image we produce the bytes sent to the
+model and a small JPEG used for display, both in memory. Nothing is written
+to disk here; callers store the model bytes under their digest and
+`save_display_image` writes the display JPEG to the thumbnail folder, from
+which `get_thumbnail` renders and caches the smaller variants.
+"""
+
+import io
+import logging
+import os
+import re
+
+from PIL import Image, ImageOps
+
+from storage import write_atomic
+from verdict_cache import content_digest
+
+logger = logging.getLogger(__name__)
+
+MODEL_MAX_SIZE = (1024, 1024)
+DISPLAY_MAX_SIZE = (800, 800)
+JPEG_QUALITY = 90
+DISPLAY_QUALITY = 80
+
+# Formats we re-encode to when an image has to be rewritten; anything else becomes PNG
+REENCODE_FORMATS = {'JPEG', 'PNG', 'GIF', 'WEBP'}
+
+EXIF_ORIENTATION = 0x0112
+
+# Thumbnail variants served by the image route, keyed by size name
+THUMBNAIL_SIZES = {'sm': (320, 320), 'md': DISPLAY_MAX_SIZE}
+THUMBNAIL_FORMATS = {'jpeg': ('JPEG', 'jpg'), 'webp': ('WEBP', 'webp')}
+THUMBNAIL_QUALITY = 80
+
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+# Upload formats we accept (by Pillow format name) and the file signatures that identify them
+ALLOWED_FORMATS = ('JPEG', 'PNG', 'GIF')
+SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+)
+SIGNATURE_BYTES = 12
+
+# Largest upload we are willing to decode; bigger images are rejected from the header alone
+MAX_INPUT_PIXELS = 40_000_000
+
+
+class ImageNormalizationError(ValueError):
+    """Raised when an upload cannot be decoded as an image"""
+
+
+class NormalizedImage:
+    """A decoded, size-limited image held in memory"""
+
+    __slots__ = ('data', 'mime_type', 'digest', 'size', 'display_data')
+
+    def __init__(self, data, mime_type, size, display_data=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.digest = content_digest(data)
+        self.size = size
+        self.display_data = display_data
+
+    @property
+    def blob(self):
+        """The image as an inline payload for the Gemini SDK"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def save(self, file_path):
+        """Persist the normalized bytes (the only disk write in the pipeline)"""
+        with open(file_path, 'wb') as f:
+            f.write(self.data)
+
+
+def sniff_format(head):
+    """Identify an image format from its first SIGNATURE_BYTES bytes, or return None"""
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def read_header(data, fmt):
+    """Parse only the image header and return its (width, height); no pixels are decoded"""
+    try:
+        with Image.open(io.BytesIO(data), formats=[fmt]) as img:
+            return img.size
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageNormalizationError(f"Could not read image header: {e}") from e
+
+
+def check_pixels(size, max_pixels=MAX_INPUT_PIXELS):
+    """Reject empty images and images with more than max_pixels pixels"""
+    width, height = size
+    if width <= 0 or height <= 0:
+        raise ImageNormalizationError(f"Invalid image dimensions {width}x{height}")
+    if max_pixels and width * height > max_pixels:
+        raise ImageNormalizationError(
+            f"Image is too large ({width}x{height} pixels, the limit is {max_pixels} pixels)")
+
+
+def probe_image(data, allowed_formats=ALLOWED_FORMATS, max_pixels=MAX_INPUT_PIXELS):
+    """
+    Validate image bytes by signature and header before any decoding.
+
+    Returns (format, size). Raises ImageNormalizationError for files that are
+    not a recognised image, formats outside allowed_formats, unreadable
+    headers and images over max_pixels (decompression bombs).
+    """
+    fmt = sniff_format(data[:SIGNATURE_BYTES])
+    if fmt is None:
+        raise ImageNormalizationError("File is not a recognised image")
+    if fmt not in allowed_formats:
+        raise ImageNormalizationError(f"{fmt} images are not accepted")
+    size = read_header(data, fmt)
+    check_pixels(size, max_pixels)
+    return fmt, size
+
+
+def normalize_image(data, max_size=MODEL_MAX_SIZE, display_size=DISPLAY_MAX_SIZE,
+                    allowed_formats=ALLOWED_FORMATS, max_pixels=MAX_INPUT_PIXELS):
+    """
+    Decode image bytes once and return a NormalizedImage.
+
+    The signature and header are checked first (see probe_image), so
+    disguised files and oversized images are rejected without decoding.
+    The original bytes are passed through untouched when the image already
+    fits within max_size and needs no rotation, so small uploads are never
+    re-encoded.
+    """
+    fmt, _ = probe_image(data, allowed_formats, max_pixels)
+    try:
+        img = Image.open(io.BytesIO(data), formats=[fmt])
+        source_format = img.format
+        source_size = img.size
+
+        # Let the JPEG decoder skip detail we are about to throw away
+        if source_format == 'JPEG':
+            longest = max(max_size)
+            img.draft('RGB', (longest, longest))
+
+        rotated = img.getexif().get(EXIF_ORIENTATION, 1) != 1
+        if rotated:
+            img = ImageOps.exif_transpose(img)
+
+        if img.width > max_size[0] or img.height > max_size[1]:
+            img.thumbnail(max_size, Image.LANCZOS)
+
+        if rotated or img.size != source_size:
+            data, source_format = _encode(img, source_format)
+            logger.debug("Image normalized from %s to %s", source_size, img.size)
+        else:
+            img.load()
+            logger.debug("No resize needed, image is %s", img.size)
+
+        mime_type = Image.MIME.get(source_format, 'application/octet-stream')
+        display_data = _encode_display(img, display_size) if display_size else None
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+        raise ImageNormalizationError(f"Could not read image: {e}") from e
+
+    return NormalizedImage(data, mime_type, img.size, display_data)
+
+
+def normalize_upload(file_storage, **kwargs):
+    """Read an uploaded FileStorage stream once and normalize it"""
+    return normalize_image(file_storage.stream.read(), **kwargs)
+
+
+def load_normalized_image(file_path):
+    """Load an already-normalized image from disk without decoding its pixels"""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            return NormalizedImage(data, img.get_format_mimetype(), img.size)
+    except (OSError, SyntaxError) as e:
+        raise ImageNormalizationError(f"Could not read image: {e}") from e
+
+
+def _encode(img, source_format):
+    """Re-encode img, keeping its original format where possible"""
+    target_format = source_format if source_format in REENCODE_FORMATS else 'PNG'
+    if target_format == 'JPEG' and img.mode not in ('RGB', 'L', 'CMYK'):
+        img = img.convert('RGB')
+
+    buffer = io.BytesIO()
+    if target_format == 'JPEG':
+        img.save(buffer, format='JPEG', quality=JPEG_QUALITY)
+    else:
+        img.save(buffer, format=target_format)
+    return buffer.getvalue(), target_format
+
+
+def _encode_display(img, display_size):
+    """Small JPEG rendition of img for the results page"""
+    display = img.copy()
+    display.thumbnail(display_size, Image.LANCZOS)
+    if display.mode != 'RGB':
+        display = display.convert('RGB')
+
+    buffer = io.BytesIO()
+    display.save(buffer, format='JPEG', quality=DISPLAY_QUALITY, optimize=True)
+    return buffer.getvalue()
+
+
+def save_display_image(image, thumbnail_folder):
+    """
+    Store the display rendition of a NormalizedImage under its content digest.
+
+    The rendition is the source for every thumbnail variant; identical images
+    share one file.
+    """
+    path = os.path.join(thumbnail_folder, f"{image.digest}.jpg")
+    if image.display_data is not None and not os.path.isfile(path):
+        write_atomic(path, image.display_data)
+    return path
+
+
+def get_thumbnail(thumbnail_folder, digest, size='md', fmt='jpeg'):
+    """
+    Return the path of a thumbnail variant, rendering and caching it on first use.
+
+    Raises FileNotFoundError if no display image exists for digest.
+    """
+    if not DIGEST_PATTERN.fullmatch(digest) or size not in THUMBNAIL_SIZES or fmt not in THUMBNAIL_FORMATS:
+        raise FileNotFoundError(digest)
+
+    source = os.path.join(thumbnail_folder, f"{digest}.jpg")
+    pil_format, extension = THUMBNAIL_FORMATS[fmt]
+    max_size = THUMBNAIL_SIZES[size]
+
+    # The stored display rendition already is the full-size JPEG variant
+    if fmt == 'jpeg' and max_size == DISPLAY_MAX_SIZE:
+        if not os.path.isfile(source):
+            raise FileNotFoundError(source)
+        return source
+
+    target = os.path.join(thumbnail_folder, f"{digest}_{size}.{extension}")
+    if os.path.isfile(target):
+        return target
+
+    with Image.open(source) as img:
+        img.thumbnail(max_size, Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format=pil_format, quality=THUMBNAIL_QUALITY)
+    write_atomic(target, buffer.getvalue())
+    return target
+
@@ -0,0 +1,69 @@
+"""
+Background job queue for image analyses.
+
+Analyses are run on a bounded thread pool so that request handlers can return
+a job id immediately instead of holding a worker for the whole Gemini call.
+Job state and results are kept in the result store; the queue itself only
+counts the jobs that are queued or running, to bound them.
+"""
+
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the queue already holds the maximum number of pending jobs"""
+
+
+class JobQueue:
+    """Bounded thread pool that counts its queued and running jobs"""
+
+    def __init__(self, max_workers=4, max_pending=64):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, job_id=None, **kwargs):
+        """Queue func(*args, **kwargs) and return the job id (generated unless given)"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f"Job queue is full ({self.max_pending} pending jobs)")
+            self._pending += 1
+
+        job_id = job_id or uuid.uuid4().hex
+        try:
+            self._executor.submit(self._run, job_id, func, args, kwargs)
+        except RuntimeError:  # the executor has been shut down
+            self._finish()
+            raise
+        logger.debug("Queued analysis job %s", job_id)
+        return job_id
+
+    def pending(self):
+        """Number of jobs that are queued or running"""
+        with self._lock:
+            return self._pending
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job_id, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.error("Analysis job %s failed: %s", job_id, e)
+        else:
+            logger.debug("Analysis job %s finished", job_id)
+        finally:
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._pending -= 1
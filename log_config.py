@@ -0,0 +1,261 @@
+"""
+Process-wide logging setup: structured, leveled, sampled and asynchronous.
+
+Request threads never format or write a log line themselves. The root logger
+has a single QueueHandler that only merges the message arguments into the
+record and puts it on a bounded queue; a QueueListener thread formats it
+(JSON by default) and writes it to stderr. When the queue is full the record
+is dropped and counted rather than blocking the request.
+
+Levels are set per module from a spec such as "INFO,werkzeug=WARNING,
+imaging=DEBUG". Only one in `debug_sample` DEBUG records is kept per logger,
+so turning on DEBUG for a busy module does not flood the output. Each request
+gets a budget of `request_budget` records below WARNING; once it is used up
+the rest are dropped, so one pathological request cannot produce thousands
+of lines. The time a request spends in logging calls is measured and
+reported by `end_request()`.
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"
+QUEUE_SIZE = 10000
+
+# Noisy third-party loggers kept quiet unless the level spec mentions them
+DEFAULT_LEVELS = {"PIL": "WARNING", "urllib3": "WARNING", "werkzeug": "WARNING"}
+
+# Attributes every LogRecord has; anything else was passed through `extra=` and is included in JSON output
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+_request_budget = ContextVar("log_request_budget", default=None)
+
+_handler = None
+_listener = None
+_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, process, thread and any `extra` fields"""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class RequestBudget:
+    """Logging done by one request: records kept and dropped, and time spent in logging calls"""
+
+    __slots__ = ("remaining", "records", "dropped", "seconds")
+
+    def __init__(self, limit):
+        self.remaining = limit
+        self.records = 0
+        self.dropped = 0
+        self.seconds = 0.0
+
+
+class SamplingFilter(logging.Filter):
+    """Keep one in every `every` DEBUG records of each logger"""
+
+    def __init__(self, every=1):
+        super().__init__()
+        self.every = max(1, every)
+        self._counters = {}
+        self.dropped = 0
+
+    def filter(self, record):
+        if self.every == 1 or record.levelno > logging.DEBUG:
+            return True
+        counter = self._counters.get(record.name)
+        if counter is None:
+            counter = self._counters.setdefault(record.name, itertools.count())
+        if next(counter) % self.every == 0:
+            return True
+        self.dropped += 1
+        return False
+
+
+class AsyncHandler(QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    Records below WARNING are dropped once the current request's budget is
+    used up, and records are dropped (and counted) rather than waited for
+    when the queue is full.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.queue_dropped = 0
+
+    def handle(self, record):
+        budget = _request_budget.get()
+        if budget is None:
+            return super().handle(record)
+
+        started = time.perf_counter()
+        try:
+            if not self.filter(record):
+                return False
+            if record.levelno < logging.WARNING:
+                if budget.remaining <= 0:
+                    budget.dropped += 1
+                    return False
+                budget.remaining -= 1
+            self.emit(record)
+            budget.records += 1
+            return True
+        finally:
+            budget.seconds += time.perf_counter() - started
+
+    def prepare(self, record):
+        # Merge the arguments now (they may change after this call returns), but format nothing else.
+        # This is the root logger's only handler, so no other handler sees the record afterwards.
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= QUEUE_SIZE:
+            self.queue_dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+def parse_levels(spec):
+    """
+    Parse "LEVEL,module=LEVEL,..." into (root level or None, {module: level}).
+
+    Raises ValueError for an unknown level name.
+    """
+    root, levels = None, {}
+    for entry in spec.split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, _, level = entry.rpartition("=")
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError(f"Unknown log level {level!r}")
+        if name:
+            levels[name.strip()] = level
+        else:
+            root = level
+    return root, levels
+
+
+def configure(level="INFO", levels="", fmt="json", debug_sample=1, request_budget=0, stream=None):
+    """
+    Install the asynchronous handler on the root logger, replacing any existing handlers.
+
+    level is the root level and levels a per-module spec (see
+    parse_levels). fmt is "json" or "text". request_budget limits the
+    records below WARNING kept per request (0 for no limit).
+    """
+    global _handler, _listener
+    root_level, module_levels = parse_levels(levels)
+    stream = stream or sys.stderr
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    handler = AsyncHandler(queue.SimpleQueue())
+    handler.addFilter(SamplingFilter(debug_sample))
+    handler.request_budget = request_budget
+
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(root_level or level.upper())
+        for name, module_level in {**DEFAULT_LEVELS, **module_levels}.items():
+            logging.getLogger(name).setLevel(module_level)
+
+        _handler = handler
+        _listener = QueueListener(handler.queue, output)
+        _listener.start()
+    return handler
+
+
+def reinit():
+    """
+    Restart the listener thread in a forked child process.
+
+    Threads do not survive a fork, so without this a preloaded worker would
+    queue its records forever. The child also gets a fresh queue, since the
+    parent's may have been locked mid-operation when it forked.
+    """
+    global _listener
+    with _lock:
+        if _handler is None or _listener is None:
+            return
+        _handler.queue = queue.SimpleQueue()
+        _listener = QueueListener(_handler.queue, *_listener.handlers)
+        _listener.start()
+
+
+def shutdown():
+    """Write out queued records and stop the listener thread"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+atexit.register(shutdown)
+
+
+def start_request():
+    """Give the current request its own logging budget and cost measurement; returns it"""
+    budget = RequestBudget(_handler.request_budget if _handler and _handler.request_budget else float("inf"))
+    _request_budget.set(budget)
+    return budget
+
+
+def end_request():
+    """Stop accounting for the current request and return its RequestBudget (or None)"""
+    budget = _request_budget.get()
+    _request_budget.set(None)
+    return budget
+
+
+def stats():
+    """Records dropped because the queue was full or by DEBUG sampling, and the current queue depth"""
+    if _handler is None:
+        return {"queue_dropped": 0, "sampled_out": 0, "queue_depth": 0}
+    sampler = next((f for f in _handler.filters if isinstance(f, SamplingFilter)), None)
+    return {
+        "queue_dropped": _handler.queue_dropped,
+        "sampled_out": sampler.dropped if sampler else 0,
+        "queue_depth": _handler.queue.qsize(),
+    }
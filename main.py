@@ -1,4 +1,5 @@
 import os
+import sys
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -10,7 +11,18 @@ else:
     print("Warning: .env file not found. Make sure to set up your environment variables!")
 
 # Import the Flask app after loading environment variables
-from app import app
+from app import app, startup_check, warm_up
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # `python main.py --check` verifies the configuration and exits (non-zero on problems)
+    if "--check" in sys.argv[1:]:
+        problems = startup_check()
+        for problem in problems:
+            print(f"Startup check failed: {problem}")
+        if not problems:
+            print("Startup check passed")
+        sys.exit(1 if problems else 0)
+
+    # Development server only; use `gunicorn -c gunicorn.conf.py main:app` in production
+    warm_up()
+    app.run(host="0.0.0.0", port=5000, debug=os.environ.get("FLASK_DEBUG", "").lower() in ("1", "true", "yes"))
@@ -0,0 +1,340 @@
+"""
+Request timing spans and counters in Prometheus text format.
+
+`span(stage)` times one stage of the work (receiving the upload,
+normalization, storage, the model call, parsing, rendering, ...) into the
+`deepfake_stage_seconds` histogram, and also records it against the current
+request so the app can report it in a `Server-Timing` header.
+
+Each worker process keeps its own registry. With a snapshot directory
+configured, every process periodically writes its counters and histograms
+there and `render()` adds up all snapshots, so a scrape of any one worker
+reports totals for the whole server. Gauges always describe the process
+that answered the scrape.
+
+When a worker exits, `mark_process_dead(pid)` (gunicorn's child_exit hook)
+folds its snapshot into `aggregate.json` and removes it, so counts of
+recycled workers do not pile up as files and are not lost or lowered when
+a new worker gets the same pid. A process also folds a snapshot left under
+its own pid before writing its first one.
+"""
+
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from storage import write_atomic
+
+try:
+    import fcntl
+except ImportError:  # Windows: no gunicorn workers to coordinate
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PREFIX = "deepfake_"
+
+# Counters and histograms of workers that have exited, in snapshot format
+AGGREGATE_FILE = "aggregate.json"
+
+_request_timings = ContextVar("request_timings", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _combine(snapshots):
+    """Add up snapshots into {(name, labels): value} counters and {(name, labels): [counts, sum, count]} histograms"""
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get("counters", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, counts, total, count in snapshot.get("histograms", []):
+            key = (name, tuple(tuple(pair) for pair in labels))
+            merged = histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+            if len(merged[0]) != len(counts):
+                continue  # written with a different bucket layout
+            merged[0] = [a + b for a, b in zip(merged[0], counts)]
+            merged[1] += total
+            merged[2] += count
+    return counters, histograms
+
+
+@contextmanager
+def _aggregate_lock(directory):
+    """Serialize updates of the aggregate snapshot between processes"""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, "aggregate.lock"), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Registry:
+    """Thread-safe counters, histograms and gauges for one process"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, snapshot_dir=None, flush_interval=5.0):
+        self.buckets = tuple(buckets)
+        self.snapshot_dir = snapshot_dir
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._last_flush = 0.0
+        self._flushed_pid = None
+
+        if snapshot_dir:
+            os.makedirs(snapshot_dir, exist_ok=True)
+
+    def describe(self, name, kind, text):
+        """Register the TYPE and HELP lines for a metric"""
+        self._help[PREFIX + name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter"""
+        key = _key(PREFIX + name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram"""
+        key = _key(PREFIX + name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = histogram[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, func, **labels):
+        """Register a callable evaluated at scrape time"""
+        with self._lock:
+            self._gauges[_key(PREFIX + name, labels)] = func
+
+    def snapshot(self):
+        """Counters and histograms as plain JSON-compatible data"""
+        with self._lock:
+            return {
+                "counters": [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                "histograms": [
+                    [name, list(labels), list(counts), total, count]
+                    for (name, labels), (counts, total, count) in self._histograms.items()
+                ],
+            }
+
+    def flush(self, force=False):
+        """Write this process's snapshot to the snapshot directory (at most every flush_interval seconds)"""
+        if not self.snapshot_dir:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        pid = os.getpid()
+        if pid != self._flushed_pid:
+            # A snapshot under this pid belongs to an earlier process whose exit was not recorded
+            mark_process_dead(pid, self.snapshot_dir)
+            self._flushed_pid = pid
+        try:
+            path = os.path.join(self.snapshot_dir, f"{pid}.json")
+            write_atomic(path, json.dumps(self.snapshot()).encode("utf-8"))
+        except OSError as e:
+            logger.error("Could not write metrics snapshot: %s", e)
+
+    def _collect(self):
+        """Merge this process's snapshot with those written by other workers"""
+        if not self.snapshot_dir:
+            return [self.snapshot()]
+        self.flush(force=True)
+        snapshots = []
+        for path in glob.glob(os.path.join(self.snapshot_dir, "*.json")):
+            try:
+                with open(path, "rb") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue  # a worker is rewriting it or it was just removed
+        return snapshots
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        counters, histograms = _combine(self._collect())
+        histograms = {key: value for key, value in histograms.items() if len(value[0]) == len(self.buckets)}
+
+        with self._lock:
+            gauges = dict(self._gauges)
+
+        lines = []
+        for kind, series in (("counter", counters), ("histogram", histograms), ("gauge", gauges)):
+            for name in sorted({name for name, _ in series}):
+                _, text = self._help.get(name, (kind, name))
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (series_name, labels), value in sorted(series.items(), key=lambda item: item[0]):
+                    if series_name != name:
+                        continue
+                    if kind == "histogram":
+                        lines.extend(self._render_histogram(name, labels, value))
+                        continue
+                    if kind == "gauge":
+                        try:
+                            value = value()
+                        except Exception as e:
+                            logger.error("Gauge %s failed: %s", name, e)
+                            continue
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def _render_histogram(self, name, labels, histogram):
+        counts, total, count = histogram
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            yield f"{name}_bucket{_format_labels(labels, [('le', _format_value(bound))])} {cumulative}"
+        yield f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}"
+        yield f"{name}_sum{_format_labels(labels)} {_format_value(total)}"
+        yield f"{name}_count{_format_labels(labels)} {count}"
+
+
+registry = Registry()
+
+registry.describe("stage_seconds", "histogram", "Time spent in each stage of handling an analysis")
+
+
+def configure(snapshot_dir=None, flush_interval=5.0, buckets=DEFAULT_BUCKETS):
+    """Replace the process-wide registry, e.g. to share snapshots between workers"""
+    global registry
+    help_lines = registry._help
+    registry = Registry(buckets=buckets, snapshot_dir=snapshot_dir, flush_interval=flush_interval)
+    registry._help.update(help_lines)
+    return registry
+
+
+def describe(name, kind, text):
+    registry.describe(name, kind, text)
+
+
+def inc(name, value=1, **labels):
+    registry.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+
+def start_request():
+    """Begin collecting spans for the current request; returns the list they are added to"""
+    timings = []
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def span(stage):
+    """Time a block into the stage histogram and the current request's timings"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        registry.observe("stage_seconds", elapsed, stage=stage)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings.append((stage, elapsed))
+
+
+def server_timing(timings, total=None):
+    """Format request timings as a Server-Timing header value (durations in milliseconds)"""
+    durations = {}
+    for stage, elapsed in timings:
+        durations[stage] = durations.get(stage, 0.0) + elapsed
+    entries = [f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in durations.items()]
+    if total is not None:
+        entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def flush(force=False):
+    """Write this process's snapshot if one is due (or now, with force)"""
+    registry.flush(force)
+
+
+def mark_process_dead(pid, snapshot_dir=None):
+    """
+    Fold the snapshot of an exited process into the aggregate snapshot and
+    remove it. snapshot_dir defaults to the registry's.
+    """
+    snapshot_dir = snapshot_dir or registry.snapshot_dir
+    if not snapshot_dir:
+        return
+    path = os.path.join(snapshot_dir, f"{pid}.json")
+    aggregate_path = os.path.join(snapshot_dir, AGGREGATE_FILE)
+    try:
+        with _aggregate_lock(snapshot_dir):
+            try:
+                with open(path, "rb") as f:
+                    snapshot = json.load(f)
+            except FileNotFoundError:
+                return
+            except ValueError as e:
+                logger.error("Discarding unreadable metrics snapshot %s: %s", path, e)
+                os.remove(path)
+                return
+            try:
+                with open(aggregate_path, "rb") as f:
+                    aggregate = json.load(f)
+            except FileNotFoundError:
+                aggregate = {}
+            counters, histograms = _combine([aggregate, snapshot])
+            write_atomic(aggregate_path, json.dumps({
+                "counters": [[name, list(labels), value] for (name, labels), value in counters.items()],
+                "histograms": [
+                    [name, list(labels), counts, total, count]
+                    for (name, labels), (counts, total, count) in histograms.items()
+                ],
+            }).encode("utf-8"))
+            os.remove(path)
+    except (OSError, ValueError) as e:
+        logger.error("Could not fold metrics snapshot of process %s: %s", pid, e)
+
+
+def render():
+    return registry.render()
@@ -0,0 +1,322 @@
+"""
+Routing of analysis calls across several Gemini models.
+
+One slow or failing model should not fail or stall a request. The router
+holds an ordered list of ModelRoutes (name, per-call timeout, relative cost)
+and keeps recent latency and error statistics for each. Three strategies:
+
+- fallback: try the models in order until one answers.
+- hedge: start the first model; if it has not answered within its latency
+  budget (the configured hedge delay, or the observed p95 once enough calls
+  have been seen), start the next one as well and take whichever answers
+  first.
+- ensemble: call several models at once and combine their verdicts by vote.
+
+Models whose recent error rate is above max_error_rate are tried last, and
+hedges and ensemble members are only added while the request stays within
+max_cost. Every call goes through the shared ModelRegistry, so the rate
+limiter and retry policy apply as before.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+STRATEGIES = ("fallback", "hedge", "ensemble")
+
+# Calls remembered per model for the latency and error statistics
+STATS_WINDOW = 200
+# Successful calls needed before the observed p95 replaces the configured hedge delay
+MIN_SAMPLES = 20
+
+CONFIDENCE_RANKS = {"low": 0, "medium": 1, "high": 2}
+
+
+class ModelRoute:
+    """One model the router may call, with its per-call timeout and relative cost"""
+
+    __slots__ = ('name', 'timeout', 'cost', 'hedge_after')
+
+    def __init__(self, name, timeout=60.0, cost=1.0, hedge_after=None):
+        self.name = name
+        self.timeout = timeout
+        self.cost = cost
+        self.hedge_after = hedge_after
+
+    def __repr__(self):
+        return f"ModelRoute({self.name!r}, timeout={self.timeout}, cost={self.cost})"
+
+
+def parse_routes(spec, default_timeout=60.0):
+    """
+    Parse a route list such as "gemini-1.5-flash:timeout=20:cost=1,gemini-1.5-pro:timeout=60:cost=4".
+
+    Each entry is a model name optionally followed by `:key=value` options
+    (timeout, cost and hedge_after, in seconds or relative units).
+    """
+    routes = []
+    for entry in spec.split(","):
+        name, *options = entry.strip().split(":")
+        if not name:
+            continue
+        settings = {"timeout": default_timeout}
+        for option in options:
+            key, _, value = option.partition("=")
+            if key not in ("timeout", "cost", "hedge_after") or not value:
+                raise ValueError(f"Invalid option {option!r} for model {name!r}")
+            settings[key] = float(value)
+        routes.append(ModelRoute(name, **settings))
+    if not routes:
+        raise ValueError("At least one model is required")
+    return routes
+
+
+class ModelStats:
+    """Latencies and outcomes of a model's most recent calls"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self._latencies = deque(maxlen=window)
+        self._outcomes = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, elapsed, ok):
+        with self._lock:
+            self.calls += 1
+            self._outcomes.append(ok)
+            if ok:
+                self._latencies.append(elapsed)
+            else:
+                self.errors += 1
+
+    def percentile(self, pct):
+        """Latency percentile of recent successful calls, or None without enough samples"""
+        with self._lock:
+            if len(self._latencies) < MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+    def error_rate(self):
+        with self._lock:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "error_rate": round(self.error_rate(), 4),
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+        }
+
+
+class ModelRouter:
+    """Sends each analysis to one or more models according to the routing strategy"""
+
+    def __init__(self, registry, routes, strategy="fallback", ensemble_size=2, max_cost=0.0,
+                 max_error_rate=0.5, max_workers=16, observer=None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown routing strategy {strategy!r}, expected one of {', '.join(STRATEGIES)}")
+        self.registry = registry
+        self.routes = list(routes)
+        self.strategy = strategy
+        self.ensemble_size = max(1, ensemble_size)
+        self.max_cost = max_cost
+        self.max_error_rate = max_error_rate
+        self.observer = observer
+
+        self.stats = {route.name: ModelStats() for route in self.routes}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model-router")
+
+    @property
+    def primary(self):
+        return self.routes[0].name
+
+    @property
+    def key(self):
+        """Identifies the set of models that may answer, e.g. for cache keys"""
+        if self.strategy == "fallback" and len(self.routes) == 1:
+            return self.primary
+        return f"{self.strategy}:" + "+".join(route.name for route in self.routes)
+
+    def ordered_routes(self):
+        """Configured order, with models above max_error_rate moved to the end"""
+        healthy = [route for route in self.routes if self.stats[route.name].error_rate() <= self.max_error_rate]
+        return healthy + [route for route in self.routes if route not in healthy]
+
+    def hedge_delay(self, route):
+        """Seconds to wait for route before hedging: observed p95, else the configured delay, else half the timeout"""
+        observed = self.stats[route.name].percentile(95)
+        if observed is not None:
+            return observed
+        return route.hedge_after if route.hedge_after is not None else route.timeout / 2
+
+    def generate(self, contents, parse, on_partial=None, **kwargs):
+        """
+        Run the analysis and return the parsed result of the answering model(s).
+
+        parse(text) turns a reply into a result dict; the result gains a
+        `model` key naming the model that produced it. With on_partial the
+        models are tried in order with streaming (hedging and voting need
+        complete replies); when one fails mid-reply, on_partial("") signals that
+        the next model starts over. Raises the last error if every model failed.
+        """
+        if on_partial is not None or self.strategy == "fallback" or len(self.routes) == 1:
+            return self._fallback(contents, parse, on_partial, kwargs)
+        if self.strategy == "hedge":
+            return self._hedge(contents, parse, kwargs)
+        return self._ensemble(contents, parse, kwargs)
+
+    def snapshot(self):
+        return {route.name: self.stats[route.name].snapshot() for route in self.routes}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _call(self, route, contents, parse, kwargs, on_partial=None):
+        """One call to one model, recorded in its statistics"""
+        options = dict(kwargs)
+        options["request_options"] = {"timeout": route.timeout, "retry": None}
+        started = time.monotonic()
+        try:
+            if on_partial is not None:
+                text = ""
+                for chunk in self.registry.generate(route.name, contents, stream=True, **options):
+                    try:
+                        chunk_text = chunk.text
+                    except ValueError:
+                        continue  # a chunk without text parts (e.g. only safety ratings)
+                    if not chunk_text:
+                        continue  # on_partial("") means the reply starts over
+                    text += chunk_text
+                    on_partial(text)
+            else:
+                text = self.registry.generate(route.name, contents, **options).text
+        except Exception as e:
+            elapsed = time.monotonic() - started
+            self.stats[route.name].record(elapsed, ok=False)
+            if self.observer is not None:
+                self.observer(route.name, elapsed, None, e)
+            raise
+
+        elapsed = time.monotonic() - started
+        self.stats[route.name].record(elapsed, ok=True)
+        if self.observer is not None:
+            self.observer(route.name, elapsed, text, None)
+        return {**parse(text), "model": route.name}
+
+    def _fallback(self, contents, parse, on_partial, kwargs):
+        last_error = None
+        for route in self.ordered_routes():
+            try:
+                return self._call(route, contents, parse, kwargs, on_partial)
+            except Exception as e:
+                last_error = e
+                logger.warning("Model %s failed, trying the next one: %s", route.name, e)
+                if on_partial is not None:
+                    on_partial("")  # the next model starts its reply from scratch
+        raise last_error
+
+    def _affordable(self, routes, spent):
+        """Routes that can still be called without exceeding max_cost"""
+        for route in routes:
+            if self.max_cost and spent + route.cost > self.max_cost:
+                continue
+            yield route
+
+    def _hedge(self, contents, parse, kwargs):
+        ordered = self.ordered_routes()
+        first, rest = ordered[0], ordered[1:]
+        spent = first.cost
+        pending = {self._executor.submit(self._call, first, contents, parse, kwargs): first}
+        latest = first
+        last_error = None
+
+        while pending:
+            # Only wait out the latency budget while there is another model to hedge with
+            budget = self.hedge_delay(latest) if rest else None
+            done, _ = wait(pending, timeout=budget, return_when=FIRST_COMPLETED)
+            for future in done:
+                route = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+                    logger.warning("Model %s failed: %s", route.name, e)
+
+            if rest and (not done or not pending):
+                # Over budget, or everything in flight failed: start the next affordable model
+                candidates = list(self._affordable(rest, spent))
+                rest = rest[rest.index(candidates[0]) + 1:] if candidates else []
+                if candidates:
+                    latest = candidates[0]
+                    spent += latest.cost
+                    if not done:
+                        logger.info("Hedging with %s: no reply within %.2fs", latest.name, budget)
+                    pending[self._executor.submit(self._call, latest, contents, parse, kwargs)] = latest
+        # Calls still running after we return are abandoned; they finish in the background
+        raise last_error
+
+    def _ensemble(self, contents, parse, kwargs):
+        members, spent = [], 0.0
+        for route in self.ordered_routes():
+            if self.max_cost and spent + route.cost > self.max_cost:
+                continue  # checked against the running total, so the members together stay within max_cost
+            members.append(route)
+            spent += route.cost
+            if len(members) == self.ensemble_size:
+                break
+        if not members:
+            members = self.ordered_routes()[:1]  # the budget always allows one call
+
+        futures = {self._executor.submit(self._call, route, contents, parse, kwargs): route for route in members}
+        results, last_error = [], None
+        for future, route in futures.items():
+            try:
+                results.append(future.result())
+            except Exception as e:
+                last_error = e
+                logger.warning("Ensemble member %s failed: %s", route.name, e)
+        if not results:
+            raise last_error
+        return vote(results)
+
+
+def vote(results):
+    """
+    Combine the verdicts of several models.
+
+    The majority verdict wins; a tie goes to the side with the more confident
+    votes. The analysis and confidence come from the most confident model on
+    the winning side, lowered to Low when the models disagree evenly. Each
+    model's verdict is listed under `votes`.
+    """
+    decided = [result for result in results if result.get("is_deepfake") is not None]
+    if not decided:
+        return dict(results[0])
+
+    def strength(side):
+        return len(side), sum(CONFIDENCE_RANKS.get(str(r.get("confidence", "")).lower(), 1) for r in side)
+
+    flagged = [result for result in decided if result["is_deepfake"]]
+    cleared = [result for result in decided if not result["is_deepfake"]]
+    winners = flagged if strength(flagged) >= strength(cleared) else cleared
+    best = max(winners, key=lambda r: CONFIDENCE_RANKS.get(str(r.get("confidence", "")).lower(), 1))
+
+    combined = dict(best)
+    if len(winners) * 2 == len(decided):
+        combined["confidence"] = "Low"
+    combined["model"] = "+".join(result["model"] for result in decided)
+    combined["votes"] = [
+        {"model": result["model"], "is_deepfake": result["is_deepfake"], "confidence": result.get("confidence")}
+        for result in results
+    ]
+    return combined
@@ -0,0 +1,175 @@
+"""
+Adaptive resolution and encoding of the images sent to the model.
+
+Normalized uploads keep their original format at up to 1024x1024, so a PNG
+screenshot can be several megabytes on every model call. The payload policy
+re-encodes each image for the model alone (the stored image, its digest and
+everything keyed on it are unchanged):
+
+- Content type is guessed from a small nearest-neighbour sample: few
+  distinct colours means a graphic (UI, text, diagrams), anything else is a
+  photo. JPEG sources are always photos: heavy JPEG compression leaves a
+  photo with few colours, and its blocky artifacts make lossless WebP
+  large.
+- Photos are resized to `max_size` and encoded lossy (JPEG or WebP),
+  lowering the quality step by step, then the size, until the image fits
+  the per-image `byte_budget`.
+- Graphics are tried as lossless WebP first, which keeps edges sharp and is
+  usually far smaller than PNG, and fall back to the lossy steps if that is
+  still over budget.
+- JPEG and WebP images that already fit the size and the budget are sent
+  untouched, so they are never re-compressed, and so is any image whose
+  re-encoding comes out no smaller (e.g. a heavily compressed JPEG).
+
+When the compact payload produces an inconclusive or low-confidence
+verdict, `should_escalate` tells the caller to ask again with the full
+normalized images.
+"""
+
+import io
+import logging
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from imaging import NormalizedImage
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+
+# Nearest-neighbour sample used to tell graphics from photos
+SAMPLE_SIZE = (64, 64)
+QUALITY_STEP = 10
+SHRINK_FACTOR = 0.8
+MIN_SIDE = 384
+
+ENCODED_CACHE_SIZE = 128
+
+
+class PayloadPolicy:
+    """Chooses the resolution, format and quality of each image sent to the model"""
+
+    def __init__(self, max_size=(768, 768), byte_budget=256 * 1024, photo_format='jpeg', quality=85,
+                 min_quality=60, graphic_colors=256, escalate=True):
+        if photo_format not in FORMATS:
+            raise ValueError(f"Unknown payload format {photo_format!r}, expected one of {', '.join(FORMATS)}")
+        self.max_size = tuple(max_size)
+        self.byte_budget = byte_budget
+        self.photo_format = photo_format
+        self.quality = quality
+        self.min_quality = min(min_quality, quality)
+        self.graphic_colors = graphic_colors
+        self.escalate = escalate
+
+        self._encoded = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        """Identifies the policy's settings, e.g. for cache keys"""
+        return (f"{self.max_size[0]}x{self.max_size[1]}-{self.byte_budget // 1024}k-"
+                f"{self.photo_format}-q{self.quality}-{self.min_quality}")
+
+    def classify(self, img):
+        """'graphic' for images with few distinct colours, otherwise (and always for JPEGs) 'photo'"""
+        if img.format == 'JPEG':
+            return 'photo'
+        sample = img.resize(SAMPLE_SIZE, Image.NEAREST).convert('RGB')
+        return 'graphic' if sample.getcolors(self.graphic_colors) is not None else 'photo'
+
+    def encode(self, image):
+        """
+        The NormalizedImage to send to the model in place of image.
+
+        Results are cached per digest, so a reference compared many times is
+        only encoded once.
+        """
+        with self._lock:
+            cached = self._encoded.get(image.digest)
+            if cached is not None:
+                self._encoded.move_to_end(image.digest)
+                return cached
+
+        try:
+            payload = self.reencode(image)
+        except (OSError, ValueError, KeyError) as e:  # KeyError: Pillow built without WebP
+            logger.warning("Could not re-encode %s for the model, sending it as is: %s", image.digest[:12], e)
+            payload = image
+
+        with self._lock:
+            self._encoded[image.digest] = payload
+            while len(self._encoded) > ENCODED_CACHE_SIZE:
+                self._encoded.popitem(last=False)
+        return payload
+
+    def should_escalate(self, result):
+        """Whether a verdict from the compact payload is worth repeating with the full images"""
+        if not self.escalate or result.get("error"):
+            return False
+        return result.get("is_deepfake") is None or str(result.get("confidence", "")).lower() == "low"
+
+    def _fits(self, size):
+        return size[0] <= self.max_size[0] and size[1] <= self.max_size[1]
+
+    def reencode(self, image):
+        """Like encode, but always does the work and leaves the cache alone"""
+        with Image.open(io.BytesIO(image.data)) as img:
+            if img.format in ('JPEG', 'WEBP') and self._fits(img.size) and len(image.data) <= self.byte_budget:
+                return image
+
+            if img.format == 'JPEG':
+                img.draft('RGB', self.max_size)
+            content = self.classify(img)
+            img = _flatten(img)
+        if not self._fits(img.size):
+            img.thumbnail(self.max_size, Image.LANCZOS, reducing_gap=3.0)
+
+        if content == 'graphic':
+            data = _save(img, 'WEBP', lossless=True)
+            if len(data) <= self.byte_budget:
+                return self._smaller(image, NormalizedImage(data, 'image/webp', img.size))
+
+        fmt, mime_type = FORMATS[self.photo_format]
+        while True:
+            quality = self.quality
+            while True:
+                data = _save(img, fmt, quality=quality)
+                if len(data) <= self.byte_budget or quality <= self.min_quality:
+                    break
+                quality = max(self.min_quality, quality - QUALITY_STEP)
+            if len(data) <= self.byte_budget or min(img.size) * SHRINK_FACTOR < MIN_SIDE:
+                break
+            img = img.resize((round(img.width * SHRINK_FACTOR), round(img.height * SHRINK_FACTOR)), Image.LANCZOS)
+
+        logger.debug("Payload for %s: %s %s q%s, %s -> %s bytes", image.digest[:12], content, img.size,
+                     quality, len(image.data), len(data))
+        return self._smaller(image, NormalizedImage(data, mime_type, img.size))
+
+    def _smaller(self, image, payload):
+        """payload, unless it is not actually smaller than the image it replaces"""
+        if len(payload.data) < len(image.data):
+            return payload
+        logger.debug("Payload for %s is not smaller (%s >= %s bytes), sending the original",
+                     image.digest[:12], len(payload.data), len(image.data))
+        return image
+
+
+def _flatten(img):
+    """RGB (or L) copy of img, with any transparency composited onto white"""
+    if img.mode in ('RGB', 'L'):
+        return img.copy()
+    if img.mode in ('P', 'LA', 'PA') or 'transparency' in img.info:
+        img = img.convert('RGBA')
+    if img.mode == 'RGBA':
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img.convert('RGB')
+
+
+def _save(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **options)
+    return buffer.getvalue()
@@ -0,0 +1,229 @@
+"""
+Client-side rate and concurrency limiting for model calls.
+
+A token bucket caps the request rate and a lease table caps how many calls
+are in flight. With a db_path the state lives in a SQLite file, so every
+worker process on the machine draws from the same budget; each acquisition
+is one short `BEGIN IMMEDIATE` transaction. Leases expire after lease_ttl
+seconds so a crashed worker cannot hold a slot forever.
+
+Callers that cannot get a slot in time get RateLimitExceeded (an
+OverloadedError) carrying a Retry-After hint, instead of piling up.
+"""
+
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# How long to wait before re-checking when every in-flight slot is taken
+IN_FLIGHT_POLL_INTERVAL = 0.05
+
+
+class OverloadedError(Exception):
+    """The model cannot take more work right now; retry after retry_after seconds"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class RateLimitExceeded(OverloadedError):
+    """No limiter slot became free in time, or too many callers were already waiting"""
+
+
+class RateLimiter:
+    """Token bucket plus max-in-flight cap, per process or shared through SQLite"""
+
+    def __init__(self, rate=0.0, burst=None, max_in_flight=0, max_waiting=32, db_path=None,
+                 lease_ttl=300.0, name="gemini"):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.lease_ttl = lease_ttl
+        self.name = name
+        self.db_path = db_path
+
+        self._lock = threading.Lock()
+        self._db = None
+        self._tokens = self.burst
+        self._updated = time.time()
+        self._leases = {}
+        self._waiting = 0
+
+        self.granted = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        """Open (and create if needed) the shared limiter state"""
+        try:
+            directory = os.path.dirname(os.path.abspath(db_path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "id TEXT PRIMARY KEY, name TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            logger.info("Rate limiter state shared through %s", db_path)
+        except sqlite3.Error as e:
+            logger.error("Could not open rate limiter database %s: %s", db_path, e)
+            self._db = None
+
+    def reopen(self):
+        """
+        Open a fresh database connection, e.g. in a worker forked from a process
+        that already held one. The inherited connection is abandoned, not closed,
+        because closing it would release the parent's locks.
+        """
+        with self._lock:
+            if self.db_path:
+                self._open_db(self.db_path)
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a slot and return its lease id.
+
+        Raises RateLimitExceeded if no slot frees up within timeout seconds,
+        or straight away if max_waiting callers in this process are already
+        waiting.
+        """
+        with self._lock:
+            if self.max_waiting and self._waiting >= self.max_waiting:
+                self.rejected += 1
+                raise RateLimitExceeded(f"{self._waiting} calls already waiting for the model")
+            self._waiting += 1
+
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        try:
+            while True:
+                lease, wait = self._try_acquire()
+                now = time.monotonic()
+                if lease is not None:
+                    with self._lock:
+                        self.granted += 1
+                        self.wait_seconds += now - started
+                    return lease
+
+                if deadline is not None and now + wait > deadline:
+                    with self._lock:
+                        self.rejected += 1
+                    raise RateLimitExceeded("Timed out waiting for a model call slot", retry_after=wait)
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self, lease):
+        """Return an in-flight slot"""
+        with self._lock:
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM leases WHERE id = ?", (lease,))
+                    return
+                except sqlite3.Error as e:
+                    logger.error("Error releasing rate limiter lease: %s", e)
+            self._leases.pop(lease, None)
+
+    @contextmanager
+    def slot(self, timeout=None):
+        """Hold a slot for the duration of a with block"""
+        lease = self.acquire(timeout)
+        try:
+            yield lease
+        finally:
+            self.release(lease)
+
+    def stats(self):
+        """Return grant/reject counters and current usage"""
+        with self._lock:
+            in_flight = len(self._leases)
+            if self._db is not None:
+                try:
+                    in_flight = self._db.execute(
+                        "SELECT COUNT(*) FROM leases WHERE name = ? AND expires >= ?", (self.name, time.time())
+                    ).fetchone()[0]
+                except sqlite3.Error:
+                    pass
+            return {
+                "granted": self.granted,
+                "rejected": self.rejected,
+                "waiting": self._waiting,
+                "in_flight": in_flight,
+                "average_wait": (self.wait_seconds / self.granted) if self.granted else 0.0,
+                "shared": self._db is not None,
+            }
+
+    def _decide(self, tokens, updated, active, now):
+        """Refill the bucket and return (granted, tokens, seconds to wait before retrying)"""
+        if self.rate > 0:
+            tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+        if self.max_in_flight and active >= self.max_in_flight:
+            return False, tokens, IN_FLIGHT_POLL_INTERVAL
+        if self.rate > 0:
+            if tokens < 1:
+                return False, tokens, (1 - tokens) / self.rate
+            tokens -= 1
+        return True, tokens, 0.0
+
+    def _try_acquire(self):
+        """Take a slot if one is free; return (lease or None, seconds to wait)"""
+        now = time.time()
+        with self._lock:
+            if self._db is not None:
+                try:
+                    return self._db_try_acquire(now)
+                except sqlite3.Error as e:
+                    logger.error("Rate limiter database error, using per-process limits: %s", e)
+
+            self._leases = {lease: expires for lease, expires in self._leases.items() if expires >= now}
+            granted, self._tokens, wait = self._decide(self._tokens, self._updated, len(self._leases), now)
+            self._updated = now
+            if not granted:
+                return None, wait
+            lease = uuid.uuid4().hex
+            self._leases[lease] = now + self.lease_ttl
+            return lease, 0.0
+
+    def _db_try_acquire(self, now):
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM leases WHERE name = ? AND expires < ?", (self.name, now))
+            active = db.execute("SELECT COUNT(*) FROM leases WHERE name = ?", (self.name,)).fetchone()[0]
+            row = db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (self.name,)).fetchone()
+            tokens, updated = row if row is not None else (self.burst, now)
+
+            granted, tokens, wait = self._decide(tokens, updated, active, now)
+            db.execute(
+                "INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                (self.name, tokens, now),
+            )
+            lease = None
+            if granted:
+                lease = uuid.uuid4().hex
+                db.execute(
+                    "INSERT INTO leases (id, name, expires) VALUES (?, ?, ?)",
+                    (lease, self.name, now + self.lease_ttl),
+                )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        return lease, wait
@@ -0,0 +1,197 @@
+"""
+Registry of known-authentic reference images.
+
+Investigators compare many suspects against the same reference photos. A
+reference is uploaded once: it is normalized, stored outside the retention
+janitor's reach under its content digest, and its comparison features (the
+pre-screen fingerprint, and face detections when face cropping is
+enabled) are computed and saved with it. Later comparisons pass a
+`reference_id` instead of re-uploading the image; the normalized bytes and
+features are loaded from the registry (and cached per process), so nothing
+is decoded, resized or stored again.
+
+Database functions must be called inside a Flask application context.
+"""
+
+import json
+import logging
+import os
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy.exc import IntegrityError
+
+from imaging import NormalizedImage, load_normalized_image
+from result_store import _utcnow, db
+from storage import write_atomic
+
+try:
+    import prescreen
+except ImportError:  # NumPy is not installed
+    prescreen = None
+
+logger = logging.getLogger(__name__)
+
+# Loaded references kept in memory per process
+LOADED_CACHE_SIZE = 32
+
+_loaded = OrderedDict()
+_loaded_lock = threading.Lock()
+
+
+class Reference(db.Model):
+    """A registered reference image and its precomputed features"""
+
+    __tablename__ = "reference_images"
+
+    id = db.Column(db.String(32), primary_key=True)
+    label = db.Column(db.String(128))
+    digest = db.Column(db.String(64), nullable=False, unique=True, index=True)
+    mime_type = db.Column(db.String(32), nullable=False)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    features = db.Column(db.Text, nullable=False, default="{}")
+    created_at = db.Column(db.DateTime, nullable=False, default=_utcnow)
+    last_used_at = db.Column(db.DateTime)
+    use_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "label": self.label,
+            "digest": self.digest,
+            "width": self.width,
+            "height": self.height,
+            "features": sorted(json.loads(self.features or "{}")),
+            "created_at": self.created_at.isoformat() + "Z",
+            "last_used_at": self.last_used_at.isoformat() + "Z" if self.last_used_at else None,
+            "use_count": self.use_count,
+        }
+
+
+def compute_features(image):
+    """Comparison features of a NormalizedImage that can be computed ahead of time"""
+    features = {}
+    if prescreen is not None:
+        features["fingerprint"] = prescreen.fingerprint_to_dict(prescreen.fingerprint(image))
+    # Faces are only detected where face cropping has loaded the faces module (OpenCV is slow to import)
+    faces = sys.modules.get("faces")
+    if faces is not None:
+        features["faces"] = faces.regions_to_list(faces.detect_faces(image))
+    return features
+
+
+def _display_path(store, digest):
+    return store.path_for(digest, 'display.jpg')
+
+
+def register(image, store, label=None, reference_id=None):
+    """
+    Store a normalized image as a reference and return (Reference, created).
+
+    An image that is already registered (same digest) is returned as is,
+    also when a concurrent registration of it commits first.
+    """
+    existing = Reference.query.filter_by(digest=image.digest).first()
+    if existing is not None:
+        return existing, False
+
+    store.put(image)
+    if image.display_data is not None:
+        write_atomic(_display_path(store, image.digest), image.display_data)
+
+    record = Reference(
+        id=reference_id or uuid.uuid4().hex,
+        label=label,
+        digest=image.digest,
+        mime_type=image.mime_type,
+        width=image.size[0],
+        height=image.size[1],
+        features=json.dumps(compute_features(image)),
+    )
+    db.session.add(record)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        existing = Reference.query.filter_by(digest=image.digest).first()
+        if existing is None:
+            raise
+        return existing, False
+    logger.info("Registered reference %s (%s)", record.id, image.digest[:12])
+    return record, True
+
+
+def get_reference(reference_id):
+    if not reference_id:
+        return None
+    return db.session.get(Reference, reference_id)
+
+
+def list_references(limit=50, offset=0):
+    """Most recently used references first"""
+    query = Reference.query.order_by(Reference.last_used_at.desc().nullslast(), Reference.created_at.desc())
+    return query.offset(offset).limit(limit).all()
+
+
+def delete_reference(reference_id, store):
+    """Remove a reference and its stored files; returns False if it did not exist"""
+    record = get_reference(reference_id)
+    if record is None:
+        return False
+    for path in (store.find(record.digest), _display_path(store, record.digest)):
+        if path and os.path.isfile(path):
+            os.remove(path)
+    db.session.delete(record)
+    db.session.commit()
+    with _loaded_lock:
+        _loaded.pop(reference_id, None)
+    return True
+
+
+def load_reference(reference_id, store):
+    """
+    Return the NormalizedImage of a registered reference, or None if unknown.
+
+    The image is read from the registry (with its display rendition) and its
+    saved features are put into the pre-screen and face detection caches.
+    Loaded references are kept in a small per-process cache.
+    """
+    record = get_reference(reference_id)
+    if record is None:
+        return None
+    record.use_count = (record.use_count or 0) + 1
+    record.last_used_at = _utcnow()
+    db.session.commit()
+
+    with _loaded_lock:
+        image = _loaded.get(reference_id)
+        if image is not None:
+            _loaded.move_to_end(reference_id)
+            return image
+
+    path = store.find(record.digest)
+    if path is None:
+        logger.error("Reference %s is registered but its image is missing", reference_id)
+        return None
+    image = load_normalized_image(path)
+    display_path = _display_path(store, record.digest)
+    if os.path.isfile(display_path):
+        with open(display_path, 'rb') as f:
+            image = NormalizedImage(image.data, image.mime_type, image.size, f.read())
+
+    features = json.loads(record.features or "{}")
+    if prescreen is not None and "fingerprint" in features:
+        prescreen.remember(prescreen.fingerprint_from_dict(record.digest, features["fingerprint"]))
+    # Face detections are only needed where face cropping has loaded the faces module
+    faces = sys.modules.get("faces")
+    if faces is not None and "faces" in features:
+        faces.remember(record.digest, faces.regions_from_list(features["faces"]))
+
+    with _loaded_lock:
+        _loaded[reference_id] = image
+        while len(_loaded) > LOADED_CACHE_SIZE:
+            _loaded.popitem(last=False)
+    return image
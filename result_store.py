@@ -0,0 +1,232 @@
+"""
+Server-side store for analysis results.
+
+Verdicts are persisted by id in a SQL database (SQLite by default, or any
+SQLAlchemy URL such as PostgreSQL via DATABASE_URL), so the session cookie
+only needs to carry the id, results and job status are visible to every
+worker, and past analyses can be queried.
+
+All functions must be called inside a Flask application context.
+"""
+
+import json
+import uuid
+from datetime import datetime, timezone
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+
+db = SQLAlchemy()
+
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+
+# Result fields stored in their own columns rather than in `details`
+_COLUMN_FIELDS = {"is_deepfake", "confidence", "analysis", "error", "model"}
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class AnalysisResult(db.Model):
+    """One analysed image pair and its verdict"""
+
+    __tablename__ = "analysis_results"
+
+    id = db.Column(db.String(32), primary_key=True)
+    status = db.Column(db.String(16), nullable=False, default=STATUS_QUEUED)
+    source = db.Column(db.String(16), nullable=False, default="upload")
+    created_at = db.Column(db.DateTime, nullable=False, default=_utcnow, index=True)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    model_name = db.Column(db.String(64))
+    original_digest = db.Column(db.String(64), index=True)
+    suspected_digest = db.Column(db.String(64), index=True)
+
+    is_deepfake = db.Column(db.Boolean)
+    confidence = db.Column(db.String(16))
+    analysis = db.Column(db.Text)
+    error = db.Column(db.Text)
+    # Every other field of the result (scores, votes, prescreen, known_fake, payload, ...)
+    details = db.Column(db.JSON)
+    # Bumped whenever the streamed analysis text starts over (another model took over the reply)
+    stream_generation = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+
+    def analysis_results(self):
+        """The verdict in the shape produced by analyze_images_with_gemini"""
+        results = {
+            "is_deepfake": self.is_deepfake,
+            "confidence": self.confidence,
+            "analysis": self.analysis,
+        }
+        if self.error:
+            results["error"] = self.error
+        if self.details:
+            results.update(self.details)
+        return results
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "source": self.source,
+            "created_at": _isoformat(self.created_at),
+            "started_at": _isoformat(self.started_at),
+            "finished_at": _isoformat(self.finished_at),
+            "model_name": self.model_name,
+            "original_digest": self.original_digest,
+            "suspected_digest": self.suspected_digest,
+            "results": self.analysis_results() if self.status == STATUS_DONE else None,
+        }
+
+
+def _isoformat(value):
+    return value.isoformat() + "Z" if value is not None else None
+
+
+def init_app(app):
+    """Bind the store to the Flask app and create missing tables and columns"""
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        _add_missing_columns()
+
+
+def _add_missing_columns():
+    """
+    Add columns introduced since the table was created.
+
+    create_all only creates missing tables, so databases from earlier
+    versions would otherwise lack newer columns. Every added column is
+    nullable or has a server default, so ADD COLUMN is enough.
+    """
+    table = AnalysisResult.__table__
+    existing = {column["name"] for column in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            definition = f"{column.name} {column.type.compile(db.engine.dialect)}"
+            if column.server_default is not None:
+                definition += f" NOT NULL DEFAULT {column.server_default.arg}"
+            connection.execute(db.text(f"ALTER TABLE {table.name} ADD COLUMN {definition}"))
+
+
+def ping():
+    """Run a trivial query; raises if the database cannot be reached"""
+    db.session.execute(db.text("SELECT 1"))
+    db.session.close()
+
+
+def dispose_connections():
+    """Drop pooled connections inherited from a parent process without closing them for the parent"""
+    db.engine.dispose(close=False)
+
+
+def new_result_id():
+    return uuid.uuid4().hex
+
+
+def create_result(result_id, original_digest, suspected_digest, model_name, source="upload"):
+    """Record a queued analysis"""
+    record = AnalysisResult(
+        id=result_id,
+        status=STATUS_QUEUED,
+        source=source,
+        model_name=model_name,
+        original_digest=original_digest,
+        suspected_digest=suspected_digest,
+    )
+    db.session.add(record)
+    db.session.commit()
+    return record
+
+
+def mark_running(result_id):
+    _update(result_id, status=STATUS_RUNNING, started_at=_utcnow())
+
+
+def update_partial(result_id, text):
+    """Store the analysis text received so far for a running, streamed analysis"""
+    _update(result_id, analysis=text)
+
+
+def reset_partial(result_id):
+    """Clear the streamed text and start a new generation, so readers discard what they have shown"""
+    record = db.session.get(AnalysisResult, result_id)
+    if record is None:
+        return
+    record.analysis = ""
+    record.stream_generation = (record.stream_generation or 0) + 1
+    db.session.commit()
+
+
+def complete_result(result_id, results):
+    """
+    Store the verdict returned by analyze_images_with_gemini (and the model that produced it, if known).
+
+    Fields other than the verdict columns are kept as JSON in `details` and
+    returned again by analysis_results().
+    """
+    fields = {"model_name": results["model"]} if results.get("model") else {}
+    details = {key: value for key, value in results.items() if key not in _COLUMN_FIELDS}
+    _update(
+        result_id,
+        status=STATUS_DONE,
+        finished_at=_utcnow(),
+        is_deepfake=results.get("is_deepfake"),
+        confidence=results.get("confidence"),
+        analysis=results.get("analysis"),
+        error=results.get("error"),
+        # Round-trip through JSON so values such as NumPy integers cannot fail the commit
+        details=json.loads(json.dumps(details, default=str)) if details else None,
+        **fields,
+    )
+
+
+def fail_result(result_id, error):
+    _update(result_id, status=STATUS_FAILED, finished_at=_utcnow(), error=error)
+
+
+def get_result(result_id):
+    """Return the AnalysisResult with this id, or None"""
+    if not result_id:
+        return None
+    return db.session.get(AnalysisResult, result_id)
+
+
+def refresh_result(result_id):
+    """
+    Re-read a result from the database.
+
+    Closes the current session first so updates committed by other threads
+    or workers are visible to long-running readers such as event streams.
+    """
+    db.session.close()
+    return get_result(result_id)
+
+
+def recent_results(limit=50, offset=0, is_deepfake=None, digest=None):
+    """Most recent results first, optionally filtered by verdict or image digest"""
+    query = AnalysisResult.query
+    if is_deepfake is not None:
+        query = query.filter(AnalysisResult.is_deepfake.is_(is_deepfake))
+    if digest:
+        query = query.filter(
+            (AnalysisResult.original_digest == digest) | (AnalysisResult.suspected_digest == digest)
+        )
+    return query.order_by(AnalysisResult.created_at.desc()).offset(offset).limit(limit).all()
+
+
+def _update(result_id, **fields):
+    record = db.session.get(AnalysisResult, result_id)
+    if record is None:
+        return
+    for name, value in fields.items():
+        setattr(record, name, value)
+    db.session.commit()
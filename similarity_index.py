@@ -0,0 +1,491 @@
+"""
+Index of previously analyzed image pairs, for instant verdicts on re-crops
+and re-compressions of known fakes.
+
+Every suspected image that gets a model verdict is recorded with the digest
+of the reference it was compared against, its perceptual hashes (64-bit
+pHash and dHash from the pre-screen fingerprint), the verdict and the result
+it came from. A verdict such as "different people" describes the pair, not
+the suspected image alone, so entries are keyed on the pair: before a new
+pair is sent to the model, the suspected image is looked up among entries
+for the same reference, and if it is within `max_distance` bits (on both
+hashes) of an image already flagged as a deepfake, the prior verdict is
+returned with its provenance and no model call is made. A newer verdict for
+the same pair replaces the older one.
+
+Storage has two parts:
+
+- An SQLite table holding every entry. Workers insert into it and read the
+  rows other workers added since their last refresh, so it is also how
+  entries are shared between processes.
+- A compacted base segment of the known fakes: NumPy arrays written to
+  `base-<rowid>/` and loaded memory-mapped, so a worker opens an index of
+  millions of entries without reading it into memory. Rows added since the
+  base was built are kept in small in-memory arrays and searched by brute
+  force; once there are `compact_after` of them a new base is built in the
+  background.
+
+Replaced entries stay in the table (so their row ids are never handed out
+again) and are listed in a `retired` table, which every worker reads on
+refresh to skip them; the next base is built without them.
+
+Lookups in the base use multi-index hashing: the pHash is split into four
+16-bit chunks, and for each chunk there is a sorted copy of the chunk values
+with the rows they belong to. Two hashes within 7 bits of each other agree
+to within one bit on at least one chunk, so probing each chunk's value and
+its 16 one-bit neighbours with a binary search finds every candidate. That
+is 68 binary searches and a few hundred candidate rows even at millions of
+entries, well under a millisecond. `max_distance` is therefore capped at 7.
+
+Requires NumPy.
+"""
+
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from storage import write_atomic
+
+logger = logging.getLogger(__name__)
+
+MAX_DISTANCE_LIMIT = 7
+CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+
+CONFIDENCES = ("Low", "Medium", "High")
+_CONFIDENCE_RANKS = {value.lower(): rank for rank, value in enumerate(CONFIDENCES)}
+
+# Bits set in each byte value, for popcounts on NumPy versions without bitwise_count
+_BYTE_BITS = np.array([bin(value).count("1") for value in range(256)], dtype=np.uint8)
+
+
+def _popcount(values):
+    """Bits set in each element of a uint64 array"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _BYTE_BITS[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _signed(value):
+    """A uint64 hash as the signed 64-bit integer SQLite can store"""
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+
+def _probe_values(chunk, radius):
+    """The chunk value and, with radius 1, every value one bit away"""
+    values = [chunk]
+    if radius:
+        values += [chunk ^ (1 << bit) for bit in range(CHUNK_BITS)]
+    return np.array(values, dtype=np.uint16)
+
+
+class Match:
+    """A known fake found near a queried image"""
+
+    __slots__ = ('result_id', 'distance', 'confidence', 'created')
+
+    def __init__(self, result_id, distance, confidence, created):
+        self.result_id = result_id
+        self.distance = distance
+        self.confidence = confidence
+        self.created = created
+
+
+# Per-row arrays of a segment, in the column order of the rows it is built from
+SEGMENT_ARRAYS = ("ids", "references", "phash", "dhash", "confidence", "created", "result_ids")
+
+# Columns selected for a segment, matching SEGMENT_ARRAYS
+_SEGMENT_COLUMNS = "id, reference, phash, dhash, confidence, created, result_id"
+# Entries that have not been replaced by a newer verdict for their pair
+_LIVE = "id NOT IN (SELECT entry_id FROM retired)"
+
+
+class Segment:
+    """Arrays describing a set of known fakes: hashes, provenance and (for a base) the chunk tables"""
+
+    def __init__(self, ids, references, phash, dhash, confidence, created, result_ids, chunk_keys=None,
+                 chunk_rows=None):
+        self.ids = ids
+        self.references = references
+        self.phash = phash
+        self.dhash = dhash
+        self.confidence = confidence
+        self.created = created
+        self.result_ids = result_ids
+        self.chunk_keys = chunk_keys
+        self.chunk_rows = chunk_rows
+
+    def __len__(self):
+        return len(self.phash)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, np.int64), np.empty(0, "S64"), np.empty(0, np.uint64), np.empty(0, np.uint64),
+                   np.empty(0, np.uint8), np.empty(0, np.float64), np.empty(0, "S32"))
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build an unindexed segment from (id, reference, phash, dhash, confidence, created, result_id) rows"""
+        if not rows:
+            return cls.empty()
+        ids, references, phash, dhash, confidence, created, result_ids = zip(*rows)
+        return cls(
+            np.array(ids, dtype=np.int64),
+            np.array(references, dtype="S64"),
+            np.array(phash, dtype=np.int64).view(np.uint64),
+            np.array(dhash, dtype=np.int64).view(np.uint64),
+            np.array(confidence, dtype=np.uint8),
+            np.array(created, dtype=np.float64),
+            np.array(result_ids, dtype="S32"),
+        )
+
+    def extend(self, other):
+        """A new segment with the rows of other appended (chunk tables are not carried over)"""
+        return Segment(*(np.concatenate([getattr(self, name), getattr(other, name)]) for name in SEGMENT_ARRAYS))
+
+    def save(self, directory):
+        """Write the segment with its chunk tables, one .npy file per array"""
+        os.makedirs(directory)
+        for name in SEGMENT_ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        for index in range(CHUNKS):
+            keys = ((self.phash >> np.uint64(index * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.uint16)
+            order = np.argsort(keys, kind="stable").astype(np.uint32)
+            np.save(os.path.join(directory, f"chunk{index}_keys.npy"), keys[order])
+            np.save(os.path.join(directory, f"chunk{index}_rows.npy"), order)
+
+    @classmethod
+    def load(cls, directory):
+        """Memory-map a segment written by save"""
+        def array(name):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+        return cls(
+            *(array(name) for name in SEGMENT_ARRAYS),
+            [array(f"chunk{index}_keys") for index in range(CHUNKS)],
+            [array(f"chunk{index}_rows") for index in range(CHUNKS)],
+        )
+
+    def candidates(self, phash, radius):
+        """Rows whose pHash may be within 4 * radius + 3 bits of phash (all rows without chunk tables)"""
+        if self.chunk_keys is None:
+            return None
+        found = []
+        for index in range(CHUNKS):
+            probes = _probe_values((phash >> (index * CHUNK_BITS)) & CHUNK_MASK, radius)
+            keys = self.chunk_keys[index]
+            starts = np.searchsorted(keys, probes, side="left")
+            ends = np.searchsorted(keys, probes, side="right")
+            for start, end in zip(starts, ends):
+                if end > start:
+                    found.append(self.chunk_rows[index][start:end])
+        if not found:
+            return np.empty(0, np.uint32)
+        return np.unique(np.concatenate(found))
+
+    def nearest(self, phash, dhash, max_distance, reference, retired=None):
+        """
+        Closest row for reference within max_distance bits on both hashes,
+        skipping the row ids in retired, as (row, distance), or None.
+        """
+        if not len(self):
+            return None
+        rows = self.candidates(phash, max_distance // CHUNKS)
+        if rows is None:
+            rows = np.arange(len(self))
+        elif not len(rows):
+            return None
+        keep = self.references[rows] == reference.encode("ascii")
+        if retired is not None and len(retired):
+            keep &= ~np.isin(self.ids[rows], retired)
+        rows = rows[keep]
+        if not len(rows):
+            return None
+        distances = np.maximum(_popcount(self.phash[rows] ^ np.uint64(phash)),
+                               _popcount(self.dhash[rows] ^ np.uint64(dhash)))
+        best = int(np.argmin(distances))
+        if distances[best] > max_distance:
+            return None
+        return int(rows[best]), int(distances[best])
+
+    def match(self, row, distance):
+        return Match(self.result_ids[row].decode("ascii"), distance,
+                     CONFIDENCES[min(int(self.confidence[row]), len(CONFIDENCES) - 1)], float(self.created[row]))
+
+
+class SimilarityIndex:
+    """Perceptual-hash index of analyzed image pairs, searched for near-duplicates of known fakes"""
+
+    def __init__(self, directory, max_distance=6, refresh_interval=1.0, compact_after=50000):
+        if not 0 <= max_distance <= MAX_DISTANCE_LIMIT:
+            raise ValueError(f"max_distance must be between 0 and {MAX_DISTANCE_LIMIT}")
+        self.directory = directory
+        self.max_distance = max_distance
+        self.refresh_interval = refresh_interval
+        self.compact_after = compact_after
+
+        self._lock = threading.Lock()
+        self._db = None
+        self._base = Segment.empty()
+        self._base_rowid = 0
+        self._recent = Segment.empty()
+        self._seen_rowid = 0
+        self._retired = np.empty(0, np.int64)
+        self._seen_retired = 0
+        self._next_refresh = 0.0
+        self._compacting = False
+
+        os.makedirs(directory, exist_ok=True)
+        self._open_db()
+        self.refresh(force=True)
+
+    @property
+    def _db_path(self):
+        return os.path.join(self.directory, "entries.db")
+
+    @property
+    def _current_path(self):
+        return os.path.join(self.directory, "CURRENT")
+
+    def _open_db(self):
+        try:
+            self._db = sqlite3.connect(self._db_path, timeout=5, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "id INTEGER PRIMARY KEY, result_id TEXT NOT NULL, reference TEXT NOT NULL DEFAULT '', "
+                "digest TEXT NOT NULL, phash INTEGER NOT NULL, dhash INTEGER NOT NULL, "
+                "is_deepfake INTEGER NOT NULL, confidence INTEGER NOT NULL, created REAL NOT NULL)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS retired (id INTEGER PRIMARY KEY, entry_id INTEGER NOT NULL)")
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(entries)")}
+            if "reference" not in columns:
+                self._upgrade_unpaired()
+            self._db.execute("DROP INDEX IF EXISTS entries_digest")
+            self._db.execute("CREATE INDEX IF NOT EXISTS entries_pair ON entries (reference, digest)")
+            self._db.commit()
+        except sqlite3.Error as e:
+            logger.error("Could not open similarity index database %s: %s", self._db_path, e)
+            self._db = None
+
+    def _upgrade_unpaired(self):
+        """
+        Upgrade an index whose entries were keyed on the suspected image alone.
+
+        Their reference is unknown, so they get an empty one and never match
+        again; the base built from them is dropped with them.
+        """
+        try:
+            self._db.execute("ALTER TABLE entries ADD COLUMN reference TEXT NOT NULL DEFAULT ''")
+        except sqlite3.OperationalError as e:
+            if "duplicate column" not in str(e):
+                raise
+            return  # another worker upgraded it first
+        logger.warning("Similarity index %s predates pair keys; its entries will no longer match", self.directory)
+        try:
+            os.remove(self._current_path)
+        except FileNotFoundError:
+            pass
+        for entry in os.listdir(self.directory):
+            if entry.startswith("base-"):
+                shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+    def reopen(self):
+        """Open a fresh database connection, e.g. in a worker forked from a process that already held one"""
+        with self._lock:
+            self._open_db()
+
+    def __len__(self):
+        return len(self._base) + len(self._recent)
+
+    def add(self, result_id, reference, digest, phash, dhash, is_deepfake, confidence):
+        """
+        Record the verdict for a suspected image compared against reference
+        (both digests). A different verdict already recorded for the pair is
+        replaced; the same verdict is kept as it is.
+
+        Other workers see the entry after their next refresh.
+        """
+        if self._db is None:
+            return
+        rank = _CONFIDENCE_RANKS.get(str(confidence).lower(), 1)
+        with self._lock:
+            try:
+                previous = self._db.execute(
+                    f"SELECT id, is_deepfake, confidence FROM entries WHERE reference = ? AND digest = ? AND {_LIVE}",
+                    (reference, digest),
+                ).fetchall()
+                if any(row[1:] == (int(bool(is_deepfake)), rank) for row in previous):
+                    return  # e.g. a repeat submission answered from the verdict cache
+                self._db.executemany("INSERT INTO retired (entry_id) VALUES (?)", ((row[0],) for row in previous))
+                self._db.execute(
+                    "INSERT INTO entries (result_id, reference, digest, phash, dhash, is_deepfake, confidence, "
+                    "created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (result_id, reference, digest, _signed(phash), _signed(dhash), int(bool(is_deepfake)), rank,
+                     time.time()),
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                self._db.rollback()
+                logger.error("Error writing similarity index: %s", e)
+                return
+        self._next_refresh = 0.0
+
+    def add_many(self, entries):
+        """
+        Record many (result_id, reference, digest, phash, dhash, is_deepfake,
+        confidence) entries in one transaction, e.g. to backfill the index.
+        Pairs are not checked for earlier verdicts.
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT INTO entries (result_id, reference, digest, phash, dhash, is_deepfake, confidence, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((result_id, reference, digest, _signed(phash), _signed(dhash), int(bool(is_deepfake)),
+                  _CONFIDENCE_RANKS.get(str(confidence).lower(), 1), now)
+                 for result_id, reference, digest, phash, dhash, is_deepfake, confidence in entries),
+            )
+            self._db.commit()
+        self._next_refresh = 0.0
+
+    def lookup(self, reference, phash, dhash, max_distance=None):
+        """
+        Closest known fake compared against reference (a digest) within
+        max_distance bits (default: the index's) on both pHash and dHash, as
+        a Match, or None.
+        """
+        max_distance = self.max_distance if max_distance is None else min(max_distance, MAX_DISTANCE_LIMIT)
+        self.refresh()
+        base, recent, retired = self._base, self._recent, self._retired
+        best = None
+        for segment in (base, recent):
+            found = segment.nearest(phash, dhash, max_distance, reference, retired)
+            if found is not None and (best is None or found[1] < best[1]):
+                best = (segment, *found)
+        if best is None:
+            return None
+        segment, row, distance = best
+        return segment.match(row, distance)
+
+    def refresh(self, force=False):
+        """Pick up a newer base segment and rows added by other workers (at most every refresh_interval)"""
+        now = time.monotonic()
+        if not force and now < self._next_refresh:
+            return
+        with self._lock:
+            if not force and now < self._next_refresh:
+                return
+            self._next_refresh = now + self.refresh_interval
+            if self._db is None:
+                return
+            try:
+                self._load_current_base()
+                last = self._db.execute("SELECT max(id) FROM entries").fetchone()[0] or 0
+                rows = self._db.execute(
+                    f"SELECT {_SEGMENT_COLUMNS} FROM entries "
+                    f"WHERE id > ? AND id <= ? AND is_deepfake = 1 AND {_LIVE} ORDER BY id",
+                    (max(self._seen_rowid, self._base_rowid), last),
+                ).fetchall()
+                retired = self._db.execute(
+                    "SELECT id, entry_id FROM retired WHERE id > ? ORDER BY id", (self._seen_retired,)
+                ).fetchall()
+            except (sqlite3.Error, OSError, ValueError) as e:
+                logger.error("Error refreshing similarity index: %s", e)
+                return
+            if rows:
+                self._recent = self._recent.extend(Segment.from_rows(rows))
+            if retired:
+                self._retired = np.union1d(self._retired, np.array([row[1] for row in retired], dtype=np.int64))
+                self._seen_retired = retired[-1][0]
+            self._seen_rowid = max(self._seen_rowid, last)
+            should_compact = len(self._recent) >= self.compact_after and not self._compacting
+            if should_compact:
+                self._compacting = True
+        if should_compact:
+            threading.Thread(target=self._compact_in_background, name="similarity-compact", daemon=True).start()
+
+    def _load_current_base(self):
+        """Switch to the base named in CURRENT if it is newer than the loaded one (called with the lock held)"""
+        try:
+            with open(self._current_path) as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return
+        rowid = int(name.rpartition("-")[2])
+        if rowid <= self._base_rowid:
+            return
+        self._base = Segment.load(os.path.join(self.directory, name))
+        self._base_rowid = rowid
+        if self._seen_rowid < rowid:
+            self._recent = Segment.empty()
+            self._seen_rowid = rowid
+        else:
+            # Rows up to rowid are now in the base; keep only the fakes added after it
+            self._recent = Segment.from_rows(self._db.execute(
+                f"SELECT {_SEGMENT_COLUMNS} FROM entries "
+                f"WHERE id > ? AND id <= ? AND is_deepfake = 1 AND {_LIVE} ORDER BY id",
+                (rowid, self._seen_rowid),
+            ).fetchall())
+        logger.info("Loaded similarity index base %s (%s known fakes)", name, len(self._base))
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as e:
+            logger.error("Similarity index compaction failed: %s", e)
+        finally:
+            self._compacting = False
+
+    def compact(self):
+        """
+        Build a new base segment from every known fake in the database and
+        make it current. Concurrent compactions by several workers are
+        harmless: each writes a complete base and the newest one wins.
+        """
+        # A connection of its own, so lookups can refresh while the rows are read
+        db = sqlite3.connect(self._db_path, timeout=5)
+        try:
+            last = db.execute("SELECT max(id) FROM entries").fetchone()[0] or 0
+            rows = db.execute(
+                f"SELECT {_SEGMENT_COLUMNS} FROM entries "
+                f"WHERE id <= ? AND is_deepfake = 1 AND {_LIVE} ORDER BY id",
+                (last,),
+            ).fetchall()
+        finally:
+            db.close()
+        if last <= self._base_rowid:
+            return
+
+        name = f"base-{last}"
+        target = os.path.join(self.directory, name)
+        if not os.path.isdir(target):
+            staging = f"{target}.tmp-{os.getpid()}-{threading.get_ident()}"
+            Segment.from_rows(rows).save(staging)
+            try:
+                os.rename(staging, target)
+            except OSError:
+                shutil.rmtree(staging, ignore_errors=True)  # another worker built the same base first
+        write_atomic(self._current_path, name.encode("ascii"))
+        logger.info("Compacted similarity index: %s known fakes in %s", len(rows), name)
+
+        with self._lock:
+            self._load_current_base()
+        self._remove_old_bases(name)
+
+    def _remove_old_bases(self, current):
+        """Delete superseded bases; workers still mapping one keep their open files until they switch"""
+        for entry in os.listdir(self.directory):
+            if entry.startswith("base-") and entry != current and "." not in entry:
+                if int(entry.rpartition("-")[2]) < int(current.rpartition("-")[2]):
+                    shutil.rmtree(os.path.join(self.directory, entry), ignore_errors=True)
+
+    def stats(self):
+        return {"base": len(self._base), "recent": len(self._recent), "base_rowid": self._base_rowid,
+                "retired": len(self._retired)}
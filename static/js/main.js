@@ -13,6 +13,9 @@ document.addEventListener('DOMContentLoaded', function() {
     const analyzeBtn = document.getElementById('analyze-btn');
     const loadingIndicator = document.getElementById('loading-indicator');
     
+    // How often to check on a queued analysis job
+    const JOB_POLL_INTERVAL_MS = 1000;
+    
     // Add event listeners for file inputs
     if (originalInput) {
         originalInput.addEventListener('change', function() {
@@ -28,22 +31,103 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Add event listener for form submission
     if (uploadForm) {
-        uploadForm.addEventListener('submit', function() {
+        uploadForm.addEventListener('submit', function(event) {
             // Validate form before submission
-            if (validateForm()) {
-                // Show loading indicator and disable button
-                if (loadingIndicator) loadingIndicator.classList.remove('d-none');
-                if (analyzeBtn) {
-                    analyzeBtn.disabled = true;
-                    analyzeBtn.innerHTML = '<div class="spinner-border spinner-border-sm me-2" role="status"></div>Analyzing...';
-                }
-                return true;
-            } else {
+            if (!validateForm()) {
+                event.preventDefault();
                 return false;
             }
+            
+            // Show loading indicator and disable button
+            setLoading(true);
+            
+            // Without fetch support fall back to a normal (blocking) form post
+            if (!window.fetch || !window.FormData) {
+                return true;
+            }
+            
+            // Submit as a background job and poll until the analysis finishes
+            event.preventDefault();
+            submitAnalysisJob(new FormData(uploadForm));
+            return false;
         });
     }
     
+    /**
+     * Toggle the loading indicator and analyze button state
+     */
+    function setLoading(isLoading) {
+        if (loadingIndicator) loadingIndicator.classList.toggle('d-none', !isLoading);
+        if (analyzeBtn) {
+            analyzeBtn.disabled = isLoading;
+            analyzeBtn.innerHTML = isLoading
+                ? '<div class="spinner-border spinner-border-sm me-2" role="status"></div>Analyzing...'
+                : '<i class="fas fa-magnifying-glass me-2"></i>Analyze Images';
+        }
+    }
+    
+    /**
+     * Upload both images, receive a job id and start polling its status
+     * (or open the streaming results page when the server offers a stream)
+     */
+    function submitAnalysisJob(formData) {
+        fetch(uploadForm.action, {
+            method: 'POST',
+            body: formData,
+            headers: { 'Accept': 'application/json' }
+        })
+            .then(function(response) {
+                return response.json().then(function(data) {
+                    if (!response.ok) {
+                        throw new Error(data.error || 'Upload failed (' + response.status + ')');
+                    }
+                    return data;
+                });
+            })
+            .then(function(job) {
+                // In streaming mode the results page follows the job itself
+                if (job.stream_url) {
+                    window.location.href = job.results_url;
+                } else {
+                    pollJob(job.status_url, job.results_url);
+                }
+            })
+            .catch(showJobError);
+    }
+    
+    /**
+     * Poll a job until it is done, then open its results page
+     */
+    function pollJob(statusUrl, resultsUrl) {
+        fetch(statusUrl, { headers: { 'Accept': 'application/json' } })
+            .then(function(response) {
+                return response.json().then(function(data) {
+                    if (!response.ok) {
+                        throw new Error(data.error || 'Could not fetch job status');
+                    }
+                    return data;
+                });
+            })
+            .then(function(job) {
+                if (job.status === 'done') {
+                    window.location.href = resultsUrl;
+                } else if (job.status === 'failed') {
+                    throw new Error(job.error || 'Analysis failed');
+                } else {
+                    setTimeout(function() { pollJob(statusUrl, resultsUrl); }, JOB_POLL_INTERVAL_MS);
+                }
+            })
+            .catch(showJobError);
+    }
+    
+    /**
+     * Report a failed upload or analysis and re-enable the form
+     */
+    function showJobError(error) {
+        setLoading(false);
+        alert('Error processing upload: ' + error.message);
+    }
+    
     /**
      * Display image preview when a file is selected
      */
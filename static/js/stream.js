@@ -0,0 +1,42 @@
+// Follow a pending analysis over server-sent events and show the text as it arrives
+document.addEventListener('DOMContentLoaded', function() {
+    const pending = document.getElementById('analysis-pending');
+    const output = document.getElementById('analysis-stream');
+    
+    // Without EventSource support just reload until the analysis is finished
+    const FALLBACK_RELOAD_MS = 2000;
+    
+    if (!pending || !output) {
+        return;
+    }
+    
+    if (!window.EventSource) {
+        setTimeout(function() { window.location.reload(); }, FALLBACK_RELOAD_MS);
+        return;
+    }
+    
+    const source = new EventSource(pending.dataset.streamUrl);
+    let received = false;
+    
+    // Partial analysis text; the browser resumes from the last event id after a reconnect
+    source.addEventListener('chunk', function(event) {
+        const data = JSON.parse(event.data);
+        if (!received) {
+            output.textContent = '';
+            received = true;
+        }
+        output.textContent += data.text;
+    });
+    
+    // The reply starts over (another model took over): drop the text shown so far
+    source.addEventListener('reset', function() {
+        output.textContent = '';
+        received = true;
+    });
+    
+    // Terminal event: reload to render the final verdict (or the error for a failed job)
+    source.addEventListener('verdict', function() {
+        source.close();
+        window.location.reload();
+    });
+});
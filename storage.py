@@ -0,0 +1,152 @@
+"""
+Content-addressed storage for normalized uploads.
+
+Every image is stored under its SHA-256 digest in sharded subdirectories
+(`ab/cd/abcd....jpg`), so concurrent uploads can never overwrite each other
+and identical uploads are stored once. A background janitor keeps the
+managed directories within an age and total size budget.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {
+    'image/jpeg': 'jpg',
+    'image/png': 'png',
+    'image/gif': 'gif',
+    'image/webp': 'webp',
+}
+
+
+def write_atomic(path, data):
+    """Write data to path so concurrent readers never see a partial file"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class ImageStore:
+    """Sharded, deduplicating store of normalized images keyed by digest"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest, extension):
+        """Location of a stored image: <root>/<d[0:2]>/<d[2:4]>/<digest>.<ext>"""
+        return os.path.join(self.root, digest[:2], digest[2:4], f"{digest}.{extension}")
+
+    def put(self, image):
+        """
+        Store a NormalizedImage and return its path.
+
+        An identical image that is already stored is not rewritten; its
+        modification time is refreshed so retention counts from the latest upload.
+        """
+        path = self.path_for(image.digest, EXTENSIONS.get(image.mime_type, 'bin'))
+        try:
+            os.utime(path)
+            logger.debug("Deduplicated upload %s", image.digest[:12])
+        except FileNotFoundError:
+            write_atomic(path, image.data)
+        return path
+
+    def find(self, digest):
+        """Return the path of a stored image by digest, or None"""
+        directory = os.path.join(self.root, digest[:2], digest[2:4])
+        for extension in EXTENSIONS.values():
+            path = os.path.join(directory, f"{digest}.{extension}")
+            if os.path.isfile(path):
+                return path
+        return None
+
+
+def sweep(roots, max_age=None, max_bytes=None, now=None):
+    """
+    Delete files under roots that are older than max_age seconds, then the
+    oldest remaining files until their total size is within max_bytes.
+
+    Returns (files_removed, bytes_removed).
+    """
+    now = now or time.time()
+    entries = []
+    for root in roots:
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue  # a write in progress
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    removed_files = removed_bytes = 0
+
+    for mtime, size, path in entries:
+        too_old = max_age and now - mtime > max_age
+        too_big = max_bytes and total > max_bytes
+        if not (too_old or too_big):
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error("Could not remove %s: %s", path, e)
+            continue
+        total -= size
+        removed_files += 1
+        removed_bytes += size
+
+    return removed_files, removed_bytes
+
+
+class Janitor:
+    """Daemon thread that periodically sweeps the managed storage directories"""
+
+    def __init__(self, roots, max_age, max_bytes, interval=600):
+        self.roots = roots
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and self.interval > 0:
+            self._thread = threading.Thread(target=self._run, name="storage-janitor", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run_once(self):
+        removed_files, removed_bytes = sweep(self.roots, self.max_age, self.max_bytes)
+        if removed_files:
+            logger.info("Storage janitor removed %s files (%s bytes)", removed_files, removed_bytes)
+        return removed_files, removed_bytes
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Storage janitor failed: %s", e)
+            self._stop.wait(self.interval)
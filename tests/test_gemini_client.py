@@ -0,0 +1,51 @@
+import pytest
+
+from gemini_client import FakeModel, ModelRegistry, load_backend
+
+
+def test_registry_reuses_models_from_the_factory():
+    created = []
+
+    def factory(model_name):
+        created.append(model_name)
+        return FakeModel(model_name, text="reply")
+
+    registry = ModelRegistry(factory=factory)
+    assert registry.generate("a", ["prompt"]).text == "reply"
+    assert registry.generate("a", ["prompt"]).text == "reply"
+    assert created == ["a"]
+    assert registry.get("a").calls == 2
+
+
+def test_set_factory_drops_cached_models():
+    registry = ModelRegistry(factory=lambda name: FakeModel(name, text="old"))
+    registry.get("a")
+    registry.set_factory(lambda name: FakeModel(name, text="new"))
+    assert registry.generate("a", ["prompt"]).text == "new"
+
+
+def test_streamed_reply_reassembles_the_text():
+    text = " ".join(f"word{index}" for index in range(20))
+    registry = ModelRegistry(factory=lambda name: FakeModel(name, text=text))
+    chunks = [chunk.text for chunk in registry.generate("a", ["prompt"], stream=True)]
+    assert len(chunks) > 1
+    assert "".join(chunks) == text
+
+
+def test_non_transient_errors_are_not_retried():
+    class FailingModel(FakeModel):
+        def generate_content(self, contents, stream=False, **kwargs):
+            self.calls += 1
+            raise RuntimeError("boom")
+
+    registry = ModelRegistry(factory=FailingModel, retry_timeout=30)
+    with pytest.raises(RuntimeError):
+        registry.generate("a", ["prompt"])
+    assert registry.get("a").calls == 1
+
+
+def test_load_backend():
+    assert load_backend("fake")("m").model_name == "m"
+    assert load_backend("gemini_client:FakeModel") is FakeModel
+    with pytest.raises(ValueError):
+        load_backend("not-a-spec")
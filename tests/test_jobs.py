@@ -0,0 +1,26 @@
+import threading
+
+import pytest
+
+from jobs import JobQueue, QueueFullError
+
+
+def test_pending_counts_queued_and_running_jobs_until_they_finish():
+    queue = JobQueue(max_workers=1, max_pending=2)
+    release = threading.Event()
+    queue.submit(release.wait)
+    queue.submit(release.wait)
+    assert queue.pending() == 2
+    with pytest.raises(QueueFullError):
+        queue.submit(release.wait)
+
+    release.set()
+    queue.shutdown(wait=True)
+    assert queue.pending() == 0
+
+
+def test_failed_jobs_are_no_longer_pending():
+    queue = JobQueue(max_workers=1)
+    queue.submit(lambda: 1 / 0)
+    queue.shutdown(wait=True)
+    assert queue.pending() == 0
@@ -0,0 +1,47 @@
+import json
+import os
+
+import metrics
+
+
+def write_snapshot(directory, pid, value, observation=None):
+    registry = metrics.Registry(snapshot_dir=str(directory))
+    registry.inc("requests_total", value, endpoint="upload")
+    if observation is not None:
+        registry.observe("stage_seconds", observation, stage="model")
+    with open(os.path.join(str(directory), f"{pid}.json"), "w") as f:
+        json.dump(registry.snapshot(), f)
+
+
+def test_render_adds_up_worker_snapshots(tmp_path):
+    write_snapshot(tmp_path, 101, 3)
+    registry = metrics.Registry(snapshot_dir=str(tmp_path))
+    registry.inc("requests_total", 2, endpoint="upload")
+    assert 'deepfake_requests_total{endpoint="upload"} 5' in registry.render()
+
+
+def test_dead_worker_snapshots_are_folded_into_the_aggregate(tmp_path):
+    write_snapshot(tmp_path, 101, 3, observation=0.2)
+    write_snapshot(tmp_path, 102, 4, observation=7.0)
+    metrics.mark_process_dead(101, str(tmp_path))
+    metrics.mark_process_dead(102, str(tmp_path))
+    metrics.mark_process_dead(103, str(tmp_path))  # never wrote a snapshot
+
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".json")) == ["aggregate.json"]
+    output = metrics.Registry(snapshot_dir=str(tmp_path)).render()
+    assert 'deepfake_requests_total{endpoint="upload"} 7' in output
+    assert 'deepfake_stage_seconds_count{stage="model"} 2' in output
+    assert 'deepfake_stage_seconds_bucket{stage="model",le="0.25"} 1' in output
+
+
+def test_a_reused_pid_does_not_lower_the_totals(tmp_path):
+    # A worker died without child_exit running; a new process now has its pid
+    write_snapshot(tmp_path, os.getpid(), 10)
+    registry = metrics.Registry(snapshot_dir=str(tmp_path))
+    registry.inc("requests_total", 1, endpoint="upload")
+    registry.flush(force=True)
+    assert 'deepfake_requests_total{endpoint="upload"} 11' in registry.render()
+
+    # Later flushes by the same process replace its own snapshot
+    registry.inc("requests_total", 1, endpoint="upload")
+    assert 'deepfake_requests_total{endpoint="upload"} 12' in registry.render()
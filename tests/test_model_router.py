@@ -0,0 +1,83 @@
+from gemini_client import FakeModel, ModelRegistry
+from model_router import ModelRoute, ModelRouter, vote
+from verdict_parser import parse_verdict
+
+FLAGGED = "This is a deepfake. High confidence."
+CLEARED = "The images show the same person. This is not a deepfake. High confidence."
+
+
+def make_router(texts, **kwargs):
+    models = {}
+
+    def factory(model_name):
+        models[model_name] = FakeModel(model_name, text=texts[model_name])
+        return models[model_name]
+
+    registry = ModelRegistry(factory=factory)
+    routes = [ModelRoute(name, cost=kwargs.pop(f"cost_{name}", 1.0)) for name in texts]
+    return ModelRouter(registry, routes, **kwargs), models
+
+
+def test_ensemble_members_stay_within_max_cost():
+    router, models = make_router({"a": FLAGGED, "b": FLAGGED, "c": FLAGGED}, strategy="ensemble",
+                                 ensemble_size=3, max_cost=3, cost_a=2, cost_b=2, cost_c=2)
+    result = router.generate(["prompt"], parse=parse_verdict)
+    router.shutdown()
+
+    assert result["model"] == "a"
+    assert sorted(models) == ["a"]
+
+
+def test_ensemble_skips_members_over_budget_but_keeps_cheaper_ones():
+    router, models = make_router({"a": FLAGGED, "b": CLEARED, "c": FLAGGED}, strategy="ensemble",
+                                 ensemble_size=3, max_cost=3, cost_a=1, cost_b=5, cost_c=2)
+    result = router.generate(["prompt"], parse=parse_verdict)
+    router.shutdown()
+
+    assert sorted(models) == ["a", "c"]
+    assert [v["model"] for v in result["votes"]] == ["a", "c"]
+
+
+def test_ensemble_always_makes_one_call():
+    router, models = make_router({"a": FLAGGED, "b": FLAGGED}, strategy="ensemble", max_cost=1, cost_a=2, cost_b=2)
+    assert router.generate(["prompt"], parse=parse_verdict)["model"] == "a"
+    router.shutdown()
+
+
+def test_vote_majority_wins():
+    results = [
+        {"is_deepfake": True, "confidence": "High", "analysis": "x", "model": "a"},
+        {"is_deepfake": True, "confidence": "Medium", "analysis": "y", "model": "b"},
+        {"is_deepfake": False, "confidence": "High", "analysis": "z", "model": "c"},
+    ]
+    combined = vote(results)
+    assert combined["is_deepfake"] is True
+    assert combined["analysis"] == "x"
+    assert len(combined["votes"]) == 3
+
+
+def test_fallback_signals_a_reset_before_the_next_model_streams():
+    class FailingMidReply(FakeModel):
+        def generate_content(self, contents, stream=False, **kwargs):
+            self.calls += 1
+            return self._fail_after_first_chunk()
+
+        def _fail_after_first_chunk(self):
+            yield from list(self._stream())[:1]
+            raise RuntimeError("connection dropped")
+
+    def factory(model_name):
+        model_class = FailingMidReply if model_name == "a" else FakeModel
+        return model_class(model_name, text=" ".join(f"{model_name}{index}" for index in range(20)))
+
+    router = ModelRouter(ModelRegistry(factory=factory), [ModelRoute("a"), ModelRoute("b")])
+    partials = []
+    result = router.generate(["prompt"], parse=parse_verdict, on_partial=partials.append)
+    router.shutdown()
+
+    assert result["model"] == "b"
+    reset = partials.index("")
+    assert all(text.startswith("a0") for text in partials[:reset])
+    assert all(text.startswith("b0") for text in partials[reset + 1:])
+    assert partials[-1] == " ".join(f"b{index}" for index in range(20))
+    assert "" not in partials[reset + 1:]
@@ -0,0 +1,69 @@
+import io
+import random
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from imaging import NormalizedImage  # noqa: E402
+from payload_policy import PayloadPolicy  # noqa: E402
+
+
+def encode(img, fmt, **options):
+    buffer = io.BytesIO()
+    img.save(buffer, format=fmt, **options)
+    return NormalizedImage(buffer.getvalue(), Image.MIME[fmt], img.size)
+
+
+def photo(size, seed=0):
+    rng = random.Random(seed)
+    noise = [Image.effect_noise(size, rng.uniform(20, 60)) for _ in range(3)]
+    gradient = Image.linear_gradient('L').resize(size)
+    return Image.merge('RGB', [Image.blend(channel, gradient, 0.5) for channel in noise])
+
+
+def test_large_png_photo_becomes_a_smaller_jpeg_within_the_budget():
+    image = encode(photo((1024, 768)), 'PNG')
+    payload = PayloadPolicy(byte_budget=200 * 1024).reencode(image)
+
+    assert payload.mime_type == 'image/jpeg'
+    assert max(payload.size) <= 768
+    assert len(payload.data) <= 200 * 1024
+    assert len(payload.data) < len(image.data)
+
+
+def test_payload_that_is_not_smaller_falls_back_to_the_original():
+    # A 1024px JPEG at very low quality is smaller than any q85 re-encoding of it at 768px
+    image = encode(photo((1024, 1024)), 'JPEG', quality=5)
+    policy = PayloadPolicy(quality=85, min_quality=85)
+
+    assert policy.reencode(image) is image
+    assert policy.encode(image) is image
+
+
+def test_small_jpeg_is_sent_untouched():
+    image = encode(photo((640, 480)), 'JPEG', quality=80)
+    assert PayloadPolicy().reencode(image) is image
+
+
+def test_graphics_are_classified_and_sent_as_lossless_webp():
+    img = Image.new('RGB', (1024, 768), (255, 255, 255))
+    img.paste((30, 90, 200), (100, 100, 600, 400))
+    policy = PayloadPolicy()
+    assert policy.classify(img) == 'graphic'
+    assert policy.classify(photo((256, 256))) == 'photo'
+    with Image.open(io.BytesIO(encode(img, 'JPEG', quality=5).data)) as compressed:
+        assert policy.classify(compressed) == 'photo'
+
+    payload = policy.reencode(encode(img, 'PNG'))
+    if 'WEBP' in Image.SAVE:
+        assert payload.mime_type == 'image/webp'
+
+
+def test_should_escalate_on_low_confidence_or_no_verdict():
+    policy = PayloadPolicy()
+    assert policy.should_escalate({"is_deepfake": True, "confidence": "Low"})
+    assert policy.should_escalate({"is_deepfake": None, "confidence": "Medium"})
+    assert not policy.should_escalate({"is_deepfake": False, "confidence": "High"})
+    assert not policy.should_escalate({"is_deepfake": None, "error": "boom"})
+    assert not PayloadPolicy(escalate=False).should_escalate({"is_deepfake": True, "confidence": "Low"})
@@ -0,0 +1,56 @@
+import io
+
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+
+import prescreen  # noqa: E402
+from imaging import normalize_image  # noqa: E402
+
+
+def jpeg(img, quality=90):
+    buffer = io.BytesIO()
+    img.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def reference():
+    """A 1024x768 photo-like image: smooth shading with some texture"""
+    y, x = np.mgrid[0:768, 0:1024].astype(np.float64)
+    rng = np.random.default_rng(7)
+    channels = [
+        96 + 60 * np.sin(x / (40 + 15 * c)) * np.cos(y / (55 + 10 * c)) + rng.normal(0, 4, x.shape)
+        for c in range(3)
+    ]
+    pixels = np.clip(np.stack(channels, axis=-1), 0, 255).astype(np.uint8)
+    return Image.fromarray(pixels, 'RGB')
+
+
+def test_byte_identical_pair_is_answered_locally(reference):
+    image = normalize_image(jpeg(reference))
+    result = prescreen.prescreen(image, image)
+    assert result["is_deepfake"] is False
+    assert result["prescreen"]["identical"]
+
+
+def test_recompressed_copy_is_answered_locally(reference):
+    original = normalize_image(jpeg(reference, quality=95))
+    suspected = normalize_image(jpeg(reference, quality=85))
+    result = prescreen.prescreen(original, suspected)
+    assert result is not None and result["is_deepfake"] is False
+
+
+@pytest.mark.parametrize("diameter", [40, 80, 120])
+def test_small_pasted_region_is_escalated_to_the_model(reference, diameter):
+    edited = reference.copy()
+    left, top = 400, 300
+    ImageDraw.Draw(edited).ellipse((left, top, left + diameter, top + diameter), fill=(255, 0, 0))
+    original = normalize_image(jpeg(reference))
+    suspected = normalize_image(jpeg(edited))
+
+    metrics = prescreen.compare(original, suspected)
+    assert metrics["ssim"] > 0.99  # the edit all but disappears in the mean
+    assert prescreen.prescreen(original, suspected) is None
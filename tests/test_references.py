@@ -0,0 +1,62 @@
+import io
+import sys
+
+import pytest
+
+flask = pytest.importorskip("flask")
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("flask_sqlalchemy")
+
+import references  # noqa: E402
+import result_store  # noqa: E402
+from imaging import normalize_image  # noqa: E402
+from storage import ImageStore  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    app = flask.Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + str(tmp_path / "results.db")
+    result_store.init_app(app)
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def image():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 48), (40, 90, 160)).save(buffer, format='PNG')
+    return normalize_image(buffer.getvalue())
+
+
+def test_registering_the_same_image_twice_returns_the_first_reference(app, image, tmp_path):
+    store = ImageStore(str(tmp_path / "references"))
+    first, created = references.register(image, store, label="first")
+    again, created_again = references.register(image, store, label="again")
+    assert created and not created_again
+    assert again.id == first.id
+
+
+def test_concurrent_registration_returns_the_reference_that_won(app, image, tmp_path, monkeypatch):
+    store = ImageStore(str(tmp_path / "references"))
+    compute_features = references.compute_features
+
+    def register_elsewhere_first(img):
+        # Another worker commits the same digest between our check and our insert
+        with result_store.db.engine.begin() as connection:
+            connection.execute(references.Reference.__table__.insert().values(
+                id="b" * 32, digest=img.digest, mime_type=img.mime_type, width=img.size[0],
+                height=img.size[1], features="{}", use_count=0, created_at=result_store._utcnow()))
+        return compute_features(img)
+
+    monkeypatch.setattr(references, "compute_features", register_elsewhere_first)
+    record, created = references.register(image, store)
+    assert not created
+    assert record.id == "b" * 32
+
+
+def test_registration_does_not_import_face_detection(app, image, tmp_path, monkeypatch):
+    monkeypatch.delitem(sys.modules, "faces", raising=False)
+    record, _ = references.register(image, ImageStore(str(tmp_path / "references")))
+    assert "faces" not in sys.modules
+    assert "faces" not in record.to_dict()["features"]
@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from similarity_index import SimilarityIndex  # noqa: E402
+
+REFERENCE = "a" * 64
+OTHER_REFERENCE = "b" * 64
+PHASH = 0x0123456789ABCDEF
+DHASH = 0xFEDCBA9876543210
+
+
+@pytest.fixture
+def index(tmp_path):
+    return SimilarityIndex(str(tmp_path), max_distance=6, refresh_interval=0)
+
+
+def test_near_duplicate_of_a_known_fake_matches_for_the_same_reference(index):
+    index.add("r1", REFERENCE, "d" * 64, PHASH, DHASH, True, "High")
+    match = index.lookup(REFERENCE, PHASH ^ 0b101, DHASH ^ 0b1)
+    assert match is not None
+    assert (match.result_id, match.distance, match.confidence) == ("r1", 2, "High")
+
+
+def test_verdicts_are_not_reused_for_another_reference(index):
+    index.add("r1", REFERENCE, "d" * 64, PHASH, DHASH, True, "High")
+    assert index.lookup(OTHER_REFERENCE, PHASH, DHASH) is None
+
+
+def test_images_cleared_or_too_different_do_not_match(index):
+    index.add("r1", REFERENCE, "d" * 64, PHASH, DHASH, False, "High")
+    index.add("r2", REFERENCE, "e" * 64, ~PHASH & (2 ** 64 - 1), DHASH, True, "High")
+    assert index.lookup(REFERENCE, PHASH, DHASH) is None
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_newer_verdict_for_the_pair_replaces_the_older_one(index, tmp_path, compact):
+    index.add("r1", REFERENCE, "d" * 64, PHASH, DHASH, True, "High")
+    if compact:
+        index.compact()
+    assert index.lookup(REFERENCE, PHASH, DHASH).result_id == "r1"
+
+    # Another worker sees the replacement through the shared database
+    other = SimilarityIndex(str(tmp_path), max_distance=6, refresh_interval=0)
+    other.add("r2", REFERENCE, "d" * 64, PHASH, DHASH, False, "High")
+    assert index.lookup(REFERENCE, PHASH, DHASH) is None
+
+    other.add("r3", REFERENCE, "d" * 64, PHASH, DHASH, True, "Medium")
+    assert index.lookup(REFERENCE, PHASH, DHASH).result_id == "r3"
+    assert len(index) == 2  # the retired row is skipped, not dropped, until the next compaction
+
+
+def test_repeat_verdict_keeps_the_first_entry(index):
+    index.add("r1", REFERENCE, "d" * 64, PHASH, DHASH, True, "High")
+    index.add("r2", REFERENCE, "d" * 64, PHASH, DHASH, True, "High")
+    assert index.lookup(REFERENCE, PHASH, DHASH).result_id == "r1"
+    assert len(index) == 1
+
+
+def test_compaction_drops_replaced_entries(index):
+    index.add("r1", REFERENCE, "d" * 64, PHASH, DHASH, True, "High")
+    index.compact()
+    index.add("r2", REFERENCE, "d" * 64, PHASH, DHASH, True, "Low")
+    index.compact()
+    assert len(index) == 1
+    assert index.lookup(REFERENCE, PHASH, DHASH).result_id == "r2"
@@ -0,0 +1,51 @@
+import io
+
+import pytest
+
+pytest.importorskip("flask")
+Image = pytest.importorskip("PIL.Image")
+
+from upload_validation import UploadRejected, ValidatingStream  # noqa: E402
+
+
+def png(size, mode="RGB"):
+    buffer = io.BytesIO()
+    Image.new(mode, size).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def bomb():
+    """A 2000x2000 bilevel PNG: 4 million pixels in under 1KB"""
+    data = png((2000, 2000), mode="1")
+    assert len(data) < 1024
+    return data
+
+
+def test_small_decompression_bomb_is_rejected_when_the_file_ends():
+    stream = ValidatingStream("bomb.png", max_pixels=1000)
+    stream.write(bomb())
+    assert stream.size is None  # below the first probe step
+    with pytest.raises(UploadRejected, match="too large"):
+        stream.seek(0)
+
+
+def test_small_valid_header_is_accepted_at_the_end():
+    stream = ValidatingStream("small.png", max_pixels=1000)
+    stream.write(png((20, 20)))
+    stream.seek(0)
+    assert stream.size == (20, 20)
+
+
+def test_close_checks_an_unvalidated_file():
+    stream = ValidatingStream("bomb.png", max_pixels=1000)
+    stream.write(bomb())
+    with pytest.raises(UploadRejected, match="too large"):
+        stream.close()
+    assert stream.closed
+
+
+def test_empty_file_is_left_to_the_endpoint():
+    stream = ValidatingStream("")
+    stream.seek(0)
+    stream.close()
+    assert stream.size is None
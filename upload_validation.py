@@ -0,0 +1,142 @@
+"""
+Fast-fail validation of image uploads while the request body streams in.
+
+Werkzeug's multipart parser writes each uploaded file into a stream obtained
+from the request. UploadRequest hands it a ValidatingStream, which sniffs the
+file signature as soon as the first bytes arrive and parses the image header
+once enough of the file is buffered, or when the whole file has arrived. A disguised file, a decompression bomb
+or an image over the pixel limit raises UploadRejected there and then,
+before the rest of the body (including any later files) is read.
+
+Endpoints that accept video (see `upload_spool_endpoints`) receive files with
+a video extension into a temporary file on disk instead, so large clips are
+never held in memory; their container is checked before decoding.
+"""
+
+import io
+import os
+import tempfile
+
+from flask import Request
+
+from imaging import (
+    ALLOWED_FORMATS, MAX_INPUT_PIXELS, SIGNATURE_BYTES, ImageNormalizationError, check_pixels, read_header,
+    sniff_format
+)
+
+# Buffered sizes at which the header is parsed; most headers fit in the first step, but
+# JPEG metadata segments can push the frame header further into the file
+PROBE_STEPS = (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024)
+
+
+class UploadRejected(Exception):
+    """
+    An uploaded file failed validation.
+
+    Deliberately not a ValueError: Werkzeug's form parser silently discards
+    ValueErrors raised while parsing.
+    """
+
+    def __init__(self, message, filename=None):
+        super().__init__(message)
+        self.filename = filename
+
+
+class ValidatingStream(io.BytesIO):
+    """In-memory upload buffer that validates the image as data is written to it"""
+
+    def __init__(self, filename=None, allowed_formats=ALLOWED_FORMATS, max_pixels=MAX_INPUT_PIXELS):
+        super().__init__()
+        self.filename = filename
+        self.allowed_formats = allowed_formats
+        self.max_pixels = max_pixels
+        self.format = None
+        self.size = None
+        self._probe_step = 0
+        self._finished = False
+
+    def write(self, data):
+        written = super().write(data)
+        if self.size is None:
+            self._validate()
+        return written
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # Werkzeug rewinds the stream once the whole file has been received
+        self._finish()
+        return super().seek(offset, whence)
+
+    def close(self):
+        try:
+            if not self.closed:
+                self._finish()
+        finally:
+            super().close()
+
+    def _finish(self):
+        """
+        Validate a complete file that never reached a probe step.
+
+        Files smaller than the first step (including small decompression
+        bombs) would otherwise never have their header checked while
+        streaming. Empty files are left to the endpoint, which treats them
+        as a missing upload.
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if self.size is None and self.getbuffer().nbytes:
+            self._validate(final=True)
+
+    def _validate(self, final=False):
+        buffered = self.getbuffer().nbytes
+
+        if self.format is None:
+            if buffered < SIGNATURE_BYTES and not final:
+                return
+            fmt = sniff_format(self.getbuffer()[:SIGNATURE_BYTES].tobytes())
+            if fmt is None:
+                raise UploadRejected("File is not a recognised image", self.filename)
+            if fmt not in self.allowed_formats:
+                raise UploadRejected(f"{fmt} images are not accepted", self.filename)
+            self.format = fmt
+
+        if not final and (self._probe_step >= len(PROBE_STEPS) or buffered < PROBE_STEPS[self._probe_step]):
+            return
+        self._probe_step += 1
+
+        try:
+            size = read_header(self.getvalue(), self.format)
+        except ImageNormalizationError:
+            # Probably a header that is not complete yet; give up once the last step or the end is reached
+            if final or self._probe_step >= len(PROBE_STEPS):
+                raise UploadRejected("Could not read the image header", self.filename)
+            return
+
+        try:
+            check_pixels(size, self.max_pixels)
+        except ImageNormalizationError as e:
+            raise UploadRejected(str(e), self.filename) from e
+        self.size = size
+
+
+class UploadRequest(Request):
+    """Request class whose uploaded files are validated while they are received"""
+
+    upload_allowed_formats = ALLOWED_FORMATS
+    upload_max_pixels = MAX_INPUT_PIXELS
+
+    # Endpoints whose files with these extensions are spooled to disk unvalidated, and their body size limits
+    upload_spool_endpoints = {}
+    upload_spool_extensions = frozenset()
+
+    @property
+    def max_content_length(self):
+        limit = self.upload_spool_endpoints.get(self.endpoint)
+        return limit if limit is not None else super().max_content_length
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        extension = os.path.splitext(filename or '')[1].lstrip('.').lower()
+        if self.endpoint in self.upload_spool_endpoints and extension in self.upload_spool_extensions:
+            return tempfile.NamedTemporaryFile('w+b', suffix=f'.{extension}')
+        return ValidatingStream(filename, self.upload_allowed_formats, self.upload_max_pixels)
@@ -0,0 +1,209 @@
+"""
+Verdict cache for deepfake analyses.
+
+Results are keyed on a content hash of both normalized images together with
+the model name and prompt version, so a repeat submission of the same image
+pair is answered without another Gemini round trip. The cache has an
+in-process LRU tier and an optional SQLite tier shared by every worker on
+the same machine.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def file_digest(file_path, chunk_size=64 * 1024):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_digest(data):
+    """Return the SHA-256 hex digest of an in-memory byte string"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_cache_key(original_digest, suspected_digest, model_name, prompt_version):
+    """Build the cache key for an image pair analysed by a given model and prompt"""
+    material = "|".join([original_digest, suspected_digest, model_name, str(prompt_version)])
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class VerdictCache:
+    """Two-tier (memory + optional SQLite) cache of analysis results"""
+
+    def __init__(self, max_entries=1024, ttl=7 * 24 * 3600, db_path=None, max_disk_entries=100000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._writes_since_prune = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+
+        if db_path:
+            self._open_db(db_path)
+
+    def _open_db(self, db_path):
+        """Open (and create if needed) the on-disk tier"""
+        try:
+            directory = os.path.dirname(os.path.abspath(db_path))
+            os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(db_path, timeout=5, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS verdicts_accessed ON verdicts (accessed)")
+            self._db.commit()
+            logger.info("Verdict cache disk tier enabled at %s", db_path)
+        except sqlite3.Error as e:
+            logger.error("Could not open verdict cache database %s: %s", db_path, e)
+            self._db = None
+
+    def reopen(self):
+        """
+        Open a fresh database connection, e.g. in a worker forked from a process
+        that already held one. The inherited connection is abandoned, not closed,
+        because closing it would release the parent's locks.
+        """
+        with self._lock:
+            if self.db_path:
+                self._open_db(self.db_path)
+
+    def _is_expired(self, created, now):
+        return self.ttl > 0 and now - created > self.ttl
+
+    def get(self, key):
+        """Return a copy of the cached result for key, or None on a miss"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if not self._is_expired(created, now):
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    self.memory_hits += 1
+                    return dict(value)
+                del self._memory[key]
+
+            value = self._disk_get(key, now)
+            if value is not None:
+                self._memory_set(key, value, now)
+                self.hits += 1
+                self.disk_hits += 1
+                return dict(value)
+
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        """Store a result under key in every enabled tier"""
+        now = time.time()
+        value = dict(value)
+        with self._lock:
+            self._memory_set(key, value, now)
+            self._disk_set(key, value, now)
+
+    def clear(self):
+        """Drop every cached entry and reset the counters"""
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                try:
+                    self._db.execute("DELETE FROM verdicts")
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    logger.error("Error clearing verdict cache database: %s", e)
+            self.hits = self.misses = self.memory_hits = self.disk_hits = 0
+
+    def stats(self):
+        """Return hit/miss counters and tier sizes"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_enabled": self._db is not None,
+            }
+
+    def _memory_set(self, key, value, now):
+        if self.max_entries <= 0:
+            return
+        self._memory[key] = (now, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _disk_get(self, key, now):
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT value, created FROM verdicts WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self._is_expired(created, now):
+                self._db.execute("DELETE FROM verdicts WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE verdicts SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            return json.loads(value)
+        except (sqlite3.Error, ValueError) as e:
+            logger.error("Error reading verdict cache database: %s", e)
+            return None
+
+    def _disk_set(self, key, value, now):
+        if self._db is None:
+            return
+        try:
+            self._db.execute(
+                "INSERT OR REPLACE INTO verdicts (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self._db.commit()
+            self._writes_since_prune += 1
+            if self._writes_since_prune >= 100:
+                self._disk_prune(now)
+        except (sqlite3.Error, TypeError) as e:
+            logger.error("Error writing verdict cache database: %s", e)
+
+    def _disk_prune(self, now):
+        """Remove expired rows and trim the table to max_disk_entries"""
+        self._writes_since_prune = 0
+        if self.ttl > 0:
+            self._db.execute("DELETE FROM verdicts WHERE created < ?", (now - self.ttl,))
+        self._db.execute(
+            "DELETE FROM verdicts WHERE key IN ("
+            "SELECT key FROM verdicts ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+            (self.max_disk_entries,),
+        )
+        self._db.commit()
@@ -0,0 +1,178 @@
+"""
+Turning model output into a verdict.
+
+In structured mode the model is asked for JSON matching RESPONSE_SCHEMA and
+the reply is validated by parse_structured_verdict. Free-form replies (the
+detailed prompt, or a structured reply that fails validation) go through the
+keyword heuristic in parse_free_text_verdict.
+"""
+
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+CRITERIA = ("identity", "manipulation", "lighting", "edges", "facial_features", "texture")
+
+CONFIDENCE_LEVELS = {"low": "Low", "medium": "Medium", "high": "High"}
+
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "verdict": {"type": "string", "format": "enum", "enum": ["deepfake", "authentic"]},
+        "confidence": {"type": "string", "format": "enum", "enum": list(CONFIDENCE_LEVELS)},
+        "same_person": {"type": "boolean"},
+        "scores": {
+            "type": "object",
+            "properties": {name: {"type": "number"} for name in CRITERIA},
+        },
+        "rationale": {"type": "string"},
+    },
+    "required": ["verdict", "confidence", "same_person", "rationale"],
+}
+
+# Terse prompt for structured mode: scores instead of prose keeps the reply short
+STRUCTURED_PROMPT = """
+Image 1 is the reference/original image. Image 2 is a suspected deepfake or manipulated version.
+Decide whether image 2 is a deepfake or manipulated. If the images show different people, the
+verdict MUST be "deepfake" with high confidence.
+Score each criterion from 0 (no sign of manipulation) to 1 (clear manipulation):
+identity (different person), manipulation (editing traces), lighting (lighting/shadow/reflection
+inconsistencies), edges (unnatural edges, blurring, artifacts), facial_features (proportions of
+eyes, nose, mouth, jawline), texture (texture inconsistencies).
+Reply with JSON only. Keep the rationale under 60 words.
+"""
+
+# Output cap for structured replies; the schema needs far fewer tokens than this
+STRUCTURED_MAX_OUTPUT_TOKENS = 512
+
+
+class VerdictParseError(ValueError):
+    """Raised when a structured reply does not match RESPONSE_SCHEMA"""
+
+
+def structured_generation_config():
+    """generation_config asking Gemini for JSON matching RESPONSE_SCHEMA"""
+    return {
+        "response_mime_type": "application/json",
+        "response_schema": RESPONSE_SCHEMA,
+        "max_output_tokens": STRUCTURED_MAX_OUTPUT_TOKENS,
+    }
+
+
+def parse_structured_verdict(text):
+    """Validate a JSON reply and convert it into a result dict"""
+    try:
+        data = json.loads(text)
+    except ValueError as e:
+        raise VerdictParseError(f"Reply is not valid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise VerdictParseError("Reply is not a JSON object")
+
+    verdict = data.get("verdict")
+    if verdict not in ("deepfake", "authentic"):
+        raise VerdictParseError(f"Unknown verdict: {verdict!r}")
+
+    confidence = CONFIDENCE_LEVELS.get(str(data.get("confidence", "")).lower())
+    if confidence is None:
+        raise VerdictParseError(f"Unknown confidence: {data.get('confidence')!r}")
+
+    rationale = data.get("rationale")
+    if not isinstance(rationale, str):
+        raise VerdictParseError("Missing rationale")
+
+    scores = {}
+    raw_scores = data.get("scores") or {}
+    if not isinstance(raw_scores, dict):
+        raise VerdictParseError("Scores must be an object")
+    for name in CRITERIA:
+        value = raw_scores.get(name)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            scores[name] = min(max(float(value), 0.0), 1.0)
+
+    is_deepfake = verdict == "deepfake"
+    same_person = data.get("same_person")
+    # Different people always means a deepfake, whatever the verdict field says
+    if same_person is False and not is_deepfake:
+        is_deepfake, confidence = True, "High"
+
+    return {
+        "is_deepfake": is_deepfake,
+        "confidence": confidence,
+        "analysis": format_structured_analysis(is_deepfake, confidence, same_person, scores, rationale),
+        "scores": scores,
+    }
+
+
+def format_structured_analysis(is_deepfake, confidence, same_person, scores, rationale):
+    """Render a structured verdict as the readable text shown on the results page"""
+    lines = [
+        "Determination: " + ("deepfake or manipulated" if is_deepfake else "authentic"),
+        f"Confidence: {confidence}",
+    ]
+    if same_person is not None:
+        lines.append("Same person: " + ("yes" if same_person else "no"))
+    if scores:
+        lines.append("")
+        lines.append("Criterion scores (0 = no sign of manipulation, 1 = clear manipulation):")
+        for name, value in scores.items():
+            lines.append(f"  {name.replace('_', ' ')}: {value:.2f}")
+    lines.append("")
+    lines.append("Reasoning:")
+    lines.append(rationale.strip())
+    return "\n".join(lines)
+
+
+def parse_free_text_verdict(analysis):
+    """Infer the verdict from free-form prose by keyword matching"""
+    # Extract determination
+    is_deepfake = False
+    confidence = "Medium"  # Default to Medium instead of Unknown
+
+    # Check for keywords that indicate different people or deepfake
+    text_lower = analysis.lower()
+
+    # Strong indicators of different people/deepfake
+    if any(phrase in text_lower for phrase in [
+        "different people",
+        "not the same person",
+        "completely different",
+        "two different individuals",
+        "different individuals"
+    ]):
+        is_deepfake = True
+        confidence = "High"
+    # Indicators of same person (non-deepfake)
+    elif "same person" in text_lower and "not a deepfake" in text_lower:
+        is_deepfake = False
+        confidence = "High" if "high confidence" in text_lower else "Medium"
+    else:
+        # Fall back to yes/no determination
+        if "yes" in text_lower and ("deepfake" in text_lower or "manipulated" in text_lower):
+            is_deepfake = True
+        elif "no" in text_lower and "not a deepfake" in text_lower:
+            is_deepfake = False
+
+        # Extract confidence
+        if "high confidence" in text_lower:
+            confidence = "High"
+        elif "medium confidence" in text_lower:
+            confidence = "Medium"
+        elif "low confidence" in text_lower:
+            confidence = "Low"
+
+    return {
+        "is_deepfake": is_deepfake,
+        "confidence": confidence,
+        "analysis": analysis
+    }
+
+
+def parse_verdict(text, structured=False):
+    """Parse a model reply, falling back to the keyword heuristic if structured parsing fails"""
+    if structured:
+        try:
+            return parse_structured_verdict(text)
+        except VerdictParseError as e:
+            logger.warning("Structured verdict rejected, using keyword heuristic: %s", e)
+    return parse_free_text_verdict(text)
@@ -107,6 +107,7 @@ def check_python_packages():
     """Check if required Python packages are installed."""
     required_packages = [
         'flask',
+        'flask_sqlalchemy',
         'google.generativeai',
         'dotenv',
         'PIL',
@@ -131,6 +132,8 @@ def check_python_packages():
                 print(f"  - {package} (Install with: pip install pillow)")
             elif package == 'dotenv':
                 print(f"  - {package} (Install with: pip install python-dotenv)")
+            elif package == 'flask_sqlalchemy':
+                print(f"  - {package} (Install with: pip install flask-sqlalchemy)")
             else:
                 print(f"  - {package} (Install with: pip install {package})")
         
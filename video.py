@@ -0,0 +1,194 @@
+"""
+Keyframe sampling and verdict aggregation for video clips.
+
+A clip is decoded one frame at a time, so memory stays bounded whatever its
+length. Only every `sample_every`-th frame is examined, and only frames that
+differ enough from the last keyframe are kept: a scene change (grayscale
+histogram distance) or a change in the face region (mean difference of the
+largest detected face, resized to a small fixed size). Each keyframe is
+JPEG-encoded and handed to the caller, which normalizes it like any other
+upload and scores it against the reference image.
+
+Per-frame verdicts are combined by `aggregate_verdicts` into one verdict for
+the clip with a per-timestamp breakdown.
+
+Requires OpenCV (opencv-python-headless) and NumPy.
+"""
+
+import logging
+import math
+
+import cv2
+import numpy as np
+
+from faces import find_faces
+
+logger = logging.getLogger(__name__)
+
+# Container signatures we accept; anything else is rejected before decoding
+VIDEO_FORMATS = ('MP4', 'WEBM', 'AVI')
+
+# Frames are compared at this size; faces are detected on the same thumbnail
+SIGNATURE_WIDTH = 320
+HISTOGRAM_BINS = 32
+FACE_SIZE = (32, 32)
+KEYFRAME_QUALITY = 90
+
+CONFIDENCE_RANKS = {"low": 0, "medium": 1, "high": 2}
+
+
+class VideoDecodeError(ValueError):
+    """Raised when an upload cannot be decoded as a video"""
+
+
+class Keyframe:
+    """One frame selected for scoring"""
+
+    __slots__ = ('index', 'timestamp', 'reason', 'data')
+
+    def __init__(self, index, timestamp, reason, data):
+        self.index = index
+        self.timestamp = timestamp
+        self.reason = reason
+        self.data = data
+
+
+def sniff_video_format(head):
+    """Identify a video container from its first 12 bytes, or return None"""
+    if head[4:8] == b'ftyp':
+        return 'MP4'  # also QuickTime .mov, which shares the ISO base media format
+    if head[:4] == b'\x1a\x45\xdf\xa3':
+        return 'WEBM'  # also Matroska
+    if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+        return 'AVI'
+    return None
+
+
+def _largest_face(gray):
+    """Crop of the largest detected face, resized to FACE_SIZE, or None"""
+    faces = find_faces(gray)
+    if not faces:
+        return None
+    x, y, w, h = faces[0]
+    return cv2.resize(gray[y:y + h, x:x + w], FACE_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+
+
+def _signature(frame):
+    """Normalized grayscale histogram and face crop of a downscaled frame"""
+    height, width = frame.shape[:2]
+    scale = SIGNATURE_WIDTH / width if width > SIGNATURE_WIDTH else 1.0
+    small = cv2.resize(frame, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+    histogram = cv2.calcHist([gray], [0], None, [HISTOGRAM_BINS], [0, 256])
+    cv2.normalize(histogram, histogram)
+    return histogram, _largest_face(gray)
+
+
+def _face_change(previous, current):
+    """Mean absolute difference (0-1) between two face crops; appearing or vanishing faces count as 1"""
+    if previous is None and current is None:
+        return 0.0
+    if previous is None or current is None:
+        return 1.0
+    return float(np.mean(np.abs(previous - current))) / 255.0
+
+
+def iter_keyframes(path, sample_every=5, scene_threshold=0.35, face_threshold=0.12, min_gap=1.0,
+                   max_frames=16, max_duration=120.0):
+    """
+    Decode the video at path and yield Keyframe objects as they are selected.
+
+    The first examined frame is always kept. Later frames are kept when their
+    histogram distance (Bhattacharyya, 0-1) to the last keyframe exceeds
+    scene_threshold or their face region differs by more than face_threshold,
+    at most one per min_gap seconds and max_frames in total. Decoding stops
+    after max_duration seconds of video.
+
+    Raises VideoDecodeError if the file cannot be opened as a video.
+    """
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise VideoDecodeError("Could not open video")
+
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS) or 25.0
+        min_gap_frames = max(1, int(min_gap * fps))
+        last_histogram = last_face = None
+        last_index = None
+        kept = 0
+        index = -1
+
+        while kept < max_frames:
+            if not capture.grab():
+                break
+            index += 1
+            if index / fps > max_duration:
+                break
+            if index % sample_every:
+                continue  # grabbed but never converted, which is much cheaper than a full read
+
+            ok, frame = capture.retrieve()
+            if not ok:
+                break
+
+            histogram, face = _signature(frame)
+            if last_index is None:
+                reason = "first"
+            elif index - last_index < min_gap_frames:
+                continue
+            elif cv2.compareHist(last_histogram, histogram, cv2.HISTCMP_BHATTACHARYYA) > scene_threshold:
+                reason = "scene"
+            elif _face_change(last_face, face) > face_threshold:
+                reason = "face"
+            else:
+                continue
+
+            encoded, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, KEYFRAME_QUALITY])
+            if not encoded:
+                continue
+            last_histogram, last_face, last_index = histogram, face, index
+            kept += 1
+            yield Keyframe(index, round(index / fps, 3), reason, buffer.tobytes())
+
+        if index < 0:
+            raise VideoDecodeError("Video contains no decodable frames")
+        logger.info("Selected %s keyframes from %s frames", kept, index + 1)
+    finally:
+        capture.release()
+
+
+def aggregate_verdicts(frames, deepfake_ratio=0.3):
+    """
+    Combine per-frame verdicts into one verdict for the clip.
+
+    frames is a list of dicts with `timestamp` plus the keys returned by
+    analyze_images_with_gemini. The clip is flagged when at least
+    deepfake_ratio of the scored frames (and at least one) are flagged.
+    Confidence is the most common confidence among the frames that agree
+    with the clip verdict, lowered to Low when fewer than half agree.
+    Frames that failed are listed but do not vote.
+    """
+    scored = [frame for frame in frames if frame.get("is_deepfake") is not None]
+    if not scored:
+        return {
+            "is_deepfake": None,
+            "confidence": "Low",
+            "analysis": "No frame of the clip could be analyzed.",
+            "error": "No frame of the clip could be analyzed",
+        }
+
+    flagged = [frame for frame in scored if frame["is_deepfake"]]
+    is_deepfake = len(flagged) >= max(1, math.ceil(deepfake_ratio * len(scored)))
+    agreeing = flagged if is_deepfake else [frame for frame in scored if not frame["is_deepfake"]]
+
+    confidences = [str(frame.get("confidence") or "Medium").capitalize() for frame in agreeing]
+    confidence = max(set(confidences), key=lambda value: (confidences.count(value),
+                                                          CONFIDENCE_RANKS.get(value.lower(), 0)))
+    if len(agreeing) * 2 < len(scored):
+        confidence = "Low"
+
+    timestamps = ", ".join(f"{frame['timestamp']:.1f}s" for frame in flagged) or "none"
+    analysis = (f"{len(flagged)} of {len(scored)} analyzed frames appear manipulated "
+                f"(flagged at: {timestamps}).")
+    return {"is_deepfake": is_deepfake, "confidence": confidence, "analysis": analysis}